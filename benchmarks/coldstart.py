@@ -0,0 +1,100 @@
+"""Cold-start benchmark with an enforced time budget.
+
+Boots the bot in a fresh interpreter against the fake Telegram and Gemini
+servers from loadtest.py, up to the point where it would start taking updates
+(imports, config, application build, Telegram initialize, history load and
+Gemini warm-up), and prints the per-phase startup profile. Exits non-zero when
+the median time to ready exceeds the budget, so it can gate deploys in CI.
+
+Usage:
+    python benchmarks/coldstart.py [--runs 5] [--budget 1.5] [--history-chats 5000]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from loadtest import REPO_ROOT, FakeGemini, FakeServer, FakeTelegram, LatencyTracker, parse_args as loadtest_args, write_config
+
+CHILD = """
+import asyncio, json, sys, time
+sys.path.insert(0, {repo!r})
+import main
+
+async def boot():
+    application = main.build_application()
+    await application.initialize()
+    await main.post_init(application)
+    ready_at = time.time()
+    await application.shutdown()
+    await main.post_shutdown(application)
+    return ready_at
+
+ready_at = asyncio.run(boot())
+print(json.dumps({{"ready_at": ready_at, "phases": main.startup_profile.phases}}))
+"""
+
+def seed_history(chats: int):
+    """Give the bot a realistic conversation_history.json to load"""
+    entry = [0, 1704067200.0, "kal movie dekhi bahut acchi thi, tum batao"]
+    with open("conversation_history.json", "w") as f:
+        json.dump({str(chat_id): [entry] * 10 for chat_id in range(chats)}, f)
+
+def run_once() -> dict:
+    spawned_at = time.time()
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD.format(repo=REPO_ROOT)],
+        capture_output=True, text=True, timeout=120
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise SystemExit(f"bot failed to start (exit code {result.returncode})")
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report["ready"] = report["ready_at"] - spawned_at
+    return report
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measure bot cold start and enforce a budget")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=1.5, help="max median seconds from exec to ready")
+    parser.add_argument('--history-chats', type=int, default=5000, help="chats in the seeded history file")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help="extra config.txt setting")
+    args = parser.parse_args(argv)
+
+    fake_args = loadtest_args(["--gemini-latency", "0", "--telegram-latency", "0"] + [f"--set={s}" for s in args.set])
+    servers = [FakeServer(FakeTelegram(LatencyTracker(), 0)), FakeServer(FakeGemini(fake_args))]
+    for server in servers:
+        server.start()
+
+    os.chdir(tempfile.mkdtemp(prefix="hinata-coldstart-"))
+    write_config(fake_args, servers[0].port, servers[1].port)
+    seed_history(args.history_chats)
+
+    try:
+        # The first boot imports the seeded JSON into the SQLite store, a one-off that isn't timed
+        run_once()
+        runs = [run_once() for _ in range(args.runs)]
+    finally:
+        for server in servers:
+            server.stop()
+
+    phases = {}
+    for run in runs:
+        for phase, seconds in run["phases"]:
+            phases.setdefault(phase, []).append(seconds)
+    for phase, samples in phases.items():
+        print(f"{phase:>20}: {statistics.median(samples) * 1000:7.1f}ms")
+
+    ready = statistics.median(run["ready"] for run in runs)
+    print(f"{'ready (median)':>20}: {ready * 1000:7.1f}ms, budget {args.budget * 1000:.0f}ms")
+    if ready > args.budget:
+        print("cold start is over budget")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
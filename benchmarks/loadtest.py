@@ -0,0 +1,478 @@
+"""Offline end-to-end load test for the bot.
+
+Starts a fake Telegram Bot API and a fake Gemini endpoint on localhost, points
+a fresh copy of the bot at them and feeds the real Application simulated
+private-chat messages at a target rate. Reply latency is measured from the
+moment an update is queued until the fake Telegram server receives the first
+sendMessage for that chat (the full reply, or the first chunk when streaming).
+
+Usage:
+    python benchmarks/loadtest.py --chats 200 --rate 50 --duration 30 \\
+        --gemini-latency 0.4 --gemini-429-rate 0.05 --set CONCURRENT_UPDATES=64
+
+    # Capture real Gemini responses once, then replay them deterministically
+    python benchmarks/loadtest.py --record gemini.jsonl --api-key $GEMINI_API_KEY
+    python benchmarks/loadtest.py --replay gemini.jsonl
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional
+
+import httpx
+import uvicorn
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:LOADTEST"
+REAL_GEMINI_BASE = "https://generativelanguage.googleapis.com/v1beta"
+GREETINGS = ["hi", "hello", "hey", "gm", "good night", "kya haal hai"]
+WORDS = "kal movie dekhi bahut acchi thi tum batao aaj kya plan hai weekend pe ghumne chale".split()
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def read_body(receive) -> bytes:
+    body = b""
+    while True:
+        event = await receive()
+        body += event.get("body", b"")
+        if not event.get("more_body"):
+            return body
+
+async def send_json(send, status: int, payload, headers: Optional[List] = None):
+    body = json.dumps(payload).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())] + (headers or [])
+    })
+    await send({"type": "http.response.body", "body": body})
+
+class LatencyTracker:
+    """Match each queued message to the next reply sent to its chat"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending: Dict[int, collections.deque] = collections.defaultdict(collections.deque)
+        self.latencies: List[float] = []
+        self.sent = 0
+        self.first_sent = None
+        self.last_reply = None
+
+    def queued(self, chat_id: int):
+        now = time.perf_counter()
+        with self.lock:
+            self.pending[chat_id].append(now)
+            self.sent += 1
+            if self.first_sent is None:
+                self.first_sent = now
+
+    def replied(self, chat_id: int):
+        now = time.perf_counter()
+        with self.lock:
+            waiting = self.pending.get(chat_id)
+            if waiting:
+                self.latencies.append(now - waiting.popleft())
+                self.last_reply = now
+
+    def outstanding(self) -> int:
+        with self.lock:
+            return sum(len(waiting) for waiting in self.pending.values())
+
+# Openings of the bot's admission-control replies
+THROTTLE_NOTICES = ("🐢 Slow down", "😵 I'm getting a lot of messages")
+
+class FakeTelegram:
+    """Minimal Bot API: answers the methods the bot calls and reports replies to the tracker"""
+    def __init__(self, tracker: LatencyTracker, latency: float):
+        self.tracker = tracker
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.message_ids = 0
+
+    def message(self, chat_id: int, text: str) -> Dict:
+        self.message_ids += 1
+        return {
+            "message_id": self.message_ids,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 123456, "is_bot": True, "first_name": "Hinata", "username": "loadtest_bot"},
+            "text": text
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        body = await read_body(receive)
+        method = scope["path"].rsplit("/", 1)[-1]
+        self.calls[method] += 1
+
+        if scope.get("headers") and (b"content-type", b"application/json") in scope["headers"]:
+            params = json.loads(body or b"{}")
+        else:
+            params = {k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Hinata", "username": "loadtest_bot"}
+        elif method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            if params.get("text", "").startswith(THROTTLE_NOTICES):
+                # A rate-limit notice is not an answer; the throttled message stays unanswered
+                self.calls["throttled"] += 1
+            else:
+                self.tracker.replied(chat_id)
+            result = self.message(chat_id, params.get("text", ""))
+        elif method == "getUpdates":
+            # Nothing to deliver; behave like an idle long poll
+            await asyncio.sleep(min(1.0, float(params.get("timeout", 0))))
+            result = []
+        elif method == "editMessageText":
+            result = self.message(int(params.get("chat_id", 0)), params.get("text", ""))
+        else:
+            result = True
+        await send_json(send, 200, {"ok": True, "result": result})
+
+class FakeGemini:
+    """Gemini REST stand-in with configurable latency, 429 rate and reply size.
+
+    With record set, requests are forwarded to the real API and every response
+    is appended to a JSONL file; with replay set, those responses are served
+    back in the order they were captured.
+    """
+    def __init__(self, args):
+        self.latency = args.gemini_latency
+        self.jitter = args.gemini_jitter
+        self.rate_limit = args.gemini_429_rate
+        self.slow_rate = args.gemini_slow_rate
+        self.slow_latency = args.gemini_slow_latency
+        self.retry_after = args.retry_after
+        self.response_chars = args.response_chars
+        self.chunks = args.stream_chunks
+        self.rng = random.Random(args.seed)
+        self.counts = collections.Counter()
+        # cachedContents names that generate calls are told no longer exist
+        self.expired_caches = set()
+        self.record_file = open(args.record, "a") if args.record else None
+        self.upstream = httpx.AsyncClient(timeout=60) if args.record else None
+        self.replay: Dict[str, collections.deque] = collections.defaultdict(collections.deque)
+        if args.replay:
+            with open(args.replay) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.replay[entry["method"]].append(entry)
+
+    def reply_text(self) -> str:
+        words = []
+        while sum(len(w) + 1 for w in words) < self.response_chars:
+            words.append(self.rng.choice(WORDS))
+        return " ".join(words)[:self.response_chars]
+
+    @staticmethod
+    def candidate(text: str) -> Dict:
+        return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}]}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        body = await read_body(receive)
+        path = scope["path"]
+        method = path.rsplit(":", 1)[-1] if ":" in path else path.rsplit("/", 1)[-1]
+        self.counts[method] += 1
+        request = json.loads(body) if body and scope["method"] == "POST" else {}
+        if "cachedContent" in request:
+            self.counts["cachedContent"] += 1
+
+        if self.upstream is not None:
+            await self.forward(scope, body, method, send)
+        elif self.replay:
+            await self.play(method, request, send)
+        else:
+            await self.synthesize(method, request, send)
+
+    async def synthesize(self, method: str, request: Dict, send):
+        if method == "models":
+            await send_json(send, 200, {"models": []})
+            return
+        if method == "cachedContents":
+            await send_json(send, 200, {"name": f"cachedContents/loadtest-{self.counts[method]}"})
+            return
+        if request.get("cachedContent") in self.expired_caches:
+            await send_json(send, 404, {"error": {"code": 404, "status": "NOT_FOUND"}})
+            return
+
+        latency = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+        if self.rng.random() < self.slow_rate:
+            self.counts["slow"] += 1
+            latency = self.slow_latency
+        await asyncio.sleep(max(0.0, latency))
+        if self.rng.random() < self.rate_limit:
+            self.counts["429"] += 1
+            await send_json(send, 429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}},
+                            [(b"retry-after", str(self.retry_after).encode())])
+            return
+
+        text = self.reply_text()
+        if method != "streamGenerateContent":
+            await send_json(send, 200, self.candidate(text))
+            return
+
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/event-stream")]})
+        size = max(1, len(text) // self.chunks + 1)
+        for start in range(0, len(text), size):
+            chunk = "data: " + json.dumps(self.candidate(text[start:start + size])) + "\r\n\r\n"
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+            await asyncio.sleep(self.latency / self.chunks)
+        await send({"type": "http.response.body", "body": b""})
+
+    async def play(self, method: str, request: Dict, send):
+        entries = self.replay.get(method)
+        if not entries:
+            await self.synthesize(method, request, send)
+            return
+        entry = entries[0]
+        entries.rotate(-1)
+        await asyncio.sleep(entry["latency"])
+        content_type = b"text/event-stream" if method == "streamGenerateContent" else b"application/json"
+        await send({"type": "http.response.start", "status": entry["status"], "headers": [(b"content-type", content_type)]})
+        await send({"type": "http.response.body", "body": entry["body"].encode()})
+
+    async def forward(self, scope, body: bytes, method: str, send):
+        url = REAL_GEMINI_BASE + scope["path"].split("/v1beta", 1)[-1]
+        if scope.get("query_string"):
+            url += "?" + scope["query_string"].decode()
+        started = time.perf_counter()
+        response = await self.upstream.request(scope["method"], url, content=body or None,
+                                               headers={"content-type": "application/json"})
+        entry = {
+            "method": method,
+            "status": response.status_code,
+            "latency": round(time.perf_counter() - started, 4),
+            "body": response.text
+        }
+        self.record_file.write(json.dumps(entry) + "\n")
+        self.record_file.flush()
+        headers = [(b"content-type", response.headers.get("content-type", "application/json").encode())]
+        if "retry-after" in response.headers:
+            headers.append((b"retry-after", response.headers["retry-after"].encode()))
+        await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": response.content})
+
+class FakeServer:
+    """Run an ASGI app under uvicorn on its own thread and event loop"""
+    def __init__(self, app):
+        self.port = free_port()
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host="127.0.0.1", port=self.port, log_level="warning", lifespan="off"
+        ))
+        self.thread = threading.Thread(target=asyncio.run, args=(self.server.serve(),), daemon=True)
+
+    def start(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
+
+class LagMonitor:
+    """Sample how late the bot's event loop wakes up from a short sleep"""
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: List[float] = []
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+def write_config(args, telegram_port: int, gemini_port: int):
+    keys = args.api_key or [f"fake-key-{i}" for i in range(args.keys)]
+    settings = {
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+        "HINGLISH_PROMPT": "You are a friendly Hinglish chat bot. Keep replies short.",
+        "TELEGRAM_API_BASE": f"http://127.0.0.1:{telegram_port}/bot",
+        "GEMINI_API_BASE": f"http://127.0.0.1:{gemini_port}/v1beta",
+        "STREAM_REPLIES": "true" if args.stream else "false",
+        # Admission control would turn the offered load into throttle notices; --set re-enables it
+        "USER_RATE_LIMIT": "0",
+        "CHAT_RATE_LIMIT": "0",
+        "GLOBAL_RATE_LIMIT": "0"
+    }
+    for i, key in enumerate(keys):
+        settings["GEMINI_API_KEY" if i == 0 else f"GEMINI_API_KEY_{i}"] = key
+    for item in args.set:
+        key, value = item.split("=", 1)
+        settings[key.strip()] = value.strip()
+    with open("config.txt", "w") as f:
+        for key, value in settings.items():
+            f.write(f"{key}={value}\n")
+
+def make_update(update_id: int, chat_id: int, text: str) -> Dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"},
+            "text": text
+        }
+    }
+
+async def drive(args, tracker: LatencyTracker) -> Dict:
+    import main
+    from telegram import Update
+
+    application = main.build_application()
+    await application.initialize()
+    # run_polling normally calls these hooks around start/stop
+    await main.post_init(application)
+    await application.start()
+
+    rng = random.Random(args.seed)
+    lag = LagMonitor()
+    lag_task = asyncio.create_task(lag.run())
+
+    started = time.perf_counter()
+    next_at = started
+    update_id = 0
+    while next_at - started < args.duration:
+        next_at += rng.expovariate(args.rate)
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        update_id += 1
+        chat_id = rng.randint(1, args.chats)
+        if rng.random() < args.repeat_ratio:
+            text = rng.choice(GREETINGS)
+        else:
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        tracker.queued(chat_id)
+        await application.update_queue.put(Update.de_json(make_update(update_id, chat_id, text), application.bot))
+
+    deadline = time.perf_counter() + args.drain_timeout
+    while tracker.outstanding() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+
+    lag_task.cancel()
+    await application.stop()
+    await application.shutdown()
+    await main.post_shutdown(application)
+    return {"lag": lag.samples, "metrics": main.metrics.render()}
+
+def report(args, tracker: LatencyTracker, telegram: FakeTelegram, gemini: FakeGemini, result: Dict) -> Dict:
+    latencies = tracker.latencies
+    elapsed = (tracker.last_reply or time.perf_counter()) - (tracker.first_sent or time.perf_counter())
+    lag = result["lag"]
+    summary = {
+        "sent": tracker.sent,
+        "replied": len(latencies),
+        "unanswered": tracker.outstanding(),
+        "throughput_per_s": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {f"p{p}": round(percentile(latencies, p) * 1000, 1) for p in (50, 95, 99)},
+        "latency_max_ms": round(max(latencies, default=0.0) * 1000, 1),
+        "loop_lag_ms": {f"p{p}": round(percentile(lag, p) * 1000, 2) for p in (50, 99)},
+        "loop_lag_max_ms": round(max(lag, default=0.0) * 1000, 2),
+        "gemini_calls": dict(gemini.counts),
+        "telegram_calls": dict(telegram.calls)
+    }
+
+    print(f"sent {summary['sent']} messages to {args.chats} chats at {args.rate}/s for {args.duration}s")
+    print(f"replied {summary['replied']}, unanswered {summary['unanswered']}, "
+          f"throughput {summary['throughput_per_s']}/s")
+    print("reply latency ms: " + ", ".join(f"{k}={v}" for k, v in summary["latency_ms"].items())
+          + f", max={summary['latency_max_ms']}")
+    print("event loop lag ms: " + ", ".join(f"{k}={v}" for k, v in summary["loop_lag_ms"].items())
+          + f", max={summary['loop_lag_max_ms']}")
+    print(f"gemini calls: {summary['gemini_calls']}")
+    print(f"telegram calls: {summary['telegram_calls']}")
+    return summary
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the bot against local fake Telegram and Gemini servers")
+    parser.add_argument('--chats', type=int, default=100, help="number of simulated private chats")
+    parser.add_argument('--rate', type=float, default=20.0, help="target messages per second (Poisson arrivals)")
+    parser.add_argument('--duration', type=float, default=20.0, help="seconds to keep sending")
+    parser.add_argument('--drain-timeout', type=float, default=30.0, help="seconds to wait for outstanding replies")
+    parser.add_argument('--repeat-ratio', type=float, default=0.2, help="share of short repeated greetings")
+    parser.add_argument('--stream', action='store_true', help="enable STREAM_REPLIES")
+    parser.add_argument('--keys', type=int, default=3, help="number of fake Gemini keys")
+    parser.add_argument('--gemini-latency', type=float, default=0.5)
+    parser.add_argument('--gemini-jitter', type=float, default=0.1)
+    parser.add_argument('--gemini-429-rate', type=float, default=0.0)
+    parser.add_argument('--gemini-slow-rate', type=float, default=0.0, help="share of responses that take --gemini-slow-latency")
+    parser.add_argument('--gemini-slow-latency', type=float, default=10.0)
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds on fake 429s")
+    parser.add_argument('--response-chars', type=int, default=300)
+    parser.add_argument('--stream-chunks', type=int, default=5)
+    parser.add_argument('--telegram-latency', type=float, default=0.03)
+    parser.add_argument('--record', metavar='FILE', help="forward Gemini calls to the real API and save responses")
+    parser.add_argument('--replay', metavar='FILE', help="serve Gemini responses saved with --record")
+    parser.add_argument('--api-key', action='append', default=[], help="real Gemini key, for --record")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help="extra config.txt setting")
+    parser.add_argument('--json', metavar='FILE', help="also write the summary as JSON")
+    parser.add_argument('--metrics', action='store_true', help="print the bot's /metrics output at the end")
+    args = parser.parse_args(argv)
+    if args.record and not args.api_key:
+        parser.error("--record needs at least one --api-key")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.record = os.path.abspath(args.record) if args.record else None
+    args.replay = os.path.abspath(args.replay) if args.replay else None
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    # One log line per fake HTTP call would dominate the run
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    tracker = LatencyTracker()
+    telegram = FakeTelegram(tracker, args.telegram_latency)
+    gemini = FakeGemini(args)
+    servers = [FakeServer(telegram), FakeServer(gemini)]
+    for server in servers:
+        server.start()
+
+    workdir = tempfile.mkdtemp(prefix="hinata-loadtest-")
+    os.chdir(workdir)
+    write_config(args, servers[0].port, servers[1].port)
+    sys.path.insert(0, REPO_ROOT)
+
+    try:
+        result = asyncio.run(drive(args, tracker))
+    finally:
+        for server in servers:
+            server.stop()
+
+    summary = report(args, tracker, telegram, gemini, result)
+    if args.metrics:
+        print(result["metrics"])
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Memory benchmark for per-chat conversation history.
+
+Fills history for many chats the way the bot does (one append per message,
+capped at HISTORY_LIMIT) in two forms: the original list of
+{role, message, timestamp} dicts with ISO timestamps, and the ChatHistory ring
+buffer. Prints the bytes each chat costs in memory besides its message text,
+measured with tracemalloc, and the on-disk size of each encoding.
+
+Usage:
+    python benchmarks/membench.py [--chats 20000] [--messages 15]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+from loadtest import REPO_ROOT, parse_args as loadtest_args, write_config
+
+def build_dicts(texts, history_limit: int) -> dict:
+    history = {}
+    for key, role, text in texts:
+        entry = {"role": role, "message": text, "timestamp": datetime.now().isoformat()}
+        history[key] = history.get(key, [])[-(history_limit - 1):] + [entry]
+    return history
+
+def build_rings(texts, chat_history) -> dict:
+    history = {}
+    for key, role, text in texts:
+        ring = history.get(key)
+        if ring is None:
+            ring = history[key] = chat_history()
+        ring.append(role, text)
+    return history
+
+def measure(build) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare per-chat history memory before and after ChatHistory")
+    parser.add_argument('--chats', type=int, default=20000)
+    parser.add_argument('--messages', type=int, default=15, help="messages appended per chat")
+    args = parser.parse_args(argv)
+
+    # main reads config.txt from the working directory on import
+    os.chdir(tempfile.mkdtemp(prefix="hinata-membench-"))
+    write_config(loadtest_args([]), 0, 0)
+    sys.path.insert(0, REPO_ROOT)
+    import main as bot
+
+    # Message text is created up front so only the per-entry overhead is traced
+    texts = [
+        (str(chat_id), "user" if i % 2 == 0 else "model", f"message {i} in chat {chat_id}, kya haal hai?")
+        for chat_id in range(args.chats) for i in range(args.messages)
+    ]
+
+    dicts, dict_bytes = measure(lambda: build_dicts(texts, bot.HISTORY_LIMIT))
+    rings, ring_bytes = measure(lambda: build_rings(texts, bot.ChatHistory))
+
+    print(f"{'in memory':>16}: {dict_bytes / args.chats:8.0f} -> {ring_bytes / args.chats:6.0f} bytes/chat "
+          f"({dict_bytes / ring_bytes:.1f}x smaller, excluding message text)")
+
+    legacy_json = len(json.dumps(dicts, separators=(',', ':')))
+    compact_json = len(json.dumps({key: ring.to_rows() for key, ring in rings.items()}, separators=(',', ':')))
+    blobs = sum(len(key) + len(ring.to_bytes()) for key, ring in rings.items())
+    print(f"{'json on disk':>16}: {legacy_json / args.chats:8.0f} -> {compact_json / args.chats:6.0f} bytes/chat")
+    print(f"{'sqlite blobs':>16}: {blobs / args.chats:8.0f} bytes/chat before page overhead")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
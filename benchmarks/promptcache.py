@@ -0,0 +1,76 @@
+"""Repeatable check of the Gemini cachedContents prompt-cache path.
+
+Runs the bot's GeminiAPI against the fake Gemini server from loadtest.py with
+GEMINI_CACHED_PROMPT on and checks that the system prompt is cached once per
+model and key, that later requests reference the cache instead of resending
+the prompt, and that a cache the server no longer knows is dropped and
+recreated. Exits non-zero on the first failed check.
+
+Usage:
+    python benchmarks/promptcache.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from loadtest import REPO_ROOT, FakeGemini, FakeServer, parse_args as loadtest_args, write_config
+
+def check(condition: bool, message: str):
+    print(f"{'ok' if condition else 'FAILED'}: {message}")
+    if not condition:
+        raise SystemExit(1)
+
+async def wait_for_cache(bot, deadline: float = 5.0):
+    until = time.monotonic() + deadline
+    while time.monotonic() < until:
+        if any(entry["name"] for entry in bot.gemini.prompt_caches.values()):
+            return
+        await asyncio.sleep(0.01)
+
+async def run(bot, fake: FakeGemini):
+    payload = bot.build_payload(1, "hello")
+    model = bot.gemini.router.preferred()
+
+    await bot.gemini.call_api(payload, model)
+    check(fake.counts["cachedContent"] == 0, "the first request sends the system prompt itself")
+    await wait_for_cache(bot)
+    check(fake.counts["cachedContents"] == 1, "the system prompt is cached once")
+
+    for _ in range(3):
+        await bot.gemini.call_api(payload, model)
+    check(fake.counts["cachedContent"] == 3, "later requests reference the cached prompt")
+    check(fake.counts["cachedContents"] == 1, "the cache is reused rather than recreated")
+
+    (name,) = [entry["name"] for entry in bot.gemini.prompt_caches.values()]
+    fake.expired_caches.add(name)
+    await bot.gemini.call_api(payload, model)
+    check(not any(entry["name"] == name for entry in bot.gemini.prompt_caches.values()),
+          "a cache the server rejects is dropped")
+    await wait_for_cache(bot)
+    check(fake.counts["cachedContents"] == 2, "a replacement cache is created")
+
+    await bot.gemini.call_api(payload, model)
+    (renewed,) = [entry["name"] for entry in bot.gemini.prompt_caches.values()]
+    check(renewed != name, "requests move on to the replacement cache")
+    await bot.gemini.close()
+
+def main(argv=None) -> int:
+    args = loadtest_args(["--keys", "1", "--gemini-latency", "0", "--gemini-jitter", "0",
+                          "--set", "GEMINI_CACHED_PROMPT=true"] + (argv or []))
+    fake = FakeGemini(args)
+    server = FakeServer(fake)
+    server.start()
+    try:
+        os.chdir(tempfile.mkdtemp(prefix="hinata-promptcache-"))
+        write_config(args, 0, server.port)
+        sys.path.insert(0, REPO_ROOT)
+        import main as bot
+        asyncio.run(run(bot, fake))
+    finally:
+        server.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,31 @@
+"""PNG rendering for /qr and /color.
+
+These functions run in ImageRenderer's worker processes, which import only
+this module, so it must stay free of bot imports and import-time side effects.
+"""
+import io
+
+def render_qr_png(text: str, fill: str, back: str) -> bytes:
+    import qrcode
+    qr = qrcode.QRCode()
+    qr.add_data(text)
+    qr.make(fit=True)
+    
+    img = qr.make_image(fill_color=fill, back_color=back)
+    bio = io.BytesIO()
+    img.save(bio, "PNG")
+    return bio.getvalue()
+
+def render_color_png(hex_color: str, size: int) -> bytes:
+    from PIL import Image, ImageDraw
+    img = Image.new('RGB', (size, size), color=f"#{hex_color}")
+    draw = ImageDraw.Draw(img)
+    draw.text((10, 10), f"#{hex_color}", fill="black")
+    
+    bio = io.BytesIO()
+    img.save(bio, "PNG")
+    return bio.getvalue()
+
+def start_worker(started):
+    """Pool initializer: wait until every worker has started (see ImageRenderer.get_pool)"""
+    started.wait(timeout=30)
@@ -1,12 +1,29 @@
+import time
+# Taken before any other import so the startup profile covers them
+STARTUP_BEGAN = time.perf_counter()
 import os
-from flask import Flask
+import asyncio
+import bisect
+import collections
+import contextlib
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
 import threading
 import json
+import shutil
+import sqlite3
+import struct
+import tempfile
 import logging
+import math
 import random
-import time
-import qrcode
+import uuid
 import io
+import sys
+from array import array
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -14,11 +31,16 @@ from telegram.ext import (
     MessageHandler,
     filters,
     ContextTypes,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    BaseRateLimiter,
+    BaseUpdateProcessor
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 import httpx
-from datetime import datetime
-from typing import List, Dict, Optional
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Iterator, List, Dict, NamedTuple, Optional
+import imaging
 
 # Set up logging
 logging.basicConfig(
@@ -27,6 +49,28 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class StartupProfile:
+    """Wall-clock time spent in each phase of startup, logged once the bot is ready"""
+    def __init__(self, began: float):
+        self.began = began
+        self.last = began
+        self.phases: List[tuple] = []
+        self.ready: Optional[float] = None
+    
+    def mark(self, phase: str):
+        """Close the phase that has been running since the previous mark"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+    
+    def finish(self):
+        self.ready = time.perf_counter() - self.began
+        timings = ", ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in self.phases)
+        logger.info(f"Startup took {self.ready * 1000:.0f}ms: {timings}")
+
+startup_profile = StartupProfile(STARTUP_BEGAN)
+startup_profile.mark("imports")
+
 # Bot Configuration
 class BotConfig:
     def __init__(self):
@@ -38,7 +82,17 @@ class BotConfig:
         self.bot_username = self.config.get('BOT_USERNAME', '@thehintaprobot')
         self.owner_id = 7269251740  # Your user ID
         self.maintenance_mode = False
+        self.stream_replies = self.get_bool('STREAM_REPLIES')
+        self.stream_edit_interval = float(self.config.get('STREAM_EDIT_INTERVAL', 1.0))
+        # Telegram allows about 20 messages per minute in a group
+        self.stream_group_edit_interval = float(self.config.get('STREAM_GROUP_EDIT_INTERVAL', 3.0))
         
+    def get_bool(self, key: str, default: bool = False) -> bool:
+        value = self.config.get(key)
+        if value is None:
+            return default
+        return value.lower() in ('1', 'true', 'yes', 'on', 'enable')
+    
     def load_config(self):
         config = {}
         try:
@@ -63,38 +117,757 @@ class BotConfig:
 
 # Initialize config
 config = BotConfig()
+startup_profile.mark("config")
 
-# Banned users storage
-BANNED_USERS_FILE = "banned_users.json"
+def atomic_write_json(path, data, **kwargs):
+    """Write JSON to a temp file and rename it over the target"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, tokens: float = 1.0) -> float:
+        """Seconds until `tokens` can be taken"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < tokens:
+            wait = max(wait, (tokens - self.tokens) / self.rate)
+        return wait
+    
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        if self.delay(tokens) > 0:
+            return False
+        self.tokens -= tokens
+        return True
+    
+    async def acquire(self, tokens: float = 1.0):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
+    
+    def pause(self, seconds: float):
+        """Hand out nothing for the next `seconds`, e.g. after a flood-control error"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+class TTLCache:
+    """Bounded LRU mapping whose entries expire after `ttl` seconds"""
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        
+        expires, value = item
+        if expires is not None and expires < time.monotonic():
+            del self.data[key]
+            self.misses += 1
+            return default
+        
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self.data[key] = (expires, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+    
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return default if item is None else item[1]
+    
+    def clear(self):
+        self.data.clear()
+    
+    def __len__(self):
+        return len(self.data)
+
+# Metrics
+class Counter:
+    """Monotonic counter in Prometheus text format"""
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[tuple, float] = collections.defaultdict(float)
+    
+    def inc(self, *label_values, amount: float = 1.0):
+        self.values[label_values] += amount
+    
+    def format_labels(self, label_values: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, label_values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+    
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self.format_labels(k)} {v}" for k, v in list(self.values.items())]
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+    kind = "gauge"
+    
+    def dec(self, *label_values, amount: float = 1.0):
+        self.values[label_values] -= amount
+    
+    def set(self, *label_values, value: float):
+        self.values[label_values] = value
 
-def load_banned_users():
+class Histogram(Counter):
+    """Cumulative bucket histogram of observed values"""
+    kind = "histogram"
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    
+    def observe(self, *label_values, value: float):
+        series = self.values.get(label_values)
+        if series is None:
+            # Per-bucket counts, then sum and count
+            series = self.values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+    
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*label_values, value=time.perf_counter() - started)
+    
+    def samples(self) -> List[str]:
+        lines = []
+        for label_values, series in list(self.values.items()):
+            series = list(series)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{self.format_labels(label_values, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self.format_labels(label_values, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{self.format_labels(label_values)} {series[-2]}")
+            lines.append(f"{self.name}_count{self.format_labels(label_values)} {series[-1]}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+    
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.register(Histogram("bot_handler_seconds", "Handler latency by command", ("handler",)))
+UPDATES_IN_FLIGHT = metrics.register(Gauge("bot_updates_in_flight", "Updates currently being handled"))
+GEMINI_LATENCY = metrics.register(Histogram("gemini_request_seconds", "Gemini request latency", ("key", "model")))
+GEMINI_RESPONSES = metrics.register(Counter("gemini_responses_total", "Gemini responses by status code", ("key", "model", "status")))
+GEMINI_HEDGES = metrics.register(Counter("gemini_hedges_total", "Hedged Gemini requests by outcome", ("outcome",)))
+GEMINI_RETRIES = metrics.register(Counter("gemini_retries_total", "Gemini attempts after the first", ("key", "model")))
+STORAGE_LATENCY = metrics.register(Histogram("history_operation_seconds", "Conversation history operation latency", ("operation",)))
+TELEGRAM_SEND_ERRORS = metrics.register(Counter("telegram_send_errors_total", "Failed Telegram API calls by error type", ("error",)))
+ADMISSION_REJECTED = metrics.register(Counter("admission_rejected_total", "Messages dropped by rate limits", ("scope",)))
+TELEGRAM_SEND_WAIT = metrics.register(Histogram("telegram_send_wait_seconds", "Time Bot API calls wait for flood control", ("priority",)))
+TELEGRAM_FLOOD_WAITS = metrics.register(Counter("telegram_retry_after_total", "RetryAfter errors from Telegram by endpoint", ("endpoint",)))
+
+@contextlib.contextmanager
+def count_send_errors():
     try:
-        if os.path.exists(BANNED_USERS_FILE):
-            with open(BANNED_USERS_FILE, 'r') as f:
-                return json.load(f)
-        return []
+        yield
     except Exception as e:
-        logger.error(f"ᴇʀʀᴏʀ ʟᴏᴀᴅɪɴɢ ʙᴀɴɴᴇᴅ ᴜꜱᴇʀꜱ: {e}")
-        return []
+        TELEGRAM_SEND_ERRORS.inc(type(e).__name__)
+        raise
+
+# Sharding
+# Set by the dispatcher for each worker process as "index/count"
+SHARD = os.environ.get('HINATA_SHARD')
+SHARD_INDEX = int(SHARD.split('/')[0]) if SHARD else None
+SHARED_STATE_FILE = "shared_state.db"
+
+def shard_path(path: str, index: Optional[int] = None) -> str:
+    """File name for state owned by a shard's chats, this shard's by default; unchanged outside sharded mode"""
+    index = SHARD_INDEX if index is None else index
+    if index is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
 
-def save_banned_users(banned_users):
+class SharedState:
+    """State every shard must agree on, in one SQLite database in WAL mode.
+    
+    Holds bans, runtime settings changed by owner commands and key cooldowns
+    after a 429; the SubscriberRegistry keeps its chats table in the same
+    file. Workers write through on change and pull changes back every
+    SHARED_STATE_SYNC_INTERVAL seconds; triggers bump a version in the meta
+    table whenever bans change, so the ban list is only re-read after a change.
+    Outside sharded mode nothing is opened.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.enabled = SHARD is not None
+        self.sync_interval = float(config.config.get('SHARED_STATE_SYNC_INTERVAL', 1))
+        self.conn = None
+        self._lock = threading.Lock()
+        self._task = None
+        # Written by synchronous code paths and flushed by the sync loop
+        self.pending_cooldowns: Dict[int, float] = {}
+        # Version of the bans table as of the last sync
+        self.bans_version = None
+    
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS bans (user_id INTEGER PRIMARY KEY)")
+            conn.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS key_cooldowns (key_index INTEGER PRIMARY KEY, until REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('bans_version', 0)")
+            for event in ("INSERT", "DELETE"):
+                conn.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS bans_{event.lower()} AFTER {event} ON bans "
+                    "BEGIN UPDATE meta SET value = value + 1 WHERE name = 'bans_version'; END"
+                )
+            conn.commit()
+            self.conn = conn
+        return self.conn
+    
+    def execute(self, sql: str, params=(), many: bool = False) -> List[tuple]:
+        with self._lock:
+            conn = self.connect()
+            cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+            rows = cursor.fetchall()
+            conn.commit()
+            return rows
+    
+    async def call(self, sql: str, params=(), many: bool = False) -> List[tuple]:
+        return await asyncio.to_thread(self.execute, sql, params, many)
+    
+    def meta(self, name: str) -> Optional[int]:
+        rows = self.execute("SELECT value FROM meta WHERE name = ?", (name,))
+        return rows[0][0] if rows else None
+    
+    def set_meta(self, name: str, value: int):
+        self.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, value))
+    
+    def seed_bans(self, user_ids):
+        """Import the single-process ban list once, the first time sharded mode runs.
+        
+        Shards never rewrite banned_users.json, so after that the file is stale:
+        an empty bans table means everyone was unbanned, not that nothing was imported.
+        """
+        with self._lock:
+            conn = self.connect()
+            with conn:
+                if conn.execute("SELECT 1 FROM meta WHERE name = 'bans_seeded'").fetchone():
+                    return
+                conn.executemany("INSERT OR IGNORE INTO bans VALUES (?)", [(uid,) for uid in user_ids])
+                conn.execute("INSERT INTO meta VALUES ('bans_seeded', 1)")
+    
+    async def publish(self, name: str, value):
+        """Share a runtime setting changed by an owner command with the other shards"""
+        if self.enabled:
+            await self.call("INSERT OR REPLACE INTO settings VALUES (?, ?)", (name, json.dumps(value)))
+    
+    def share_cooldown(self, key_index: int, seconds: float):
+        if self.enabled:
+            until = time.time() + seconds
+            self.pending_cooldowns[key_index] = max(until, self.pending_cooldowns.get(key_index, 0.0))
+    
+    def _sync(self, cooldowns: Dict[int, float]) -> tuple:
+        """Push key cooldowns and read shared state back; bans are None when unchanged since the last sync"""
+        with self._lock:
+            conn = self.connect()
+            conn.executemany(
+                "INSERT INTO key_cooldowns VALUES (?, ?) "
+                "ON CONFLICT(key_index) DO UPDATE SET until = max(until, excluded.until)",
+                list(cooldowns.items())
+            )
+            conn.commit()
+            bans = None
+            version = conn.execute("SELECT value FROM meta WHERE name = 'bans_version'").fetchone()[0]
+            if version != self.bans_version:
+                bans = {row[0] for row in conn.execute("SELECT user_id FROM bans")}
+                self.bans_version = version
+            settings = {name: json.loads(value) for name, value in conn.execute("SELECT name, value FROM settings")}
+            key_cooldowns = dict(conn.execute("SELECT key_index, until FROM key_cooldowns"))
+        return bans, settings, key_cooldowns
+    
+    async def sync(self):
+        cooldowns, self.pending_cooldowns = self.pending_cooldowns, {}
+        bans, settings, key_cooldowns = await asyncio.to_thread(self._sync, cooldowns)
+        
+        if bans is not None:
+            banned_users.banned = bans
+        apply_shared_settings(settings)
+        now, monotonic_now = time.time(), time.monotonic()
+        for key in gemini.key_pool.keys:
+            until = key_cooldowns.get(key.index, 0.0)
+            if until > now:
+                key.cooldown_until = max(key.cooldown_until, monotonic_now + until - now)
+    
+    async def _sync_loop(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error(f"Error syncing shared state: {e}")
+            await asyncio.sleep(self.sync_interval)
+    
+    async def start(self):
+        if self.enabled and self._task is None:
+            await self.sync()
+            self._task = asyncio.create_task(self._sync_loop())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self.sync()
+        if self.conn is not None:
+            with self._lock:
+                self.conn.close()
+                self.conn = None
+
+shared_state = SharedState(SHARED_STATE_FILE)
+
+# Banned users storage
+BANNED_USERS_FILE = "banned_users.json"
+
+class BanIndex:
+    """Resident set of banned user IDs with write-through persistence"""
+    def __init__(self, path: str):
+        self.path = path
+        self.reload_interval = float(config.config.get('BAN_RELOAD_INTERVAL', 2))
+        self.banned = set()
+        self.mtime = None
+        self._last_check = 0.0
+        self._save_lock = asyncio.Lock()
+        self.reload()
+    
+    def reload(self):
+        """Re-read the file if it was changed outside the bot"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self.banned, self.mtime = set(), None
+            return
+        
+        if mtime == self.mtime:
+            return
+        
+        try:
+            with open(self.path, 'r') as f:
+                self.banned = set(json.load(f))
+            self.mtime = mtime
+        except Exception as e:
+            logger.error(f"ᴇʀʀᴏʀ ʟᴏᴀᴅɪɴɢ ʙᴀɴɴᴇᴅ ᴜꜱᴇʀꜱ: {e}")
+    
+    def is_banned(self, user_id: int) -> bool:
+        now = time.monotonic()
+        # Shards get bans from shared state instead of the file
+        if not shared_state.enabled and now - self._last_check >= self.reload_interval:
+            self._last_check = now
+            self.reload()
+        return user_id in self.banned
+    
+    def __len__(self):
+        return len(self.banned)
+    
+    async def add(self, user_id: int) -> bool:
+        if self.is_banned(user_id):
+            return False
+        self.banned.add(user_id)
+        if shared_state.enabled:
+            await shared_state.call("INSERT OR IGNORE INTO bans VALUES (?)", (user_id,))
+        else:
+            await self.save()
+        return True
+    
+    async def remove(self, user_id: int) -> bool:
+        if not self.is_banned(user_id):
+            return False
+        self.banned.discard(user_id)
+        if shared_state.enabled:
+            await shared_state.call("DELETE FROM bans WHERE user_id = ?", (user_id,))
+        else:
+            await self.save()
+        return True
+    
+    def _write(self, banned_ids: List[int]):
+        atomic_write_json(self.path, banned_ids)
+        self.mtime = os.stat(self.path).st_mtime_ns
+    
+    async def replace(self, user_ids: List[int]):
+        self.banned = set(user_ids)
+        if shared_state.enabled:
+            await shared_state.call("DELETE FROM bans")
+            await shared_state.call("INSERT OR IGNORE INTO bans VALUES (?)", [(uid,) for uid in user_ids], many=True)
+        else:
+            await self.save()
+    
+    async def save(self):
+        async with self._save_lock:
+            try:
+                await asyncio.to_thread(self._write, sorted(self.banned))
+            except Exception as e:
+                logger.error(f"ᴇʀʀᴏʀ ꜱᴀᴠɪɴɢ ʙᴀɴɴᴇᴅ ᴜꜱᴇʀꜱ: {e}")
+
+banned_users = BanIndex(BANNED_USERS_FILE)
+
+GEMINI_API_BASE = config.config.get('GEMINI_API_BASE', "https://generativelanguage.googleapis.com/v1beta")
+
+def parse_retry_after(response: httpx.Response) -> Optional[float]:
+    """Read the server's requested back-off from a 429 response"""
+    header = response.headers.get('retry-after')
+    if header:
+        try:
+            return float(header)
+        except ValueError:
+            pass
     try:
-        with open(BANNED_USERS_FILE, 'w') as f:
-            json.dump(banned_users, f, indent=2)
-    except Exception as e:
-        logger.error(f"ᴇʀʀᴏʀ ꜱᴀᴠɪɴɢ ʙᴀɴɴᴇᴅ ᴜꜱᴇʀꜱ: {e}")
+        for detail in response.json().get('error', {}).get('details', []):
+            delay = detail.get('retryDelay')
+            if delay:
+                return float(delay.rstrip('s'))
+    except Exception:
+        pass
+    return None
+
+class KeyState:
+    """Health and load of one API key"""
+    def __init__(self, index: int, key: str, weight: float, error_window: float):
+        self.index = index
+        self.key = key
+        self.weight = weight
+        self.error_window = error_window
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.rate_limit_streak = 0
+        self.outcomes = collections.deque()
+        self.last_used = 0.0
+    
+    def error_rate(self, now: float) -> float:
+        while self.outcomes and self.outcomes[0][0] < now - self.error_window:
+            self.outcomes.popleft()
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, ok in self.outcomes if not ok) / len(self.outcomes)
+    
+    def score(self, now: float) -> float:
+        # Lower is better: load, inflated by recent errors, divided by weight
+        return (self.in_flight + 1) * (1 + 4 * self.error_rate(now)) / self.weight
+
+class KeyPool:
+    """Least-loaded selection among healthy API keys with per-key cooldowns.
+    
+    acquire() and release() never await, so they are atomic with respect to
+    other coroutines on the event loop.
+    """
+    def __init__(self, keys: List[str], weights: List[float]):
+        self.error_window = float(config.config.get('GEMINI_KEY_ERROR_WINDOW', 60))
+        self.base_cooldown = float(config.config.get('GEMINI_KEY_COOLDOWN', 15))
+        self.max_cooldown = float(config.config.get('GEMINI_KEY_MAX_COOLDOWN', 300))
+        self.keys = [
+            KeyState(i, key, weights[i] if i < len(weights) else 1.0, self.error_window)
+            for i, key in enumerate(keys)
+        ]
+    
+    def acquire(self, exclude=()) -> KeyState:
+        now = time.monotonic()
+        candidates = [k for k in self.keys if k.index not in exclude] or self.keys
+        healthy = [k for k in candidates if k.cooldown_until <= now]
+        if healthy:
+            key = min(healthy, key=lambda k: (k.score(now), k.last_used))
+        else:
+            # Everything is cooling down; use whichever recovers first
+            key = min(candidates, key=lambda k: k.cooldown_until)
+        key.in_flight += 1
+        key.last_used = now
+        return key
+    
+    def release(self, key: KeyState, ok: bool, status: Optional[int] = None, retry_after: Optional[float] = None):
+        now = time.monotonic()
+        key.in_flight -= 1
+        key.outcomes.append((now, ok))
+        if status == 429:
+            key.rate_limit_streak += 1
+            cooldown = retry_after or min(self.max_cooldown, self.base_cooldown * 2 ** (key.rate_limit_streak - 1))
+            key.cooldown_until = max(key.cooldown_until, now + cooldown)
+            shared_state.share_cooldown(key.index, cooldown)
+            logger.info(f"ᴋᴇʏ {key.index} ᴄᴏᴏʟɪɴɢ ᴅᴏᴡɴ ꜰᴏʀ {cooldown:.0f}ꜱ")
+        elif ok:
+            key.rate_limit_streak = 0
+    
+    def cancel(self, key: KeyState):
+        """Return a lease whose request was abandoned, without recording an outcome"""
+        key.in_flight -= 1
+    
+    def cooldown_remaining(self) -> float:
+        """Seconds until some key is out of cooldown; 0 when one is healthy now"""
+        return max(0.0, min(k.cooldown_until for k in self.keys) - time.monotonic())
+    
+    def describe(self, key: KeyState) -> str:
+        now = time.monotonic()
+        cooldown = max(0.0, key.cooldown_until - now)
+        state = f"cooldown {cooldown:.0f}s" if cooldown else "healthy"
+        return f"{state}, {key.in_flight} in flight, {key.error_rate(now):.0%} errors"
+
+class ModelCircuit:
+    """Rolling latency and error rate of one model behind a circuit breaker"""
+    def __init__(self, name: str, window: int):
+        self.name = name
+        self.outcomes = collections.deque(maxlen=window)
+        self.state = "closed"
+        self.reopen_at = 0.0
+        self.open_streak = 0
+        self.probing = False
+    
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for ok, _ in self.outcomes if not ok) / len(self.outcomes)
+    
+    def latency(self) -> float:
+        latencies = sorted(latency for ok, latency in self.outcomes if ok)
+        return latencies[len(latencies) // 2] if latencies else 0.0
+
+class ModelRouter:
+    """Pick a model per request from model_priority, skipping models whose circuit is open.
+    
+    A model's circuit opens once its rolling error rate (server errors, network
+    failures and replies slower than GEMINI_MODEL_SLOW_SECONDS) crosses the
+    threshold. After a cooldown one probe request is let through (half-open);
+    success closes the circuit so traffic moves back up the priority list,
+    failure reopens it for twice as long. choose() tells the caller whether
+    its request is the probe, and only the probe's result or cancellation
+    (abandon) moves a half-open circuit; requests that started while the
+    circuit was closed and finish later are ignored. Like KeyPool, choose(),
+    record() and abandon() never await.
+    """
+    def __init__(self, models: List[str]):
+        self.models = models
+        window = int(config.config.get('GEMINI_MODEL_WINDOW', 20))
+        self.min_samples = int(config.config.get('GEMINI_MODEL_MIN_SAMPLES', 5))
+        self.error_threshold = float(config.config.get('GEMINI_MODEL_ERROR_THRESHOLD', 0.5))
+        self.slow_seconds = float(config.config.get('GEMINI_MODEL_SLOW_SECONDS', 30))
+        self.base_open = float(config.config.get('GEMINI_MODEL_OPEN_SECONDS', 30))
+        self.max_open = float(config.config.get('GEMINI_MODEL_MAX_OPEN_SECONDS', 600))
+        # Optional per-request routing: messages up to this length go to short_model
+        self.short_length = int(config.config.get('GEMINI_SHORT_MESSAGE_LENGTH', 0))
+        self.short_model = config.config.get('GEMINI_SHORT_MESSAGE_MODEL', models[0])
+        self.circuits = {model: ModelCircuit(model, window) for model in models}
+    
+    def route(self, message: str) -> Optional[str]:
+        """Preferred model for a user message, or None to follow model_priority"""
+        if self.short_length and len(message) <= self.short_length and self.short_model in self.circuits:
+            return self.short_model
+        return None
+    
+    def preferred(self) -> str:
+        """The model a request would get right now, without starting a probe"""
+        now = time.monotonic()
+        for model in self.models:
+            circuit = self.circuits[model]
+            if circuit.state == "closed" or (now >= circuit.reopen_at and not circuit.probing):
+                return model
+        return self.models[-1]
+    
+    def choose(self, preferred: Optional[str] = None) -> tuple:
+        """Returns (model, probe); probe is True for the one request testing a half-open model"""
+        now = time.monotonic()
+        order = self.models if preferred is None else [preferred] + [m for m in self.models if m != preferred]
+        for model in order:
+            circuit = self.circuits[model]
+            if circuit.state == "closed":
+                return model, False
+            if circuit.state == "open" and now >= circuit.reopen_at:
+                circuit.state = "half-open"
+            if circuit.state == "half-open" and not circuit.probing:
+                circuit.probing = True
+                logger.info(f"ᴘʀᴏʙɪɴɢ ᴍᴏᴅᴇʟ {model}")
+                return model, True
+        # Every circuit is open; the one that reopens first is the best bet
+        return min(order, key=lambda m: self.circuits[m].reopen_at), False
+    
+    def record(self, model: str, status: Optional[int], latency: float, probe: bool = False):
+        circuit = self.circuits.get(model)
+        if circuit is None:
+            return
+        ok = status is not None and status < 500 and latency < self.slow_seconds
+        
+        if circuit.state != "closed" and not probe:
+            # Started before the circuit opened, or sent while it was open; says nothing new
+            return
+        if probe:
+            if circuit.state != "half-open":
+                return
+            circuit.probing = False
+            if ok:
+                circuit.state = "closed"
+                circuit.open_streak = 0
+                circuit.outcomes.clear()
+                logger.info(f"ᴍᴏᴅᴇʟ {model} ʀᴇᴄᴏᴠᴇʀᴇᴅ")
+            else:
+                self._open(circuit)
+            return
+        
+        circuit.outcomes.append((ok, latency))
+        if len(circuit.outcomes) >= self.min_samples and circuit.error_rate() >= self.error_threshold:
+            self._open(circuit)
+    
+    def abandon(self, model: str, probe: bool = False):
+        """Forget a request cancelled before it finished; if it was the probe, the next request probes"""
+        circuit = self.circuits.get(model)
+        if probe and circuit is not None and circuit.state == "half-open":
+            circuit.probing = False
+    
+    def _open(self, circuit: ModelCircuit):
+        circuit.open_streak += 1
+        cooldown = min(self.max_open, self.base_open * 2 ** (circuit.open_streak - 1))
+        circuit.state = "open"
+        circuit.reopen_at = time.monotonic() + cooldown
+        circuit.outcomes.clear()
+        logger.warning(f"ᴍᴏᴅᴇʟ {circuit.name} ᴜɴʜᴇᴀʟᴛʜʏ, ᴄɪʀᴄᴜɪᴛ ᴏᴘᴇɴ ꜰᴏʀ {cooldown:.0f}ꜱ")
+    
+    def alternative(self, model: str) -> str:
+        """Another model with a closed circuit, for a hedge when there is only one key"""
+        for other in self.models:
+            if other != model and self.circuits[other].state == "closed":
+                return other
+        return model
+    
+    def describe(self, model: str) -> str:
+        circuit = self.circuits[model]
+        state = circuit.state
+        if state == "open":
+            state += f" {max(0.0, circuit.reopen_at - time.monotonic()):.0f}s"
+        return f"{state}, {circuit.error_rate():.0%} errors, p50 {circuit.latency():.1f}s"
+
+class Hedger:
+    """When to duplicate a slow Gemini request, and how many duplicates we can afford.
+    
+    A request that is still running after GEMINI_HEDGE_PERCENTILE of recent
+    successful latencies (never less than GEMINI_HEDGE_MIN_DELAY) gets a second
+    copy on another key. Each request earns GEMINI_HEDGE_BUDGET hedge tokens, so
+    hedges add at most that fraction of extra requests over time.
+    """
+    def __init__(self):
+        self.enabled = config.get_bool('GEMINI_HEDGE')
+        self.percentile = float(config.config.get('GEMINI_HEDGE_PERCENTILE', 95))
+        self.min_delay = float(config.config.get('GEMINI_HEDGE_MIN_DELAY', 1.0))
+        self.min_samples = int(config.config.get('GEMINI_HEDGE_MIN_SAMPLES', 20))
+        self.budget = float(config.config.get('GEMINI_HEDGE_BUDGET', 0.05))
+        self.burst = max(1.0, float(config.config.get('GEMINI_HEDGE_BURST', 5)))
+        self.latencies = collections.deque(maxlen=int(config.config.get('GEMINI_HEDGE_WINDOW', 200)))
+        self.tokens = 0.0
+        self.sent = 0
+        self.won = 0
+    
+    def observe(self, latency: float):
+        self.latencies.append(latency)
+    
+    def admit(self) -> Optional[float]:
+        """Count a request toward the budget; returns how long to wait before hedging it, or None"""
+        self.tokens = min(self.burst, self.tokens + self.budget)
+        if len(self.latencies) < self.min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+    
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.sent += 1
+        return True
+    
+    def record_win(self, hedge_won: bool):
+        if hedge_won:
+            self.won += 1
+        GEMINI_HEDGES.inc("won" if hedge_won else "lost")
+    
+    def describe(self) -> str:
+        if not self.enabled:
+            return "off"
+        return f"{self.sent} sent, {self.won} won"
 
 class GeminiAPI:
     def __init__(self):
         self.api_keys = self.parse_api_keys()
-        self.current_key_index = 0
+        weights = [float(w) for w in config.config.get('GEMINI_KEY_WEIGHTS', '').split(',') if w.strip()]
+        self.key_pool = KeyPool(self.api_keys, weights)
         self.model_priority = [
-            "gemini-2.5-flash-lite",
-            "gemini-2.5-flash"
+            model.strip()
+            for model in config.config.get('GEMINI_MODELS', 'gemini-2.5-flash-lite,gemini-2.5-flash').split(',')
+            if model.strip()
         ]
-        self.current_model_index = 0
+        self.router = ModelRouter(self.model_priority)
+        self.hedger = Hedger()
         self.key_usage = {key: 0 for key in self.api_keys}
         self.max_retries = 3
+        # Longest a request waits in total for a key to come out of a 429 cooldown
+        self.max_key_wait = float(config.config.get('GEMINI_MAX_KEY_WAIT', 10))
+        self.max_connections = int(config.config.get('GEMINI_MAX_CONNECTIONS', 20))
+        self.max_keepalive_connections = int(config.config.get('GEMINI_MAX_KEEPALIVE', 10))
+        self.keepalive_expiry = float(config.config.get('GEMINI_KEEPALIVE_EXPIRY', 60))
+        self.connect_timeout = float(config.config.get('GEMINI_CONNECT_TIMEOUT', 5))
+        self.read_timeout = float(config.config.get('GEMINI_READ_TIMEOUT', 60))
+        self.http2 = config.get_bool('GEMINI_HTTP2')
+        self.warmup_connections = int(config.config.get('GEMINI_WARMUP_CONNECTIONS', 2))
+        self.client: Optional[httpx.AsyncClient] = None
+        self.cache_prompt = config.get_bool('GEMINI_CACHED_PROMPT')
+        self.prompt_cache_ttl = int(config.config.get('GEMINI_CACHED_PROMPT_TTL', 3600))
+        # (model, key index) -> {"name", "text", "expires"}; a None name marks a failed attempt
+        self.prompt_caches: Dict[tuple, Dict] = {}
+        self._prompt_cache_tasks: Dict[tuple, asyncio.Task] = {}
         
     def parse_api_keys(self) -> List[str]:
         """Parse API keys from config"""
@@ -112,60 +885,266 @@ class GeminiAPI:
         
         return keys
     
-    def get_current_key(self) -> str:
-        return self.api_keys[self.current_key_index]
-    
     def get_current_model(self) -> str:
-        return self.model_priority[self.current_model_index]
+        return self.router.preferred()
+    
+    def get_api_url(self, key: str, model: str, method: str = "generateContent") -> str:
+        return f"{GEMINI_API_BASE}/models/{model}:{method}?key={key}"
+    
+    def get_client(self) -> httpx.AsyncClient:
+        """Return the shared pooled client, creating it on first use"""
+        if self.client is None or self.client.is_closed:
+            http2 = self.http2
+            if http2:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    logger.warning("ʜ2 ɴᴏᴛ ɪɴꜱᴛᴀʟʟᴇᴅ, ꜰᴀʟʟɪɴɢ ʙᴀᴄᴋ ᴛᴏ ʜᴛᴛᴘ/1.1")
+                    http2 = False
+            self.client = httpx.AsyncClient(
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                    keepalive_expiry=self.keepalive_expiry
+                ),
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                headers={"Content-Type": "application/json"}
+            )
+        return self.client
+    
+    async def warm_up(self):
+        """Open pooled connections before the first chat reply needs them"""
+        client = self.get_client()
+        url = f"{GEMINI_API_BASE}/models?pageSize=1&key={self.api_keys[0]}"
+        
+        async def probe():
+            try:
+                await client.get(url)
+            except Exception as e:
+                logger.warning(f"ɢᴇᴍɪɴɪ ᴡᴀʀᴍ-ᴜᴘ ꜰᴀɪʟᴇᴅ: {e}")
+        
+        # One connection carries every stream under HTTP/2
+        count = 1 if self.http2 else self.warmup_connections
+        await asyncio.gather(*(probe() for _ in range(count)))
     
-    def rotate_key(self):
-        self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-        logger.info(f"ʀᴏᴛᴀᴛᴇᴅ ᴛᴏ ᴀᴘɪ ᴋᴇʏ ɪɴᴅᴇx {self.current_key_index}")
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+    
+    def apply_prompt_cache(self, payload: Dict, key: KeyState, model: str) -> Dict:
+        """Swap the system instruction for a cachedContents reference when one is ready"""
+        instruction = payload.get("systemInstruction")
+        if not self.cache_prompt or instruction is None:
+            return payload
+        
+        cache_id = (model, key.index)
+        text = instruction["parts"][0]["text"]
+        entry = self.prompt_caches.get(cache_id)
+        if entry is not None and entry["text"] == text and entry["expires"] > time.time():
+            if entry["name"] is None:
+                return payload
+            payload = dict(payload)
+            del payload["systemInstruction"]
+            payload["cachedContent"] = entry["name"]
+            return payload
+        
+        task = self._prompt_cache_tasks.get(cache_id)
+        if task is None or task.done():
+            self._prompt_cache_tasks[cache_id] = asyncio.create_task(
+                self._create_prompt_cache(cache_id, key.key, instruction)
+            )
+        return payload
     
-    def downgrade_model(self):
-        if self.current_model_index < len(self.model_priority) - 1:
-            self.current_model_index += 1
-            logger.info(f"ᴅᴏᴡɴɢʀᴀᴅᴇᴅ ᴛᴏ ᴍᴏᴅᴇʟ: {self.get_current_model()}")
+    async def _create_prompt_cache(self, cache_id: tuple, key: str, instruction: Dict):
+        model = cache_id[0]
+        text = instruction["parts"][0]["text"]
+        try:
+            response = await self.get_client().post(
+                f"{GEMINI_API_BASE}/cachedContents?key={key}",
+                json={
+                    "model": f"models/{model}",
+                    "systemInstruction": instruction,
+                    "ttl": f"{self.prompt_cache_ttl}s"
+                }
+            )
+            response.raise_for_status()
+            name = response.json()["name"]
+            logger.info(f"ᴄᴀᴄʜᴇᴅ ᴘʀᴏᴍᴘᴛ ꜰᴏʀ {model} ᴏɴ ᴋᴇʏ {cache_id[1]}: {name}")
+        except Exception as e:
+            # Prompts below the model's minimum cacheable size are rejected; don't retry for a while
+            logger.warning(f"ᴘʀᴏᴍᴘᴛ ᴄᴀᴄʜɪɴɢ ᴜɴᴀᴠᴀɪʟᴀʙʟᴇ ꜰᴏʀ {model}: {e}")
+            name = None
+        self.prompt_caches[cache_id] = {
+            "name": name,
+            "text": text,
+            "expires": time.time() + self.prompt_cache_ttl - 60
+        }
     
-    def upgrade_model(self):
-        if self.current_model_index > 0:
-            self.current_model_index -= 1
-            logger.info(f"ᴜᴘɢʀᴀᴅᴇᴅ ᴛᴏ ᴍᴏᴅᴇʟ: {self.get_current_model()}")
+    def drop_prompt_cache(self, payload: Dict, key: KeyState, model: str):
+        if "cachedContent" in payload:
+            self.prompt_caches.pop((model, key.index), None)
     
-    def get_api_url(self) -> str:
-        return f"https://generativelanguage.googleapis.com/v1beta/models/{self.get_current_model()}:generateContent?key={self.get_current_key()}"
+    async def post(self, client: httpx.AsyncClient, payload: Dict, key: KeyState, model: str, probe: bool = False) -> Dict:
+        """One generateContent request on a leased key, which is released whatever happens"""
+        ok, status, retry_after = False, None, None
+        cancelled = False
+        request = self.apply_prompt_cache(payload, key, model)
+        started = time.perf_counter()
+        try:
+            response = await client.post(self.get_api_url(key.key, model), json=request)
+            status = response.status_code
+            
+            if status == 429:
+                logger.warning(f"ʀᴀᴛᴇ ʟɪᴍɪᴛᴇᴅ ᴏɴ ᴋᴇʏ {key.index}")
+                retry_after = parse_retry_after(response)
+            
+            response.raise_for_status()
+            ok = True
+            self.key_usage[key.key] += 1
+            return response.json()
+            
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception:
+            if status in (400, 403, 404):
+                self.drop_prompt_cache(request, key, model)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            if cancelled:
+                # A hedge that lost the race says nothing about the key or model
+                self.key_pool.cancel(key)
+                self.router.abandon(model, probe)
+            else:
+                self.key_pool.release(key, ok, status, retry_after)
+                self.router.record(model, status, elapsed, probe)
+                GEMINI_LATENCY.observe(str(key.index), model, value=elapsed)
+                GEMINI_RESPONSES.inc(str(key.index), model, str(status or "error"))
+                if ok:
+                    self.hedger.observe(elapsed)
     
-    async def call_api(self, payload: Dict) -> Dict:
-        """Make API call with automatic key rotation and model fallback"""
-        headers = {"Content-Type": "application/json"}
+    async def hedged_post(self, client: httpx.AsyncClient, payload: Dict, key: KeyState, model: str, probe: bool = False) -> Dict:
+        """Race a duplicate on another key (or model) once the request outlives the hedge delay"""
+        primary = asyncio.ensure_future(self.post(client, payload, key, model, probe))
+        tasks = [primary]
+        try:
+            delay = self.hedger.admit()
+            if delay is None:
+                return await primary
+            await asyncio.wait(tasks, timeout=delay)
+            if primary.done() or not self.hedger.try_spend():
+                return await primary
+            
+            hedge_key = self.key_pool.acquire(exclude={key.index})
+            hedge_model = model if hedge_key is not key else self.router.alternative(model)
+            hedge = asyncio.ensure_future(self.post(client, payload, hedge_key, hedge_model))
+            tasks.append(hedge)
+            GEMINI_HEDGES.inc("sent")
+            
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.hedger.record_win(task is hedge)
+                        return task.result()
+            # Both failed; report the original request's error
+            return primary.result()
+        finally:
+            losers = [task for task in tasks if not task.done()]
+            for task in losers:
+                task.cancel()
+            if losers:
+                await asyncio.gather(*losers, return_exceptions=True)
+    
+    async def wait_for_key(self, deadline: float, last_error: Optional[Exception]):
+        """Sleep until a key is out of cooldown, or fail fast if none will be before the deadline"""
+        wait = self.key_pool.cooldown_remaining()
+        if wait <= 0:
+            return
+        if time.monotonic() + wait > deadline:
+            raise last_error if last_error else Exception(f"ᴀʟʟ ᴀᴘɪ ᴋᴇʏꜱ ᴀʀᴇ ʀᴀᴛᴇ ʟɪᴍɪᴛᴇᴅ ꜰᴏʀ {wait:.0f}ꜱ")
+        await asyncio.sleep(wait)
+    
+    async def call_api(self, payload: Dict, model_hint: Optional[str] = None) -> Dict:
+        """Make API call, spreading attempts over healthy keys and models"""
+        client = self.get_client()
         last_error = None
+        deadline = time.monotonic() + self.max_key_wait
         
         for attempt in range(self.max_retries):
-            url = self.get_api_url()
+            await self.wait_for_key(deadline, last_error)
+            key = self.key_pool.acquire()
+            model, probe = self.router.choose(model_hint)
+            if attempt:
+                GEMINI_RETRIES.inc(str(key.index), model)
             try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(url, json=payload, headers=headers)
-                    
-                    if response.status_code == 429:
-                        logger.warning(f"ʀᴀᴛᴇ ʟɪᴍɪᴛᴇᴅ ᴏɴ ᴋᴇʏ {self.current_key_index}")
-                        self.rotate_key()
-                        continue
-                    
+                if self.hedger.enabled:
+                    return await self.hedged_post(client, payload, key, model, probe)
+                return await self.post(client, payload, key, model, probe)
+            except Exception as e:
+                last_error = e
+        
+        raise last_error if last_error else Exception("ᴍᴀx ʀᴇᴛʀɪᴇꜱ ʀᴇᴀᴄʜᴇᴅ")
+    
+    async def stream_api(self, payload: Dict, model_hint: Optional[str] = None):
+        """Stream response chunks over SSE, retrying only until the first chunk arrives"""
+        client = self.get_client()
+        last_error = None
+        deadline = time.monotonic() + self.max_key_wait
+        
+        for attempt in range(self.max_retries):
+            await self.wait_for_key(deadline, last_error)
+            key = self.key_pool.acquire()
+            ok, status, retry_after = False, None, None
+            started = cancelled = False
+            model, probe = self.router.choose(model_hint)
+            request = self.apply_prompt_cache(payload, key, model)
+            if attempt:
+                GEMINI_RETRIES.inc(str(key.index), model)
+            started_at = time.perf_counter()
+            try:
+                url = self.get_api_url(key.key, model, "streamGenerateContent") + "&alt=sse"
+                async with client.stream("POST", url, json=request) as response:
+                    status = response.status_code
+                    if response.is_error:
+                        await response.aread()
+                    if status == 429:
+                        logger.warning(f"ʀᴀᴛᴇ ʟɪᴍɪᴛᴇᴅ ᴏɴ ᴋᴇʏ {key.index}")
+                        retry_after = parse_retry_after(response)
                     response.raise_for_status()
-                    self.key_usage[self.get_current_key()] += 1
-                    return response.json()
+                    self.key_usage[key.key] += 1
                     
-            except httpx.HTTPStatusError as e:
-                last_error = e
-                if e.response.status_code == 429:
-                    if self.get_current_model() != "gemini-2.5-flash-lite":
-                        self.downgrade_model()
-                    else:
-                        self.rotate_key()
-                continue
+                    async for line in response.aiter_lines():
+                        if line.startswith("data:"):
+                            started = True
+                            yield json.loads(line[5:])
+                    ok = True
+                    return
+                    
+            except (asyncio.CancelledError, GeneratorExit):
+                cancelled = status is None
+                raise
             except Exception as e:
+                if started:
+                    raise
                 last_error = e
+                if status in (400, 403, 404):
+                    self.drop_prompt_cache(request, key, model)
                 continue
+            finally:
+                if cancelled:
+                    # Abandoned before Gemini answered, which says nothing about the key or model
+                    self.key_pool.cancel(key)
+                    self.router.abandon(model, probe)
+                else:
+                    self.key_pool.release(key, ok, status, retry_after)
+                    self.router.record(model, status, time.perf_counter() - started_at, probe)
+                    GEMINI_LATENCY.observe(str(key.index), model, value=time.perf_counter() - started_at)
+                    GEMINI_RESPONSES.inc(str(key.index), model, str(status or "error"))
         
         raise last_error if last_error else Exception("ᴍᴀx ʀᴇᴛʀɪᴇꜱ ʀᴇᴀᴄʜᴇᴅ")
 
@@ -174,89 +1153,1110 @@ gemini = GeminiAPI()
 
 # Conversation history storage
 CONVERSATION_HISTORY_FILE = "conversation_history.json"
+HISTORY_DB_FILE = "conversation_history.db"
+HISTORY_LIMIT = 10
 
-def load_conversation_history():
-    try:
-        if os.path.exists(CONVERSATION_HISTORY_FILE):
-            with open(CONVERSATION_HISTORY_FILE, 'r') as f:
-                return json.load(f)
-        return {}
-    except Exception as e:
-        logger.error(f"ᴇʀʀᴏʀ ʟᴏᴀᴅɪɴɢ ᴄᴏɴᴠᴇʀꜱᴀᴛɪᴏɴ ʜɪ�ᴛᴏʀʏ: {e}")
-        return {}
+# Roles are stored as their index in this tuple
+HISTORY_ROLES = ("user", "model")
+HISTORY_ROLE_CODES = {role: code for code, role in enumerate(HISTORY_ROLES)}
+# Binary entry layout: role code, epoch timestamp, UTF-8 length, then the text
+HISTORY_ENTRY_HEADER = struct.Struct("<BdI")
 
-def save_conversation_history(history):
-    try:
-        with open(CONVERSATION_HISTORY_FILE, 'w') as f:
-            json.dump(history, f, indent=2)
-    except Exception as e:
-        logger.error(f"ᴇʀʀᴏʀ ꜱᴀᴠɪɴɢ ᴄᴏɴᴠᴇʀꜱᴀᴛɪᴏɴ ʜɪꜱᴛᴏʀʏ: {e}")
+class HistoryEntry(NamedTuple):
+    role: str
+    message: str
+    timestamp: float
+
+class ChatHistory:
+    """Ring buffer of one chat's last HISTORY_LIMIT messages.
+    
+    Roles are one byte each and timestamps are epoch seconds in a float array,
+    so a chat costs a few hundred bytes besides its text rather than a dict
+    and an ISO string per message. Readers get HistoryEntry tuples.
+    """
+    __slots__ = ("messages", "roles", "times", "head")
+    
+    def __init__(self):
+        self.messages: List[str] = []
+        self.roles = bytearray()
+        self.times = array('d')
+        # Slot of the oldest entry once the ring is full
+        self.head = 0
+    
+    def __len__(self):
+        return len(self.messages)
+    
+    def push(self, code: int, message: str, timestamp: float):
+        if len(self.messages) < HISTORY_LIMIT:
+            self.messages.append(message)
+            self.roles.append(code)
+            self.times.append(timestamp)
+        else:
+            self.messages[self.head] = message
+            self.roles[self.head] = code
+            self.times[self.head] = timestamp
+            self.head = (self.head + 1) % HISTORY_LIMIT
+    
+    def append(self, role: str, message: str, timestamp: Optional[float] = None):
+        self.push(HISTORY_ROLE_CODES[role], message, time.time() if timestamp is None else timestamp)
+    
+    def last_active(self) -> float:
+        """Timestamp of the newest message, 0 for an empty chat"""
+        # Once the ring is full the newest entry sits just before head; until then head is 0
+        return self.times[self.head - 1] if self.messages else 0.0
+
+    def order(self) -> List[int]:
+        size = len(self.messages)
+        return [(self.head + i) % size for i in range(size)]
+    
+    def entries(self) -> List[HistoryEntry]:
+        return [HistoryEntry(HISTORY_ROLES[self.roles[i]], self.messages[i], self.times[i]) for i in self.order()]
+    
+    def copy(self) -> 'ChatHistory':
+        clone = ChatHistory()
+        clone.messages = self.messages[:]
+        clone.roles = self.roles[:]
+        clone.times = self.times[:]
+        clone.head = self.head
+        return clone
+    
+    def to_rows(self) -> List[list]:
+        """Compact JSON form: [role code, timestamp, message] per entry, oldest first"""
+        return [[self.roles[i], self.times[i], self.messages[i]] for i in self.order()]
+    
+    def to_dicts(self) -> List[Dict]:
+        """The original {role, message, timestamp} form, as used in backups"""
+        return [
+            {"role": e.role, "message": e.message, "timestamp": datetime.fromtimestamp(e.timestamp).isoformat()}
+            for e in self.entries()
+        ]
+    
+    @classmethod
+    def from_rows(cls, rows: List) -> 'ChatHistory':
+        """Build from compact rows or from {role, message, timestamp} dicts; keeps the newest HISTORY_LIMIT"""
+        history = cls()
+        for row in rows[-HISTORY_LIMIT:]:
+            if isinstance(row, dict):
+                history.append(row["role"], row["message"], datetime.fromisoformat(row["timestamp"]).timestamp())
+            else:
+                code, timestamp, message = row
+                history.push(code, message, timestamp)
+        return history
+    
+    def to_bytes(self) -> bytes:
+        blob = bytearray()
+        for i in self.order():
+            text = self.messages[i].encode()
+            blob += HISTORY_ENTRY_HEADER.pack(self.roles[i], self.times[i], len(text))
+            blob += text
+        return bytes(blob)
+    
+    @classmethod
+    def from_bytes(cls, blob: bytes) -> 'ChatHistory':
+        history = cls()
+        offset = 0
+        while offset < len(blob):
+            code, timestamp, size = HISTORY_ENTRY_HEADER.unpack_from(blob, offset)
+            offset += HISTORY_ENTRY_HEADER.size
+            history.push(code, blob[offset:offset + size].decode(), timestamp)
+            offset += size
+        return history
+
+class HistoryBackend:
+    """Persistent storage for per-chat conversation history.
+    
+    Chats are handed over as ChatHistory snapshots that the store no longer
+    mutates, so backends may encode them on a worker thread.
+    """
+    file_suffix = ""
+    
+    def open(self):
+        """Prepare for reads; called once on a worker thread before the first load_chat"""
+        pass
+    
+    def load_chat(self, chat_id: str) -> Optional[ChatHistory]:
+        raise NotImplementedError
+    
+    def iter_chats(self) -> Iterator[tuple]:
+        """Yield (chat_id, ChatHistory) for every stored chat"""
+        raise NotImplementedError
+    
+    def write_chats(self, chats: Dict[str, Optional[ChatHistory]]):
+        """Persist the given chats; a value of None deletes the chat"""
+        raise NotImplementedError
+    
+    def expire(self, cutoff: float) -> List[str]:
+        """Delete chats whose newest message is older than cutoff; returns their IDs"""
+        raise NotImplementedError
+    
+    def chat_ids(self) -> List[str]:
+        raise NotImplementedError
+    
+    def count(self) -> int:
+        raise NotImplementedError
+    
+    def snapshot(self, path: str):
+        """Write a consistent copy of the whole store to path"""
+        raise NotImplementedError
+    
+    def close(self):
+        pass
+
+class JsonHistoryBackend(HistoryBackend):
+    """Single-file JSON storage, rewritten in full on every write.
+    
+    Chats are written as compact [role code, timestamp, message] rows; files in
+    the older {role, message, timestamp} form still load. The whole file stays
+    in memory, so large deployments should use the SQLite backend.
+    """
+    file_suffix = ".json"
+    
+    def __init__(self, path: str):
+        self.path = path
+        # chat_id -> compact rows, sharing message strings with the store
+        self.history: Dict[str, List[list]] = {}
+        self._lock = threading.Lock()
+    
+    def load_file(self) -> Dict[str, List]:
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    return json.load(f)
+            return {}
+        except Exception as e:
+            logger.error(f"ᴇʀʀᴏʀ ʟᴏᴀᴅɪɴɢ ᴄᴏɴᴠᴇʀꜱᴀᴛɪᴏɴ ʜɪꜱᴛᴏʀʏ: {e}")
+            return {}
+    
+    def open(self):
+        with self._lock:
+            self.history = {
+                chat_id: ChatHistory.from_rows(rows).to_rows() for chat_id, rows in self.load_file().items()
+            }
+    
+    def load_chat(self, chat_id: str) -> Optional[ChatHistory]:
+        rows = self.history.get(chat_id)
+        return ChatHistory.from_rows(rows) if rows is not None else None
+    
+    def iter_chats(self) -> Iterator[tuple]:
+        for chat_id, rows in list(self.history.items()):
+            yield chat_id, ChatHistory.from_rows(rows)
+    
+    def write_chats(self, chats: Dict[str, Optional[ChatHistory]]):
+        with self._lock:
+            for chat_id, history in chats.items():
+                if history is None:
+                    self.history.pop(chat_id, None)
+                else:
+                    self.history[chat_id] = history.to_rows()
+            atomic_write_json(self.path, self.history, separators=(',', ':'))
+    
+    def expire(self, cutoff: float) -> List[str]:
+        with self._lock:
+            expired = [chat_id for chat_id, rows in self.history.items() if not rows or rows[-1][1] < cutoff]
+            for chat_id in expired:
+                del self.history[chat_id]
+            if expired:
+                atomic_write_json(self.path, self.history, separators=(',', ':'))
+            return expired
+    
+    def chat_ids(self) -> List[str]:
+        return list(self.history.keys())
+    
+    def count(self) -> int:
+        return len(self.history)
+    
+    def snapshot(self, path: str):
+        with self._lock:
+            atomic_write_json(path, self.history, separators=(',', ':'))
+
+class SqliteHistoryBackend(HistoryBackend):
+    """SQLite storage in WAL mode with one row per chat holding its ChatHistory.to_bytes() blob.
+    
+    Only the chats asked for are read into memory. Given import_from, open()
+    imports that JSON history file once, so a bot that used the JSON backend
+    keeps its chats when it moves over.
+    """
+    file_suffix = ".db"
+    
+    def __init__(self, path: str, import_from: Optional[str] = None):
+        self.path = path
+        self.import_from = import_from
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chats ("
+            "chat_id TEXT PRIMARY KEY, entries BLOB NOT NULL, updated REAL NOT NULL DEFAULT 0) WITHOUT ROWID"
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(chats)")]
+        if "updated" not in columns:
+            # Tables from before expiry existed count as active now
+            self.conn.execute("ALTER TABLE chats ADD COLUMN updated REAL NOT NULL DEFAULT 0")
+            self.conn.execute("UPDATE chats SET updated = ?", (time.time(),))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chats_updated ON chats (updated)")
+        # JSON history files whose chats were already imported
+        self.conn.execute("CREATE TABLE IF NOT EXISTS imported (source TEXT PRIMARY KEY)")
+        self.conn.commit()
+        self.migrate_messages()
+    
+    def open(self):
+        if self.import_from and os.path.exists(self.import_from):
+            with self._lock:
+                done = self.conn.execute("SELECT 1 FROM imported WHERE source = ?", (self.import_from,)).fetchone()
+            if not done:
+                count = self.import_json(self.import_from)
+                logger.info(f"Imported {count} chats from {self.import_from} into {self.path}")
+    
+    def import_json(self, source: str, batch_size: int = 500) -> int:
+        """Copy every chat of a JSON history file in, replacing stored copies; returns the number of chats"""
+        with open(source, 'r') as f:
+            history = json.load(f)
+        
+        batch = {}
+        for chat_id, entries in history.items():
+            batch[str(chat_id)] = ChatHistory.from_rows(entries)
+            if len(batch) >= batch_size:
+                self.write_chats(batch)
+                batch = {}
+        if batch:
+            self.write_chats(batch)
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO imported VALUES (?)", (source,))
+        return len(history)
+    
+    def migrate_messages(self):
+        """Fold the older one-row-per-message table into chats, then drop it"""
+        if not self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages'").fetchone():
+            return
+        chats = {}
+        for chat_id, role, message, timestamp in self.conn.execute(
+            "SELECT chat_id, role, message, timestamp FROM messages ORDER BY chat_id, seq"
+        ):
+            chats.setdefault(chat_id, []).append({"role": role, "message": message, "timestamp": timestamp})
+        with self.conn:
+            self.write_rows((chat_id, ChatHistory.from_rows(entries)) for chat_id, entries in chats.items())
+            self.conn.execute("DROP TABLE messages")
+        logger.info(f"Migrated {len(chats)} chats to the compact history table")
+    
+    def write_rows(self, chats):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO chats (chat_id, entries, updated) VALUES (?, ?, ?)",
+            [(chat_id, history.to_bytes(), history.last_active()) for chat_id, history in chats]
+        )
+    
+    def load_chat(self, chat_id: str) -> Optional[ChatHistory]:
+        with self._lock:
+            row = self.conn.execute("SELECT entries FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return ChatHistory.from_bytes(row[0]) if row is not None else None
+    
+    def iter_chats(self) -> Iterator[tuple]:
+        # Meant for a snapshot copy: the cursor is read without holding the lock
+        for chat_id, blob in self.conn.execute("SELECT chat_id, entries FROM chats"):
+            yield chat_id, ChatHistory.from_bytes(blob)
+    
+    def write_chats(self, chats: Dict[str, Optional[ChatHistory]]):
+        with self._lock, self.conn:
+            self.write_rows((chat_id, history) for chat_id, history in chats.items() if history)
+            self.conn.executemany(
+                "DELETE FROM chats WHERE chat_id = ?",
+                [(chat_id,) for chat_id, history in chats.items() if not history]
+            )
+    
+    def expire(self, cutoff: float) -> List[str]:
+        with self._lock, self.conn:
+            expired = [row[0] for row in self.conn.execute("SELECT chat_id FROM chats WHERE updated < ?", (cutoff,))]
+            self.conn.execute("DELETE FROM chats WHERE updated < ?", (cutoff,))
+            return expired
+    
+    def chat_ids(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self.conn.execute("SELECT chat_id FROM chats")]
+    
+    def count(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+    
+    def snapshot(self, path: str):
+        target = sqlite3.connect(path)
+        try:
+            with self._lock:
+                self.conn.backup(target)
+        finally:
+            target.close()
+    
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+def create_history_backend() -> HistoryBackend:
+    backend = config.config.get('HISTORY_BACKEND', 'sqlite').lower()
+    if backend == 'sqlite':
+        return SqliteHistoryBackend(
+            shard_path(config.config.get('HISTORY_DB_FILE', HISTORY_DB_FILE)),
+            import_from=shard_path(CONVERSATION_HISTORY_FILE)
+        )
+    if backend != 'json':
+        raise ValueError(f"ᴜɴᴋɴᴏᴡɴ ʜɪꜱᴛᴏʀʏ ʙᴀᴄᴋᴇɴᴅ: {backend}")
+    return JsonHistoryBackend(shard_path(CONVERSATION_HISTORY_FILE))
+
+class ConversationStore:
+    """Conversation history with a bounded set of hot chats in memory and write-behind persistence.
+    
+    Up to HISTORY_HOT_CHATS recently used chats stay resident in LRU order;
+    the rest live only in the backend and are paged in when their chat is
+    next used. That bounds memory with the SQLite backend (the default); the
+    JSON backend keeps its whole file loaded regardless. With HISTORY_TTL set,
+    a sweeper deletes chats idle for longer than that many seconds, in memory
+    and on disk. A cleared chat stays hot as an empty history until its
+    deletion is flushed, so a read in between can't page the old rows back in.
+    
+    Handlers wrap their work in hold(), which pages the chat in on a worker
+    thread and pins it so the LRU can't evict it before the reply is stored;
+    get() and append() then never touch the backend on the event loop.
+    """
+    def __init__(self, backend: HistoryBackend):
+        self.backend = backend
+        self.hot_limit = int(config.config.get('HISTORY_HOT_CHATS', 10000))
+        self.ttl = float(config.config.get('HISTORY_TTL', 0))
+        self.sweep_interval = float(config.config.get('HISTORY_SWEEP_INTERVAL', 3600))
+        # Hot chats, least recently used first
+        self.history: collections.OrderedDict = collections.OrderedDict()
+        # Dirty chats pushed out of the hot set, held until their next flush
+        self.evicted: Dict[str, ChatHistory] = {}
+        self.opened = False
+        self.flush_interval = float(config.config.get('HISTORY_FLUSH_INTERVAL', 5))
+        self.flush_threshold = int(config.config.get('HISTORY_FLUSH_THRESHOLD', 200))
+        self.dirty = set()
+        # Chats in use by a handler, with how many handlers hold each
+        self.pinned: Dict[str, int] = {}
+        self._flush_event = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._sweep_task = None
+    
+    def admit(self, key: str, history: Optional[ChatHistory]) -> ChatHistory:
+        """Make a chat hot, evicting the least recently used ones over the limit"""
+        if history is None:
+            history = ChatHistory()
+        self.history[key] = history
+        self.shrink()
+        return history
+    
+    def shrink(self):
+        """Evict least recently used chats over the hot limit, skipping pinned ones"""
+        while len(self.history) > self.hot_limit:
+            old_key = next((k for k in self.history if k not in self.pinned), None)
+            if old_key is None:
+                # Every hot chat is in use; the set shrinks again as they are released
+                return
+            old = self.history.pop(old_key)
+            if old_key in self.dirty:
+                self.evicted[old_key] = old
+    
+    @contextlib.asynccontextmanager
+    async def hold(self, chat_id):
+        """Page a chat in and keep it hot for the duration of a handler"""
+        key = str(chat_id)
+        self.pinned[key] = self.pinned.get(key, 0) + 1
+        try:
+            await self.load_chat(chat_id)
+            yield
+        finally:
+            self.pinned[key] -= 1
+            if not self.pinned[key]:
+                del self.pinned[key]
+                self.shrink()
+    
+    def lookup(self, key: str) -> ChatHistory:
+        history = self.history.get(key)
+        if history is not None:
+            self.history.move_to_end(key)
+            return history
+        if key in self.evicted:
+            return self.admit(key, self.evicted.pop(key))
+        # Only for callers outside hold(): a single keyed read on the event loop
+        return self.admit(key, self.backend.load_chat(key))
+    
+    async def load_chat(self, chat_id):
+        """Page a cold chat in on a worker thread so later reads don't block the event loop"""
+        key = str(chat_id)
+        if key in self.history or key in self.evicted:
+            self.lookup(key)
+            return
+        with STORAGE_LATENCY.time("load_chat"):
+            history = await asyncio.to_thread(self.backend.load_chat, key)
+        # The chat may have been loaded, written or cleared meanwhile
+        if key not in self.history and key not in self.evicted and key not in self.dirty:
+            self.admit(key, history)
+    
+    def get(self, chat_id) -> List[HistoryEntry]:
+        return self.lookup(str(chat_id)).entries()
+    
+    def append(self, chat_id, role: str, message: str):
+        key = str(chat_id)
+        self.lookup(key).append(role, message)
+        self.mark_dirty(key)
+    
+    async def clear(self, chat_id) -> bool:
+        await self.load_chat(chat_id)
+        key = str(chat_id)
+        history = self.history.pop(key, None)
+        self.evicted.pop(key, None)
+        if not history:
+            return False
+        self.admit(key, ChatHistory())
+        self.mark_dirty(key)
+        context_builder.forget(chat_id)
+        return True
+    
+    def __len__(self):
+        return len(self.history)
+    
+    async def count(self) -> int:
+        """Chats with stored history, hot or cold"""
+        await self.flush()
+        return await asyncio.to_thread(self.backend.count)
+    
+    def mark_dirty(self, key: str):
+        self.dirty.add(key)
+        if len(self.dirty) >= self.flush_threshold:
+            self._flush_event.set()
+    
+    def snapshot(self, key: str) -> Optional[ChatHistory]:
+        history = self.history.get(key)
+        if history is None:
+            history = self.evicted.get(key)
+        return history.copy() if history else None
+    
+    async def flush(self):
+        """Write all dirty chats to disk in one batch"""
+        async with self._flush_lock:
+            if not self.dirty:
+                return
+            dirty, self.dirty = self.dirty, set()
+            # Rings are mutated in place, so the writer thread gets copies
+            changes = {key: self.snapshot(key) for key in dirty}
+            evicted = {key: self.evicted[key] for key in dirty if key in self.evicted}
+            try:
+                with STORAGE_LATENCY.time("flush"):
+                    await asyncio.to_thread(self.backend.write_chats, changes)
+            except Exception as e:
+                logger.error(f"ᴇʀʀᴏʀ ꜱᴀᴠɪɴɢ ᴄᴏɴᴠᴇʀꜱᴀᴛɪᴏɴ ʜɪꜱᴛᴏʀʏ: {e}")
+                self.dirty |= dirty
+                return
+            for key, history in evicted.items():
+                if self.evicted.get(key) is history:
+                    del self.evicted[key]
+    
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"ᴇʀʀᴏʀ ꜰʟᴜꜱʜɪɴɢ ᴄᴏɴᴠᴇʀꜱᴀᴛɪᴏɴ ʜɪꜱᴛᴏʀʏ: {e}")
+    
+    async def sweep(self) -> int:
+        """Drop chats idle for longer than HISTORY_TTL; returns how many were deleted on disk"""
+        cutoff = time.time() - self.ttl
+        await self.flush()
+        for key in [key for key, history in self.history.items() if history.last_active() < cutoff]:
+            if key not in self.dirty and key not in self.pinned:
+                del self.history[key]
+        with STORAGE_LATENCY.time("sweep"):
+            expired = await asyncio.to_thread(self.backend.expire, cutoff)
+        for key in expired:
+            context_builder.forget(key)
+        return len(expired)
+    
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                expired = await self.sweep()
+                if expired:
+                    logger.info(f"Expired history of {expired} idle chats")
+            except Exception as e:
+                logger.error(f"Error expiring conversation history: {e}")
+    
+    async def open(self):
+        if not self.opened:
+            await asyncio.to_thread(self.backend.open)
+            self.opened = True
+    
+    async def start(self):
+        await self.open()
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if self.ttl > 0 and self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+    
+    async def stop(self):
+        for task in (self._flush_task, self._sweep_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._flush_task = self._sweep_task = None
+        await self.flush()
+    
+    async def export(self, directory: str) -> HistoryBackend:
+        """Point-in-time copy of every chat's history, opened from a snapshot in directory"""
+        await self.flush()
+        path = os.path.join(directory, f"history{self.backend.file_suffix}")
+        await asyncio.to_thread(self.backend.snapshot, path)
+        copy = type(self.backend)(path)
+        await asyncio.to_thread(copy.open)
+        return copy
+    
+    async def replace(self, history: Dict[str, ChatHistory]):
+        """Swap in a whole new history, e.g. from a backup, and persist it"""
+        async with self._flush_lock:
+            self.history.clear()
+            self.evicted.clear()
+            self.dirty.clear()
+            removed = set(await asyncio.to_thread(self.backend.chat_ids)) - set(history)
+            changes: Dict[str, Optional[ChatHistory]] = dict.fromkeys(removed)
+            changes.update(history)
+            await asyncio.to_thread(self.backend.write_chats, changes)
+        context_builder.forget_all()
+
+conversation_store = ConversationStore(create_history_backend())
 
 def update_conversation_history(chat_id, role, message):
-    history = load_conversation_history()
+    with STORAGE_LATENCY.time("update_conversation_history"):
+        conversation_store.append(chat_id, role, message)
+
+# Subscribers
+SUBSCRIBERS_FILE = "subscribers.db"
+
+class SubscriberRegistry:
+    """Every chat that has messaged the bot, for broadcasts and stats.
     
-    if str(chat_id) not in history:
-        history[str(chat_id)] = []
+    Kept apart from conversation history so expiring a chat's history does
+    not forget the chat. IDs live in SQLite; memory holds a bounded cache of
+    recently seen chats and the changes not yet flushed. Shards share one
+    table in the shared state database so a broadcast reaches every shard's
+    chats.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.flush_interval = float(config.config.get('SUBSCRIBER_FLUSH_INTERVAL', 5))
+        self.seen = TTLCache(int(config.config.get('SUBSCRIBER_CACHE_SIZE', 10000)))
+        self.added = set()
+        self.removed = set()
+        # Number of stored chats as of the last flush
+        self.total = 0
+        self.conn = None
+        self._lock = threading.Lock()
+        self._task = None
     
-    if len(history[str(chat_id)]) >= 10:
-        history[str(chat_id)] = history[str(chat_id)][-9:]
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS chats (chat_id TEXT PRIMARY KEY)")
+            # History files whose chats were already imported
+            conn.execute("CREATE TABLE IF NOT EXISTS seeded (source TEXT PRIMARY KEY)")
+            conn.commit()
+            self.conn = conn
+        return self.conn
     
-    history[str(chat_id)].append({
-        "role": role,
-        "message": message,
-        "timestamp": datetime.now().isoformat()
-    })
+    def record(self, chat_id):
+        key = str(chat_id)
+        if self.seen.get(key) is None:
+            self.seen.set(key, True)
+            self.added.add(key)
+            self.removed.discard(key)
+    
+    def forget(self, chat_id):
+        key = str(chat_id)
+        self.seen.pop(key)
+        self.removed.add(key)
+        self.added.discard(key)
+    
+    async def count(self) -> int:
+        """Distinct registered chats; pending changes are flushed first so none is counted twice"""
+        await self.flush()
+        return self.total
+    
+    def _write(self, added: List[str], removed: List[str]) -> int:
+        with self._lock:
+            conn = self.connect()
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO chats VALUES (?)", [(c,) for c in added])
+                conn.executemany("DELETE FROM chats WHERE chat_id = ?", [(c,) for c in removed])
+            return conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
     
-    save_conversation_history(history)
+    async def flush(self):
+        added, self.added = self.added, set()
+        removed, self.removed = self.removed, set()
+        try:
+            self.total = await asyncio.to_thread(self._write, list(added), list(removed))
+        except Exception:
+            self.added |= added - self.removed
+            self.removed |= removed - self.added
+            raise
+    
+    async def add_all(self, chat_ids):
+        self.added.update(str(c) for c in chat_ids)
+        await self.flush()
+    
+    def _read_ids(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self.connect().execute("SELECT chat_id FROM chats")]
+    
+    async def chat_ids(self) -> List[str]:
+        await self.flush()
+        return await asyncio.to_thread(self._read_ids)
+    
+    def seed(self, source: str, read_chat_ids):
+        """Import the chats of a file kept before this registry existed, once per file; read_chat_ids lists them"""
+        with self._lock:
+            if self.connect().execute("SELECT 1 FROM seeded WHERE source = ?", (source,)).fetchone():
+                return
+        chat_ids = read_chat_ids()
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO chats VALUES (?)", [(c,) for c in chat_ids])
+            self.conn.execute("INSERT INTO seeded VALUES (?)", (source,))
+        logger.info(f"Registered {len(chat_ids)} chats from {source}")
+    
+    @staticmethod
+    def read_file(path: str) -> List[str]:
+        """Chat IDs stored in another registry's database"""
+        conn = sqlite3.connect(path)
+        try:
+            return [row[0] for row in conn.execute("SELECT chat_id FROM chats")]
+        finally:
+            conn.close()
+    
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error saving subscribers: {e}")
+    
+    async def start(self):
+        # Shards share a registry the dispatcher already seeded from the single-process files
+        if SHARD is None:
+            backend = conversation_store.backend
+            await asyncio.to_thread(self.seed, backend.path, backend.chat_ids)
+        await self.flush()
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        finally:
+            self.close()
+    
+    def close(self):
+        if self.conn is not None:
+            with self._lock:
+                self.conn.close()
+                self.conn = None
 
-async def generate_response(chat_id: int, user_message: str) -> str:
-    history = load_conversation_history()
-    chat_history = history.get(str(chat_id), [])
+subscribers = SubscriberRegistry(SHARED_STATE_FILE if SHARD else SUBSCRIBERS_FILE)
+
+# Response cache
+CACHE_OPT_OUT_FILE = "cache_opt_out.json"
+
+class ResponseCache:
+    """Replies to short, repeated messages keyed by message, recent history and prompt"""
+    def __init__(self, opt_out_path: str):
+        self.enabled = config.get_bool('RESPONSE_CACHE')
+        self.max_message_length = int(config.config.get('RESPONSE_CACHE_MAX_LENGTH', 40))
+        # Turns before the current message that are part of the key, so a cached "hi" only matches a similar context
+        self.history_window = int(config.config.get('RESPONSE_CACHE_HISTORY_WINDOW', 2))
+        self.cache = TTLCache(
+            int(config.config.get('RESPONSE_CACHE_SIZE', 2000)),
+            float(config.config.get('RESPONSE_CACHE_TTL', 3600))
+        )
+        self.opt_out_path = opt_out_path
+        self.opt_out = set()
+        try:
+            if os.path.exists(opt_out_path):
+                with open(opt_out_path, 'r') as f:
+                    self.opt_out = set(json.load(f))
+        except Exception as e:
+            logger.error(f"Error loading cache opt-outs: {e}")
+        prompt = f"{config.config['HINGLISH_PROMPT']}\0{config.bot_name}\0{config.language}"
+        self.prompt_fingerprint = hashlib.blake2b(prompt.encode(), digest_size=8).digest()
     
-    contents = []
-    contents.append({
-        "role": "user",
-        "parts": [{"text": config.config['HINGLISH_PROMPT']}]
-    })
+    @staticmethod
+    def normalize(message: str) -> str:
+        return ' '.join(message.lower().split()).strip(' .!?')
     
-    for msg in chat_history:
-        contents.append({
-            "role": msg["role"],
-            "parts": [{"text": msg["message"]}]
-        })
+    def make_key(self, chat_id: int, message: str) -> Optional[bytes]:
+        if not self.enabled or chat_id in self.opt_out:
+            return None
+        
+        normalized = self.normalize(message)
+        if not normalized or len(normalized) > self.max_message_length:
+            return None
+        
+        hasher = hashlib.blake2b(self.prompt_fingerprint, digest_size=16)
+        hasher.update(normalized.encode())
+        if self.history_window:
+            history = conversation_store.get(chat_id)
+            # The current message is usually already in history and is hashed above
+            if history and history[-1].role == "user" and history[-1].message == message:
+                history = history[:-1]
+            for msg in history[-self.history_window:]:
+                hasher.update(f"\0{msg.role}\0{msg.message}".encode())
+        return hasher.digest()
     
-    contents.append({
-        "role": "user",
-        "parts": [{"text": user_message}]
-    })
+    def get(self, key: Optional[bytes]) -> Optional[str]:
+        return self.cache.get(key) if key is not None else None
+    
+    def put(self, key: Optional[bytes], text: str):
+        if key is not None:
+            self.cache.set(key, text)
+    
+    async def set_opt_out(self, chat_id: int, opted_out: bool):
+        if opted_out:
+            self.opt_out.add(chat_id)
+        else:
+            self.opt_out.discard(chat_id)
+        try:
+            await asyncio.to_thread(atomic_write_json, self.opt_out_path, sorted(self.opt_out))
+        except Exception as e:
+            logger.error(f"Error saving cache opt-outs: {e}")
+    
+    def describe(self) -> str:
+        lookups = self.cache.hits + self.cache.misses
+        hit_rate = self.cache.hits / lookups if lookups else 0.0
+        return (
+            f"{'on' if self.enabled else 'off'}, {len(self.cache)} entries, "
+            f"{self.cache.hits} hits / {self.cache.misses} misses ({hit_rate:.0%})"
+        )
+
+response_cache = ResponseCache(shard_path(CACHE_OPT_OUT_FILE))
+
+# Admission control
+class AdmissionControl:
+    """Per-user, per-chat and global token buckets checked before a message costs a Gemini call.
+    
+    Limits are messages per minute plus a burst allowance; a rate of 0 turns that limit off.
+    The global limit is off by default because a sensible bot-wide rate depends on the
+    deployment's Gemini quota; set GLOBAL_RATE_LIMIT to match it.
+    """
+    SCOPES = ("user", "chat", "global")
+    
+    def __init__(self):
+        self.limits = {
+            "user": (float(config.config.get('USER_RATE_LIMIT', 8)), float(config.config.get('USER_RATE_BURST', 4))),
+            "chat": (float(config.config.get('CHAT_RATE_LIMIT', 30)), float(config.config.get('CHAT_RATE_BURST', 10))),
+            "global": (float(config.config.get('GLOBAL_RATE_LIMIT', 0)), float(config.config.get('GLOBAL_RATE_BURST', 60)))
+        }
+        # An idle bucket refills completely well within the TTL, so evicting it loses nothing
+        self.buckets = {"user": TTLCache(50000, 600), "chat": TTLCache(20000, 600), "global": TTLCache(1, 0)}
+        self.warned = TTLCache(50000, float(config.config.get('RATE_LIMIT_NOTICE_INTERVAL', 30)))
+        self.rejected = collections.Counter()
+    
+    def bucket(self, scope: str, ident) -> Optional[TokenBucket]:
+        rate, burst = self.limits[scope]
+        if rate <= 0:
+            return None
+        bucket = self.buckets[scope].get(ident)
+        if bucket is None:
+            bucket = TokenBucket(rate / 60, max(1.0, burst))
+            self.buckets[scope].set(ident, bucket)
+        return bucket
+    
+    def admit(self, user_id: int, chat_id: int) -> Optional[tuple]:
+        """Take a token from every applicable bucket, or return (scope, wait) for the first that is empty"""
+        if user_id == config.owner_id:
+            return None
+        
+        taken = []
+        for scope, ident in (("user", user_id), ("chat", chat_id), ("global", None)):
+            bucket = self.bucket(scope, ident)
+            if bucket is None:
+                continue
+            wait = bucket.delay()
+            if wait > 0:
+                self.rejected[scope] += 1
+                ADMISSION_REJECTED.inc(scope)
+                return scope, wait
+            taken.append(bucket)
+        
+        for bucket in taken:
+            bucket.tokens -= 1
+        return None
+    
+    def should_notify(self, user_id: int) -> bool:
+        """Tell a throttled user once per notice interval instead of answering every dropped message"""
+        if self.warned.get(user_id):
+            return False
+        self.warned.set(user_id, True)
+        return True
+    
+    def set_limit(self, scope: str, rate: float, burst: float):
+        self.limits[scope] = (rate, burst)
+        self.buckets[scope].clear()
+    
+    def describe(self) -> str:
+        lines = []
+        for scope in self.SCOPES:
+            rate, burst = self.limits[scope]
+            limit = f"{rate:g}/min, burst {burst:g}" if rate > 0 else "off"
+            lines.append(f"  ▸ {scope}: {limit} ({self.rejected[scope]} rejected)")
+        return "\n".join(lines)
+
+admission_control = AdmissionControl()
+
+def apply_shared_settings(settings: Dict):
+    """Adopt runtime settings another shard's owner commands have changed"""
+    config.maintenance_mode = settings.get("maintenance_mode", config.maintenance_mode)
+    config.stream_replies = settings.get("stream_replies", config.stream_replies)
+    for scope, (rate, burst) in settings.get("limits", {}).items():
+        if scope in AdmissionControl.SCOPES and admission_control.limits[scope] != (rate, burst):
+            admission_control.set_limit(scope, rate, burst)
+
+EMPTY_RESPONSE = "ᴏᴏᴘꜱ! ɢᴇᴍɪɴɪ ɴᴇ ᴋᴜᴄʜ ɴᴀʜɪ ʙᴏʟᴀ. ꜰɪʀ ꜱᴇ ᴛʀʏ ᴋᴀʀᴏ ʏᴀ ʙᴀᴀᴅ ᴍᴇ ᴄʜᴇᴄᴋ ᴋᴀʀᴏ. 😅"
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+class ContextBuilder:
+    """Build request payloads within a token budget, folding older turns into a per-chat summary"""
+    def __init__(self):
+        self.token_budget = int(config.config.get('CONTEXT_TOKEN_BUDGET', 2000))
+        # Summaries cost extra background Gemini calls, so they are opt-in;
+        # without them overflowing turns are simply dropped
+        self.summary_enabled = config.get_bool('CONTEXT_SUMMARY', False)
+        self.summary_batch = int(config.config.get('CONTEXT_SUMMARY_BATCH', 6))
+        self.summary_words = int(config.config.get('CONTEXT_SUMMARY_WORDS', 80))
+        # chat_id -> (summary text, timestamp of the newest entry it covers)
+        self.summaries = TTLCache(int(config.config.get('CONTEXT_SUMMARY_CACHE_SIZE', 10000)))
+        self._refreshing: Dict[int, asyncio.Task] = {}
     
-    payload = {
-        "contents": contents,
-        "systemInstruction": {
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        # Roughly four characters per token for Gemini tokenizers
+        return len(text) // 4 + 1
+    
+    def system_instruction(self) -> Dict:
+        return {
             "parts": [{
-                "text": f"ʏᴏᴜ ᴀʀᴇ {config.bot_name}, ᴀ ꜰʀɪᴇɴᴅʟʏ ᴀɪ ᴄʜᴀᴛʙᴏᴛ ꜱᴘᴇᴀᴋɪɴɢ ɪɴ {config.language}. "
+                "text": f"{config.config['HINGLISH_PROMPT']}\n\n"
+                        f"ʏᴏᴜ ᴀʀᴇ {config.bot_name}, ᴀ ꜰʀɪᴇɴᴅʟʏ ᴀɪ ᴄʜᴀᴛʙᴏᴛ ꜱᴘᴇᴀᴋɪɴɢ ɪɴ {config.language}. "
                         "ʀᴇᴍᴇᴍʙᴇʀ ᴄᴏɴᴠᴇʀꜱᴀᴛɪᴏɴ ʜɪꜱᴛᴏʀʏ ᴀɴᴅ ʀᴇꜱᴘᴏɴᴅ ᴀᴄᴄᴏʀᴅɪɴɢʟʏ. "
                         "ᴋᴇᴇᴘ ʀᴇꜱᴘᴏɴꜱᴇꜱ ᴄᴀꜱᴜᴀʟ ᴀɴᴅ ꜰᴜɴ ᴡɪᴛʜ ᴇᴍᴏᴊɪꜱ."
             }]
         }
-    }
     
-    try:
-        response = await gemini.call_api(payload)
+    def build(self, chat_id: int, user_message: str) -> Dict:
+        chat_history = conversation_store.get(chat_id)
+        # The current message is already in history; it is sent once, at the end
+        if chat_history and chat_history[-1].role == "user" and chat_history[-1].message == user_message:
+            chat_history = chat_history[:-1]
+        
+        summary, covered_until = self.summaries.get(chat_id, (None, None))
+        uncovered = [m for m in chat_history if covered_until is None or m.timestamp > covered_until]
+        
+        budget = self.token_budget - self.estimate_tokens(user_message)
+        if summary:
+            budget -= self.estimate_tokens(summary)
+        
+        window = []
+        for msg in reversed(uncovered):
+            cost = self.estimate_tokens(msg.message)
+            if cost > budget:
+                break
+            budget -= cost
+            window.append(msg)
+        window.reverse()
+        
+        overflow = uncovered[:len(uncovered) - len(window)]
+        if len(uncovered) >= HISTORY_LIMIT - 1 and len(overflow) < self.summary_batch:
+            # Fold the oldest turns in before they are evicted from history
+            overflow = uncovered[:min(self.summary_batch, len(uncovered))]
+        if overflow and self.summary_enabled:
+            self.schedule_refresh(chat_id, overflow)
         
-        if 'candidates' in response and response['candidates']:
-            parts = response['candidates'][0]['content']['parts']
-            if parts:
-                return parts[0]['text']
+        contents = []
+        if summary:
+            contents.append({
+                "role": "user",
+                "parts": [{"text": f"(Summary of our earlier chat: {summary})"}]
+            })
         
-        return "ᴏᴏᴘꜱ! ɢᴇᴍɪɴɪ ɴᴇ ᴋᴜᴄʜ ɴᴀʜɪ ʙᴏʟᴀ. ꜰɪʀ ꜱᴇ ᴛʀʏ ᴋᴀʀᴏ ʏᴀ ʙᴀᴀᴅ ᴍᴇ ᴄʜᴇᴄᴋ ᴋᴀʀᴏ. 😅"
+        for msg in window:
+            contents.append({
+                "role": msg.role,
+                "parts": [{"text": msg.message}]
+            })
         
-    except httpx.HTTPStatusError as e:
+        contents.append({
+            "role": "user",
+            "parts": [{"text": user_message}]
+        })
+        
+        return {
+            "contents": contents,
+            "systemInstruction": self.system_instruction()
+        }
+    
+    def schedule_refresh(self, chat_id: int, entries: List[HistoryEntry]):
+        task = self._refreshing.get(chat_id)
+        if task is not None and not task.done():
+            return
+        self._refreshing[chat_id] = asyncio.create_task(self._refresh(chat_id, entries))
+    
+    async def _refresh(self, chat_id: int, entries: List[HistoryEntry]):
+        """Fold `entries` into the chat's running summary in the background"""
+        previous, _ = self.summaries.get(chat_id, (None, None))
+        transcript = "\n".join(f"{m.role}: {m.message}" for m in entries)
+        prompt = (
+            f"Summarize this chat in at most {self.summary_words} words, keeping names, facts and "
+            f"what the user wants. Reply with the summary only.\n\n"
+            + (f"Earlier summary: {previous}\n\n" if previous else "")
+            + transcript
+        )
+        payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        try:
+            text = extract_text(await gemini.call_api(payload))
+            if text:
+                words = text.split()
+                self.summaries.set(chat_id, (' '.join(words[:self.summary_words * 2]), entries[-1].timestamp))
+        except Exception as e:
+            logger.warning(f"Could not summarize chat {chat_id}: {e}")
+        finally:
+            # forget() may have replaced or removed this task already
+            if self._refreshing.get(chat_id) is asyncio.current_task():
+                del self._refreshing[chat_id]
+    
+    def forget(self, chat_id):
+        """Drop a chat's summary once its history is cleared or expired"""
+        chat_id = int(chat_id)
+        self.summaries.pop(chat_id)
+        task = self._refreshing.pop(chat_id, None)
+        if task is not None:
+            task.cancel()
+    
+    def forget_all(self):
+        for task in self._refreshing.values():
+            task.cancel()
+        self._refreshing.clear()
+        self.summaries.clear()
+    
+    async def stop(self):
+        self.forget_all()
+
+context_builder = ContextBuilder()
+
+def build_payload(chat_id: int, user_message: str) -> Dict:
+    return context_builder.build(chat_id, user_message)
+
+def extract_text(response: Dict) -> Optional[str]:
+    if 'candidates' in response and response['candidates']:
+        parts = response['candidates'][0].get('content', {}).get('parts')
+        if parts:
+            return parts[0].get('text')
+    return None
+
+def describe_api_error(e: Exception) -> str:
+    if isinstance(e, httpx.HTTPStatusError):
         logger.error(f"ʜᴛᴛᴘ ᴇʀʀᴏʀ ᴄᴀʟʟɪɴɢ ɢᴇᴍɪɴɪ ᴀᴘɪ: {e}")
         return f"ᴀᴘɪ ᴇʀʀᴏʀ ʜᴜᴀ (ꜱᴛᴀᴛᴜꜱ {e.response.status_code})"
+    logger.error(f"ᴇʀʀᴏʀ ᴄᴀʟʟɪɴɢ ɢᴇᴍɪɴɪ ᴀᴘɪ: {e}")
+    return f"ᴇʀʀᴏʀ ʜᴜᴀ ɢᴇᴍɪɴɪ ᴀᴘɪ ᴄᴀʟʟ ᴍᴇ: {str(e)}"
+
+async def generate_response(chat_id: int, user_message: str) -> str:
+    cache_key = response_cache.make_key(chat_id, user_message)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    payload = build_payload(chat_id, user_message)
+    
+    try:
+        response = await gemini.call_api(payload, gemini.router.route(user_message))
+        text = extract_text(response)
+        if text:
+            response_cache.put(cache_key, text)
+        return text or EMPTY_RESPONSE
+    except Exception as e:
+        return describe_api_error(e)
+
+async def generate_response_stream(chat_id: int, user_message: str):
+    """Yield the reply text piece by piece as Gemini streams it"""
+    cache_key = response_cache.make_key(chat_id, user_message)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+    
+    payload = build_payload(chat_id, user_message)
+    produced = []
+    
+    try:
+        async for chunk in gemini.stream_api(payload, gemini.router.route(user_message)):
+            text = extract_text(chunk)
+            if text:
+                produced.append(text)
+                yield text
+        if produced:
+            response_cache.put(cache_key, ''.join(produced))
     except Exception as e:
-        logger.error(f"ᴇʀʀᴏʀ ᴄᴀʟʟɪɴɢ ɢᴇᴍɪɴɪ ᴀᴘɪ: {e}")
-        return f"ᴇʀʀᴏʀ ʜᴜᴀ ɢᴇᴍɪɴɪ ᴀᴘɪ ᴄᴀʟʟ ᴍᴇ: {str(e)}"
+        message = describe_api_error(e)
+        # Keep a partial reply rather than replacing it with an error
+        if not produced:
+            yield message
+
+async def stream_reply(message, chat_id: int, user_message: str) -> str:
+    """Send the reply as soon as the first chunk arrives and edit it as more text streams in"""
+    interval = config.stream_edit_interval if message.chat.type == "private" else config.stream_group_edit_interval
+    sent = None
+    text = ""
+    shown = ""
+    last_edit = 0.0
+    
+    async for chunk in generate_response_stream(chat_id, user_message):
+        text += chunk
+        visible = text[:TELEGRAM_MESSAGE_LIMIT]
+        if not visible.strip():
+            continue
+        
+        now = time.monotonic()
+        if sent is None:
+            sent = await message.reply_text(visible)
+            shown, last_edit = visible, now
+        elif visible != shown and now - last_edit >= interval:
+            try:
+                await sent.edit_text(visible)
+            except BadRequest as e:
+                TELEGRAM_SEND_ERRORS.inc(type(e).__name__)
+                logger.warning(f"Stream edit failed in chat {chat_id}: {e}")
+            shown, last_edit = visible, now
+    
+    if not text.strip():
+        text = EMPTY_RESPONSE
+    
+    if sent is None:
+        await message.reply_text(text[:TELEGRAM_MESSAGE_LIMIT])
+    elif text[:TELEGRAM_MESSAGE_LIMIT] != shown:
+        await sent.edit_text(text[:TELEGRAM_MESSAGE_LIMIT])
+    
+    return text
 
 # Menu and Button Handlers
 def get_main_menu_keyboard():
@@ -342,6 +2342,381 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+# ======================
+# Broadcast
+# ======================
+
+BROADCAST_STATE_FILE = "broadcast_state.json"
+
+class BroadcastEngine:
+    """Rate-limited concurrent broadcast with flood control and a resumable cursor"""
+    def __init__(self, path: str):
+        self.path = path
+        self.rate = float(config.config.get('BROADCAST_RATE', 25))
+        self.concurrency = int(config.config.get('BROADCAST_CONCURRENCY', 10))
+        self.progress_interval = float(config.config.get('BROADCAST_PROGRESS_INTERVAL', 5))
+        self.max_attempts = 3
+        self.bucket = TokenBucket(self.rate, self.rate)
+        self.state: Optional[Dict] = self.load()
+        self.task: Optional[asyncio.Task] = None
+    
+    def load(self) -> Optional[Dict]:
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"ᴇʀʀᴏʀ ʟᴏᴀᴅɪɴɢ ʙʀᴏᴀᴅᴄᴀꜱᴛ ꜱᴛᴀᴛᴇ: {e}")
+        return None
+    
+    async def save(self):
+        try:
+            await asyncio.to_thread(atomic_write_json, self.path, self.state)
+        except Exception as e:
+            logger.error(f"ᴇʀʀᴏʀ ꜱᴀᴠɪɴɢ ʙʀᴏᴀᴅᴄᴀꜱᴛ ꜱᴛᴀᴛᴇ: {e}")
+    
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+    
+    @property
+    def resumable(self) -> bool:
+        return self.state is not None and not self.running
+    
+    def progress_text(self) -> str:
+        state = self.state
+        processed = state["sent"] + state["failed"] + state["pruned"]
+        return (
+            f"📢 ʙʀᴏᴀᴅᴄᴀꜱᴛ: {processed}/{len(state['targets'])}\n"
+            f"✅ ꜱᴇɴᴛ: {state['sent']} ▸ ❌ ꜰᴀɪʟᴇᴅ: {state['failed']} ▸ 🧹 ᴘʀᴜɴᴇᴅ: {state['pruned']}"
+        )
+    
+    async def start(self, bot, message: str, targets: List[str], status_message):
+        self.state = {
+            "message": message,
+            "targets": targets,
+            "cursor": 0,
+            "done": [],
+            "sent": 0,
+            "failed": 0,
+            "pruned": 0,
+            "status_chat_id": status_message.chat_id,
+            "status_message_id": status_message.message_id
+        }
+        await self.save()
+        self.task = asyncio.create_task(self._run(bot))
+    
+    async def stop(self):
+        """Interrupt a running broadcast, leaving its cursor on disk for /resumebroadcast"""
+        if self.running:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+    
+    def resume(self, bot):
+        self.task = asyncio.create_task(self._run(bot))
+    
+    async def cancel(self):
+        await self.stop()
+        self.state = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+    
+    async def _update_status(self, bot, text: str):
+        try:
+            with count_send_errors():
+                await bot.edit_message_text(
+                    text,
+                    chat_id=self.state["status_chat_id"],
+                    message_id=self.state["status_message_id"],
+                    rate_limit_args=SEND_PRIORITY_BACKGROUND
+                )
+        except BadRequest:
+            pass
+        except Exception as e:
+            logger.warning(f"ᴄᴏᴜʟᴅ ɴᴏᴛ ᴜᴘᴅᴀᴛᴇ ʙʀᴏᴀᴅᴄᴀꜱᴛ ᴘʀᴏɢʀᴇꜱꜱ: {e}")
+    
+    async def _deliver(self, bot, chat_id: str, message: str) -> str:
+        for attempt in range(self.max_attempts):
+            await self.bucket.acquire()
+            try:
+                with count_send_errors():
+                    await bot.send_message(chat_id=int(chat_id), text=message, rate_limit_args=SEND_PRIORITY_BACKGROUND)
+                return "sent"
+            except RetryAfter as e:
+                self.bucket.pause(retry_after_seconds(e))
+            except Forbidden:
+                await conversation_store.clear(chat_id)
+                subscribers.forget(chat_id)
+                return "pruned"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    await conversation_store.clear(chat_id)
+                    subscribers.forget(chat_id)
+                    return "pruned"
+                logger.error(f"ꜰᴀɪʟᴇᴅ ᴛᴏ ꜱᴇɴᴅ ʙʀᴏᴀᴅᴄᴀꜱᴛ ᴛᴏ {chat_id}: {e}")
+                return "failed"
+            except NetworkError as e:
+                logger.warning(f"ɴᴇᴛᴡᴏʀᴋ ᴇʀʀᴏʀ ꜱᴇɴᴅɪɴɢ ʙʀᴏᴀᴅᴄᴀꜱᴛ ᴛᴏ {chat_id}: {e}")
+            except Exception as e:
+                logger.error(f"ꜰᴀɪʟᴇᴅ ᴛᴏ ꜱᴇɴᴅ ʙʀᴏᴀᴅᴄᴀꜱᴛ ᴛᴏ {chat_id}: {e}")
+                return "failed"
+        return "failed"
+    
+    async def _run(self, bot):
+        state = self.state
+        targets = state["targets"]
+        # Indices finished past the cursor; the cursor only moves over a contiguous done prefix
+        done = set(state["done"])
+        next_index = state["cursor"]
+        
+        async def worker():
+            nonlocal next_index
+            while next_index < len(targets):
+                index = next_index
+                next_index += 1
+                if index in done:
+                    continue
+                result = await self._deliver(bot, targets[index], state["message"])
+                state[result] += 1
+                done.add(index)
+                while state["cursor"] in done:
+                    done.discard(state["cursor"])
+                    state["cursor"] += 1
+        
+        async def report():
+            while True:
+                await asyncio.sleep(self.progress_interval)
+                state["done"] = sorted(done)
+                await self.save()
+                await self._update_status(bot, self.progress_text())
+        
+        reporter = asyncio.create_task(report())
+        try:
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        finally:
+            reporter.cancel()
+            state["done"] = sorted(done)
+            await self.save()
+        
+        await self._update_status(bot, self.progress_text() + "\n\n🎉 ʙʀᴏᴀᴅᴄᴀꜱᴛ ᴄᴏᴍᴘʟᴇᴛᴇᴅ!")
+        self.state = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+broadcast_engine = BroadcastEngine(shard_path(BROADCAST_STATE_FILE))
+
+# ======================
+# Backups
+# ======================
+# Bots may upload documents of up to 50 MB but only download 20 MB through getFile,
+# so parts stay under that for /restore; a local Bot API server lifts both limits
+BACKUP_PART_SIZE = int(config.config.get('BACKUP_PART_SIZE', 19 * 1024 * 1024))
+# A multi-part restore whose next part doesn't arrive in time is dropped with its files
+BACKUP_RESTORE_TIMEOUT = float(config.config.get('BACKUP_RESTORE_TIMEOUT', 3600))
+
+class BackupPartWriter:
+    """Write-only byte sink that cuts the stream into part files of at most part_size bytes.
+    
+    on_part(path, filename) is called from the writing thread as each part is
+    finished. A backup that fits in one part keeps the plain name; otherwise
+    parts are named NAME.partNN and the final one NAME.partNN.last.
+    """
+    def __init__(self, directory: str, name: str, part_size: int, on_part):
+        self.directory = directory
+        self.name = name
+        self.part_size = part_size
+        self.on_part = on_part
+        self.index = 0
+        self.file = None
+        self.written = 0
+    
+    def _finish(self, last: bool):
+        self.file.close()
+        self.file = None
+        if last and self.index == 1:
+            filename = self.name
+        else:
+            filename = f"{self.name}.part{self.index:02d}" + (".last" if last else "")
+        path = os.path.join(self.directory, filename)
+        os.replace(os.path.join(self.directory, f"part{self.index}.tmp"), path)
+        self.on_part(path, filename)
+    
+    def write(self, data) -> int:
+        view = memoryview(data).cast('B')
+        while view:
+            # Only close a full part once more data shows up, so the last part is known
+            if self.file is not None and self.written >= self.part_size:
+                self._finish(last=False)
+            if self.file is None:
+                self.index += 1
+                self.file = open(os.path.join(self.directory, f"part{self.index}.tmp"), 'wb')
+                self.written = 0
+            chunk = view[:self.part_size - self.written]
+            self.file.write(chunk)
+            self.written += len(chunk)
+            view = view[len(chunk):]
+        return len(data)
+    
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+    
+    def close(self):
+        if self.file is None:
+            self.index += 1
+            self.file = open(os.path.join(self.directory, f"part{self.index}.tmp"), 'wb')
+        self._finish(last=True)
+
+class BackupManager:
+    """Compressed JSON-lines backups of history and bans, uploaded in parts, and their restore.
+    
+    The first line holds metadata and the banned user IDs; each further line is
+    one chat. Compression is gzip, or zstd (BACKUP_COMPRESSION=zstd) when the
+    zstandard package is installed.
+    """
+    def __init__(self):
+        self.compression = config.config.get('BACKUP_COMPRESSION', 'gzip').lower()
+        self.part_size = BACKUP_PART_SIZE
+        # Parts of a multi-part backup received so far, keyed by backup name
+        self.pending: Dict[str, Dict] = {}
+        self.restore_timeout = BACKUP_RESTORE_TIMEOUT
+    
+    def open_compressor(self, sink):
+        if self.compression == 'zstd':
+            try:
+                import zstandard
+                return zstandard.ZstdCompressor(level=6).stream_writer(sink, closefd=False), ".zst"
+            except ImportError:
+                logger.warning("ᴢꜱᴛᴀɴᴅᴀʀᴅ ɴᴏᴛ ɪɴꜱᴛᴀʟʟᴇᴅ, ꜰᴀʟʟɪɴɢ ʙᴀᴄᴋ ᴛᴏ ɢᴢɪᴘ")
+        return gzip.GzipFile(fileobj=sink, mode='wb', compresslevel=6), ".gz"
+    
+    @staticmethod
+    def open_decompressor(path: str):
+        if path.endswith(".zst"):
+            import zstandard
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return gzip.open(path, 'rb')
+    
+    def _write(self, directory: str, name: str, history: HistoryBackend, banned: List[int], on_part) -> int:
+        try:
+            sink = BackupPartWriter(directory, name, self.part_size, on_part)
+            compressor, _ = self.open_compressor(sink)
+            header = {"version": 1, "created": datetime.now().isoformat(), "chats": history.count(), "banned_users": banned}
+            with compressor:
+                compressor.write(json.dumps(header).encode() + b"\n")
+                for chat_id, messages in history.iter_chats():
+                    line = json.dumps({"chat_id": chat_id, "messages": messages.to_dicts()}, separators=(',', ':'), ensure_ascii=False)
+                    compressor.write(line.encode() + b"\n")
+            sink.close()
+            return sink.index
+        finally:
+            history.close()
+    
+    async def send(self, message) -> int:
+        """Snapshot, compress and upload a backup as a reply to message; returns the number of parts"""
+        banned = sorted(banned_users.banned)
+        
+        _, extension = self.open_compressor(io.BytesIO())
+        name = f"hinata_backup_{datetime.now():%Y%m%d_%H%M%S}.jsonl{extension}"
+        loop = asyncio.get_running_loop()
+        parts: asyncio.Queue = asyncio.Queue()
+        
+        def on_part(path: str, filename: str):
+            loop.call_soon_threadsafe(parts.put_nowait, (path, filename))
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Cold chats are only on disk, so the backup reads a snapshot of the store chat by chat
+            history = await conversation_store.export(tmp_dir)
+            writer = asyncio.ensure_future(asyncio.to_thread(self._write, tmp_dir, name, history, banned, on_part))
+            writer.add_done_callback(lambda _: parts.put_nowait(None))
+            try:
+                # Upload each part while the next one is still being compressed
+                while (item := await parts.get()) is not None:
+                    path, filename = item
+                    with open(path, 'rb') as f:
+                        await message.reply_document(document=f, filename=filename)
+                    os.remove(path)
+            except BaseException:
+                # The writer thread can't be interrupted; let it finish before its directory goes
+                await asyncio.gather(writer, return_exceptions=True)
+                raise
+            return await writer
+    
+    async def receive(self, bot, document) -> Optional[str]:
+        """Take one backup file or part; returns a status line, or None once a backup was restored"""
+        filename = document.file_name or ""
+        name, _, part = filename.rpartition(".part")
+        if not name or not part.split(".")[0].isdigit():
+            name, index, last = filename, 1, True
+        else:
+            index, last = int(part.split(".")[0]), part.endswith(".last")
+        
+        await self.expire_pending()
+        pending = self.pending.get(name)
+        if pending is None:
+            if index != 1:
+                return f"Send part 1 of {name} first."
+            pending = self.pending[name] = {"dir": tempfile.mkdtemp(), "next": 1}
+        if index != pending["next"]:
+            return f"Expected part {pending['next']} of {name}, got part {index}."
+        pending["updated"] = time.monotonic()
+        
+        combined = os.path.join(pending["dir"], name)
+        part_path = os.path.join(pending["dir"], f"part{index}")
+        telegram_file = await bot.get_file(document.file_id)
+        await telegram_file.download_to_drive(part_path)
+        await asyncio.to_thread(self._append, combined, part_path)
+        pending["next"] += 1
+        if not last:
+            return f"📦 Part {index} of {name} received, send part {index + 1}."
+        
+        del self.pending[name]
+        try:
+            history, banned = await asyncio.to_thread(self._read, combined)
+        finally:
+            await asyncio.to_thread(shutil.rmtree, pending["dir"], True)
+        await conversation_store.replace(history)
+        await subscribers.add_all(history)
+        await banned_users.replace(banned)
+        return None
+    
+    async def expire_pending(self, max_age: Optional[float] = None):
+        """Drop unfinished restores idle for longer than max_age (default the restore timeout) and delete their parts"""
+        max_age = self.restore_timeout if max_age is None else max_age
+        cutoff = time.monotonic() - max_age
+        for name, pending in list(self.pending.items()):
+            if pending.get("updated", 0.0) <= cutoff:
+                del self.pending[name]
+                logger.info(f"Dropping unfinished restore of {name} after part {pending['next'] - 1}")
+                await asyncio.to_thread(shutil.rmtree, pending["dir"], True)
+    
+    async def stop(self):
+        await self.expire_pending(max_age=0)
+    
+    @staticmethod
+    def _append(combined: str, part_path: str):
+        with open(combined, 'ab') as out, open(part_path, 'rb') as part:
+            shutil.copyfileobj(part, out)
+        os.remove(part_path)
+    
+    def _read(self, path: str) -> tuple:
+        history = {}
+        with self.open_decompressor(path) as raw:
+            lines = io.TextIOWrapper(raw, encoding='utf-8')
+            header = json.loads(lines.readline())
+            if header.get("version") != 1:
+                raise ValueError(f"unsupported backup version {header.get('version')}")
+            for line in lines:
+                if line.strip():
+                    chat = json.loads(line)
+                    history[str(chat["chat_id"])] = ChatHistory.from_rows(chat["messages"])
+        return history, header.get("banned_users", [])
+
+backup_manager = BackupManager()
+
 # ======================
 # Owner-only commands
 # ======================
@@ -355,30 +2730,63 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("ᴜꜱᴀɢᴇ: /broadcast <ᴍᴇꜱꜱᴀɢᴇ>")
         return
     
+    if broadcast_engine.running:
+        await update.message.reply_text("📢 ᴀ ʙʀᴏᴀᴅᴄᴀꜱᴛ ɪꜱ ᴀʟʀᴇᴀᴅʏ ʀᴜɴɴɪɴɢ. ᴜꜱᴇ /cancelbroadcast ꜰɪʀꜱᴛ.")
+        return
+    
+    if broadcast_engine.resumable:
+        await update.message.reply_text("📢 ᴀɴ ɪɴᴛᴇʀʀᴜᴘᴛᴇᴅ ʙʀᴏᴀᴅᴄᴀꜱᴛ ᴇxɪꜱᴛꜱ. ᴜꜱᴇ /resumebroadcast ᴏʀ /cancelbroadcast.")
+        return
+    
     message = ' '.join(context.args)
-    history = load_conversation_history()
-    count = 0
+    # Every chat ever seen, including those whose history has expired; shards share one registry
+    targets = sorted(await subscribers.chat_ids())
+    status_message = await update.message.reply_text(f"📢 ʙʀᴏᴀᴅᴄᴀꜱᴛɪɴɢ ᴛᴏ {len(targets)} ᴜꜱᴇʀꜱ...")
+    await broadcast_engine.start(context.bot, message, targets, status_message)
+
+async def resume_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != config.owner_id:
+        await update.message.reply_text("❌ ᴛʜɪꜱ ᴄᴏᴍᴍᴀɴᴅ ɪꜱ ᴏɴʟʏ ꜰᴏʀ ᴍʏ ᴏᴡɴᴇʀ!")
+        return
     
-    for chat_id in history.keys():
-        try:
-            await context.bot.send_message(chat_id=int(chat_id), text=message)
-            count += 1
-        except Exception as e:
-            logger.error(f"ꜰᴀɪʟᴇᴅ ᴛᴏ ꜱᴇɴᴅ ʙʀᴏᴀᴅᴄᴀꜱᴛ ᴛᴏ {chat_id}: {e}")
+    if not broadcast_engine.resumable:
+        await update.message.reply_text("ɴᴏ ɪɴᴛᴇʀʀᴜᴘᴛᴇᴅ ʙʀᴏᴀᴅᴄᴀꜱᴛ ᴛᴏ ʀᴇꜱᴜᴍᴇ.")
+        return
+    
+    status_message = await update.message.reply_text(broadcast_engine.progress_text())
+    broadcast_engine.state["status_chat_id"] = status_message.chat_id
+    broadcast_engine.state["status_message_id"] = status_message.message_id
+    broadcast_engine.resume(context.bot)
+
+async def cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != config.owner_id:
+        await update.message.reply_text("❌ ᴛʜɪꜱ ᴄᴏᴍᴍᴀɴᴅ ɪꜱ ᴏɴʟʏ ꜰᴏʀ ᴍʏ ᴏᴡɴᴇʀ!")
+        return
+    
+    if broadcast_engine.state is None:
+        await update.message.reply_text("ɴᴏ ʙʀᴏᴀᴅᴄᴀꜱᴛ ᴛᴏ ᴄᴀɴᴄᴇʟ.")
+        return
     
-    await update.message.reply_text(f"📢 ʙʀᴏᴀᴅᴄᴀꜱᴛ ꜱᴇɴᴛ ᴛᴏ {count} ᴜꜱᴇʀꜱ!")
+    progress = broadcast_engine.progress_text()
+    await broadcast_engine.cancel()
+    await update.message.reply_text(f"{progress}\n\n❌ ʙʀᴏᴀᴅᴄᴀꜱᴛ ᴄᴀɴᴄᴇʟʟᴇᴅ.")
+
+SHARDED_UNAVAILABLE = "❌ ᴛʜɪꜱ ᴄᴏᴍᴍᴀɴᴅ ɪꜱɴ'ᴛ ᴀᴠᴀɪʟᴀʙʟᴇ ɪɴ ꜱʜᴀʀᴅᴇᴅ ᴍᴏᴅᴇ"
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != config.owner_id:
         await update.message.reply_text("❌ ᴛʜɪꜱ ᴄᴏᴍᴍᴀɴᴅ ɪꜱ ᴏɴʟʏ ꜰᴏʀ ᴍʏ ᴏᴡɴᴇʀ!")
         return
     
-    history = load_conversation_history()
-    banned_users = load_banned_users()
+    if SHARD is not None:
+        # Chat counts and key usage would only be this shard's
+        await update.message.reply_text(SHARDED_UNAVAILABLE)
+        return
     
     stats_msg = (
         f"📊 **ʙᴏᴛ ꜱᴛᴀᴛɪꜱᴛɪᴄꜱ** 📊\n\n"
-        f"✦ ᴀᴄᴛɪᴠᴇ ᴜꜱᴇʀꜱ: {len(history)}\n"
+        f"✦ ᴀᴄᴛɪᴠᴇ ᴜꜱᴇʀꜱ: {await subscribers.count()}\n"
+        f"✦ ᴄʜᴀᴛꜱ ɪɴ ᴍᴇᴍᴏʀʏ: {len(conversation_store)}\n"
         f"✦ ʙᴀɴɴᴇᴅ ᴜꜱᴇʀꜱ: {len(banned_users)}\n"
         f"✦ ᴀᴘɪ ᴋᴇʏꜱ: {len(gemini.api_keys)}\n"
         f"✦ ᴄᴜʀʀᴇɴᴛ ᴍᴏᴅᴇʟ: {gemini.get_current_model()}\n\n"
@@ -401,13 +2809,10 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         user_id = int(context.args[0])
-        banned_users = load_banned_users()
         
-        if user_id in banned_users:
+        if not await banned_users.add(user_id):
             await update.message.reply_text(f"ᴜꜱᴇʀ {user_id} ɪꜱ ᴀʟʀᴇᴀᴅʏ ʙᴀɴɴᴇᴅ.")
         else:
-            banned_users.append(user_id)
-            save_banned_users(banned_users)
             await update.message.reply_text(f"✅ ᴜꜱᴇʀ {user_id} ʜᴀꜱ ʙᴇᴇɴ ʙᴀɴɴᴇᴅ.")
     except ValueError:
         await update.message.reply_text("ɪɴᴠᴀʟɪᴅ ᴜꜱᴇʀ ɪᴅ. ᴘʟᴇᴀꜱᴇ ᴘʀᴏᴠɪᴅᴇ ᴀ ɴᴜᴍᴇʀɪᴄ ɪᴅ.")
@@ -423,11 +2828,8 @@ async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         user_id = int(context.args[0])
-        banned_users = load_banned_users()
         
-        if user_id in banned_users:
-            banned_users.remove(user_id)
-            save_banned_users(banned_users)
+        if await banned_users.remove(user_id):
             await update.message.reply_text(f"✅ ᴜꜱᴇʀ {user_id} ʜᴀꜱ ʙᴇᴇɴ ᴜɴʙᴀɴɴᴇᴅ.")
         else:
             await update.message.reply_text(f"ᴜꜱᴇʀ {user_id} ɪꜱ ɴᴏᴛ ʙᴀɴɴᴇᴅ.")
@@ -446,13 +2848,36 @@ async def maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     mode = context.args[0].lower()
     if mode in ['on', 'true', 'enable']:
         config.maintenance_mode = True
+        await shared_state.publish("maintenance_mode", True)
         await update.message.reply_text("🛠 ᴍᴀɪɴᴛᴇɴᴀɴᴄᴇ ᴍᴏᴅᴇ ɪꜱ ɴᴏᴡ ᴏɴ")
     elif mode in ['off', 'false', 'disable']:
         config.maintenance_mode = False
+        await shared_state.publish("maintenance_mode", False)
         await update.message.reply_text("✅ ᴍᴀɪɴᴛᴇɴᴀɴᴄᴇ ᴍᴏᴅᴇ ɪꜱ ɴᴏᴡ ᴏꜰꜰ")
     else:
         await update.message.reply_text("ᴜꜱᴀɢᴇ: /maintenance <ᴏɴ/ᴏꜰꜰ>")
 
+async def stream_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != config.owner_id:
+        await update.message.reply_text("❌ ᴛʜɪꜱ ᴄᴏᴍᴍᴀɴᴅ ɪꜱ ᴏɴʟʏ ꜰᴏʀ ᴍʏ ᴏᴡɴᴇʀ!")
+        return
+    
+    if not context.args:
+        await update.message.reply_text(f"ꜱᴛʀᴇᴀᴍɪɴɢ ʀᴇᴘʟɪᴇꜱ ᴀʀᴇ ᴄᴜʀʀᴇɴᴛʟʏ {'ᴏɴ' if config.stream_replies else 'ᴏꜰꜰ'}")
+        return
+    
+    mode = context.args[0].lower()
+    if mode in ['on', 'true', 'enable']:
+        config.stream_replies = True
+        await shared_state.publish("stream_replies", True)
+        await update.message.reply_text("⚡ ꜱᴛʀᴇᴀᴍɪɴɢ ʀᴇᴘʟɪᴇꜱ ᴀʀᴇ ɴᴏᴡ ᴏɴ")
+    elif mode in ['off', 'false', 'disable']:
+        config.stream_replies = False
+        await shared_state.publish("stream_replies", False)
+        await update.message.reply_text("✅ ꜱᴛʀᴇᴀᴍɪɴɢ ʀᴇᴘʟɪᴇꜱ ᴀʀᴇ ɴᴏᴡ ᴏꜰꜰ")
+    else:
+        await update.message.reply_text("ᴜꜱᴀɢᴇ: /stream <ᴏɴ/ᴏꜰꜰ>")
+
 async def get_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != config.owner_id:
         await update.message.reply_text("❌ ᴛʜɪꜱ ᴄᴏᴍᴍᴀɴᴅ ɪꜱ ᴏɴʟʏ ꜰᴏʀ ᴍʏ ᴏᴡɴᴇʀ!")
@@ -480,15 +2905,46 @@ async def get_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != config.owner_id:
-        await update.message.reply_text("❌ ᴛʜɪꜱ ᴄᴏᴍᴍᴀɴᴅ ɪꜱ ᴏɴʟʏ ꜰᴏʀ �ʏ ᴏᴡɴᴇʀ!")
+        await update.message.reply_text("❌ ᴛʜɪꜱ ᴄᴏᴍᴍᴀɴᴅ ɪꜱ ᴏɴʟʏ ꜰᴏʀ ᴍʏ ᴏᴡɴᴇʀ!")
+        return
+    
+    if SHARD is not None:
+        # A shard can only snapshot its own chats' history
+        await update.message.reply_text(SHARDED_UNAVAILABLE)
+        return
+    
+    try:
+        parts = await backup_manager.send(update.message)
+        suffix = f" ({parts} ᴘᴀʀᴛꜱ)" if parts > 1 else ""
+        await update.message.reply_text(f"✅ ʙᴀᴄᴋᴜᴘ ᴄᴏᴍᴘʟᴇᴛᴇᴅ!{suffix}")
+    except Exception as e:
+        await update.message.reply_text(f"ʙᴀᴄᴋᴜᴘ ꜰᴀɪʟᴇᴅ: {str(e)}")
+
+async def restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != config.owner_id:
+        await update.message.reply_text("❌ ᴛʜɪꜱ ᴄᴏᴍᴍᴀɴᴅ ɪꜱ ᴏɴʟʏ ꜰᴏʀ ᴍʏ ᴏᴡɴᴇʀ!")
+        return
+    
+    if SHARD is not None:
+        # One shard would load every chat, including those other shards handle
+        await update.message.reply_text(SHARDED_UNAVAILABLE)
+        return
+    
+    reply = update.message.reply_to_message
+    if reply is None or reply.document is None:
+        await update.message.reply_text("ᴜꜱᴀɢᴇ: ʀᴇᴘʟʏ ᴛᴏ ᴀ ʙᴀᴄᴋᴜᴘ ꜰɪʟᴇ (ᴏʀ ᴇᴀᴄʜ ᴘᴀʀᴛ, ɪɴ ᴏʀᴅᴇʀ) ᴡɪᴛʜ /restore")
         return
     
     try:
-        with open(CONVERSATION_HISTORY_FILE, 'rb') as f:
-            await update.message.reply_document(document=f, filename="conversation_history_backup.json")
-        await update.message.reply_text("✅ ʙᴀᴄᴋᴜᴘ ᴄᴏᴍᴘʟᴇᴛᴇᴅ!")
+        result = await backup_manager.receive(context.bot, reply.document)
+        if result is not None:
+            await update.message.reply_text(result)
+            return
+        await update.message.reply_text(
+            f"✅ ʀᴇꜱᴛᴏʀᴇᴅ {await conversation_store.count()} ᴄʜᴀᴛꜱ ᴀɴᴅ {len(banned_users)} ʙᴀɴɴᴇᴅ ᴜꜱᴇʀꜱ"
+        )
     except Exception as e:
-        await update.message.reply_text(f"ʙᴀᴄᴋᴜᴘ ꜰᴀɪʟᴇᴅ: {str(e)}")
+        await update.message.reply_text(f"ʀᴇꜱᴛᴏʀᴇ ꜰᴀɪʟᴇᴅ: {str(e)}")
 
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != config.owner_id:
@@ -535,22 +2991,140 @@ async def password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     password = ''.join(random.choice(chars) for _ in range(length))
     await update.message.reply_text(f"🔑 Generated password:\n`{password}`", parse_mode='Markdown')
 
+# Image rendering
+class ImageRenderer:
+    """Render PNGs in a worker pool and reuse them as cached bytes or Telegram file_ids.
+    
+    Rendering runs in IMAGE_WORKERS processes (0 renders on a thread instead).
+    Concurrent requests for the same image share one render, and once an image
+    has been uploaded its file_id is sent instead of the bytes.
+    """
+    def __init__(self):
+        self.workers = int(config.config.get('IMAGE_WORKERS', 2))
+        self.pool = None
+        self.png_cache = TTLCache(
+            int(config.config.get('IMAGE_CACHE_SIZE', 256)),
+            float(config.config.get('IMAGE_CACHE_TTL', 3600))
+        )
+        # Telegram keeps uploaded files around, so file_ids only leave by LRU
+        self.file_ids = TTLCache(int(config.config.get('IMAGE_FILE_ID_CACHE_SIZE', 5000)), 0)
+        self.inflight: Dict[tuple, asyncio.Future] = {}
+    
+    def get_pool(self):
+        if self.pool is None:
+            # multiprocessing costs tens of milliseconds to import, so wait for the first image
+            import concurrent.futures
+            import multiprocessing
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                # The fork server starts clean and preloads only the render functions
+                context.set_forkserver_preload(["imaging"])
+            else:
+                context = multiprocessing.get_context("spawn")
+            # Each worker waits in its initializer until all have started, so the warm-up
+            # tasks below start every worker now and submit() never has to start one later
+            started = context.Barrier(self.workers)
+            with self.detached_main():
+                pool = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=context,
+                    initializer=imaging.start_worker, initargs=(started,)
+                )
+                for _ in range(self.workers):
+                    pool.submit(int)
+            self.pool = pool
+        return self.pool
+    
+    @staticmethod
+    @contextlib.contextmanager
+    def detached_main():
+        """Hide the bot's __main__ from worker processes started inside this block.
+        
+        A forkserver or spawn child re-imports the parent's main script before its
+        first task, which would read config and open the stores and Gemini client
+        in every worker. The render functions live in imaging, so workers need none
+        of it. Only get_pool uses this, once per pool.
+        """
+        main_module = sys.modules['__main__']
+        saved = {name: getattr(main_module, name, None) for name in ('__file__', '__spec__')}
+        main_module.__spec__ = None
+        main_module.__dict__.pop('__file__', None)
+        try:
+            yield
+        finally:
+            main_module.__spec__ = saved['__spec__']
+            if saved['__file__'] is not None:
+                main_module.__file__ = saved['__file__']
+    
+    def discard_pool(self, pool):
+        """Drop a pool that lost a worker; the next render starts a fresh one"""
+        if self.pool is pool:
+            self.pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+    
+    async def render(self, key: tuple, func, *args) -> bytes:
+        png = self.png_cache.get(key)
+        if png is not None:
+            return png
+        
+        future = self.inflight.get(key)
+        if future is None:
+            future = self.inflight[key] = asyncio.ensure_future(self._render(key, func, args))
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(future)
+    
+    async def _render(self, key: tuple, func, args: tuple) -> bytes:
+        if self.workers > 0:
+            from concurrent.futures.process import BrokenProcessPool
+            for attempt in range(2):
+                pool = self.get_pool()
+                try:
+                    png = await asyncio.wrap_future(pool.submit(func, *args))
+                    break
+                except BrokenProcessPool:
+                    # A crashed worker breaks the whole executor for good
+                    logger.warning(f"Image worker pool broke while rendering {key[0]}, starting a new one")
+                    self.discard_pool(pool)
+                    if attempt:
+                        raise
+        else:
+            png = await asyncio.to_thread(func, *args)
+        self.png_cache.set(key, png)
+        return png
+    
+    async def send_photo(self, message, key: tuple, func, *args, caption: str):
+        file_id = self.file_ids.get(key)
+        if file_id is not None:
+            try:
+                return await message.reply_photo(photo=file_id, caption=caption)
+            except BadRequest as e:
+                logger.warning(f"Cached file_id for {key[0]} image rejected, uploading again: {e}")
+                self.file_ids.pop(key)
+        
+        png = await self.render(key, func, *args)
+        sent = await message.reply_photo(photo=png, caption=caption)
+        if sent.photo:
+            self.file_ids.set(key, sent.photo[-1].file_id)
+        return sent
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+image_renderer = ImageRenderer()
+
 async def qr_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("Usage: /qr <text>")
         return
     
     text = ' '.join(context.args)
-    qr = qrcode.QRCode()
-    qr.add_data(text)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    bio = io.BytesIO()
-    img.save(bio, "PNG")
-    bio.seek(0)
-    
-    await update.message.reply_photo(photo=bio, caption=f"QR Code for: {text}")
+    await image_renderer.send_photo(
+        update.message,
+        ("qr", text, "black", "white"),
+        imaging.render_qr_png, text, "black", "white",
+        caption=f"QR Code for: {text}"
+    )
 
 async def countdown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or not context.args[0].isdigit():
@@ -562,13 +3136,17 @@ async def countdown(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Please choose between 1-60 seconds")
         return
     
-    message = await update.message.reply_text(f"⏳ Countdown: {seconds}")
-    
-    for remaining in range(seconds-1, -1, -1):
-        time.sleep(1)
-        await message.edit_text(f"⏳ Countdown: {remaining}")
+    timer_id = timer_scheduler.reserve("countdown", update.effective_user.id, seconds, seconds)
+    if timer_id is None:
+        await update.message.reply_text(f"You already have {timer_scheduler.max_per_user} timers running. Cancel one with /canceltimer")
+        return
     
-    await message.edit_text("🎉 Countdown finished!")
+    try:
+        message = await update.message.reply_text(TimerScheduler.countdown_text(timer_id, seconds))
+    except Exception:
+        timer_scheduler.release(timer_id)
+        raise
+    timer_scheduler.schedule(timer_id, message)
 
 async def timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or not context.args[0].isdigit():
@@ -580,9 +3158,46 @@ async def timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Please choose between 1-120 minutes")
         return
     
-    message = await update.message.reply_text(f"⏳ Timer set for {minutes} minute(s)")
-    time.sleep(minutes * 60)
-    await message.edit_text(f"⏰ Timer for {minutes} minute(s) is up!")
+    timer_id = timer_scheduler.reserve("timer", update.effective_user.id, minutes * 60, minutes)
+    if timer_id is None:
+        await update.message.reply_text(f"You already have {timer_scheduler.max_per_user} timers running. Cancel one with /canceltimer")
+        return
+    
+    try:
+        message = await update.message.reply_text(f"⏳ Timer set for {minutes} minute(s)\nCancel: /canceltimer {timer_id}")
+    except Exception:
+        timer_scheduler.release(timer_id)
+        raise
+    timer_scheduler.schedule(timer_id, message)
+
+async def cancel_timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    timers = timer_scheduler.user_timers(user_id)
+    
+    if not timers:
+        await update.message.reply_text("You have no running timers.")
+        return
+    
+    if not context.args:
+        lines = ["⏳ Your running timers:"]
+        for t in timers:
+            left = max(0, int(t["due"] - time.time()))
+            lines.append(f"▸ {t['id']} - {t['kind']} ({left}s left)")
+        lines.append("\nUsage: /canceltimer <id|all>")
+        await update.message.reply_text("\n".join(lines))
+        return
+    
+    target = context.args[0]
+    ids = [t["id"] for t in timers] if target == "all" else [target]
+    cancelled = 0
+    for timer_id in ids:
+        if await timer_scheduler.cancel(timer_id, user_id):
+            cancelled += 1
+    
+    if cancelled:
+        await update.message.reply_text(f"❌ Cancelled {cancelled} timer(s).")
+    else:
+        await update.message.reply_text("No timer with that ID.")
 
 async def rate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
@@ -617,17 +3232,13 @@ async def color_preview(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        # Create a simple color image
-        from PIL import Image, ImageDraw
-        img = Image.new('RGB', (200, 200), color=f"#{hex_color}")
-        draw = ImageDraw.Draw(img)
-        draw.text((10, 10), f"#{hex_color}", fill="black")
-        
-        bio = io.BytesIO()
-        img.save(bio, "PNG")
-        bio.seek(0)
-        
-        await update.message.reply_photo(photo=bio, caption=f"Color preview for #{hex_color}")
+        hex_color = hex_color.upper()
+        await image_renderer.send_photo(
+            update.message,
+            ("color", hex_color, 200),
+            imaging.render_color_png, hex_color, 200,
+            caption=f"Color preview for #{hex_color}"
+        )
     except Exception as e:
         await update.message.reply_text(f"Error generating color preview: {str(e)}")
 
@@ -866,52 +3477,329 @@ async def copy_id_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = query.data.split("_")[1]
         await query.answer(f"Copied ID: {user_id}", show_alert=True)
 
+# ======================
+# Timers
+# ======================
+
+TIMERS_FILE = "timers.json"
+
+class TimerScheduler:
+    """Non-blocking /countdown and /timer jobs that are persisted across restarts"""
+    def __init__(self, path: str):
+        self.path = path
+        self.max_per_user = int(config.config.get('MAX_TIMERS_PER_USER', 3))
+        # Groups share a 20/min send bucket, so countdowns there tick every
+        # COUNTDOWN_GROUP_INTERVAL seconds and only go per-second at the end
+        self.group_interval = max(1, int(config.config.get('COUNTDOWN_GROUP_INTERVAL', 5)))
+        self.group_tail = int(config.config.get('COUNTDOWN_GROUP_TAIL', 10))
+        self.timers: Dict[str, Dict] = {}
+        self.reserved: Dict[str, Dict] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._save_task = None
+        self.bot = None
+    
+    def load(self) -> Dict[str, Dict]:
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    return {t["id"]: t for t in json.load(f)}
+        except Exception as e:
+            logger.error(f"Error loading timers: {e}")
+        return {}
+    
+    def user_timers(self, user_id: int) -> List[Dict]:
+        return [t for t in self.timers.values() if t["user_id"] == user_id]
+    
+    def reserve(self, kind: str, user_id: int, seconds: int, amount: int) -> Optional[str]:
+        """Claim one of user_id's timer slots before the reply is sent, or None if all are taken.
+        
+        The check and the claim happen without an await in between, so
+        concurrent commands can't both pass the MAX_TIMERS_PER_USER check.
+        """
+        taken = len(self.user_timers(user_id)) + sum(1 for t in self.reserved.values() if t["user_id"] == user_id)
+        if taken >= self.max_per_user:
+            return None
+        timer_id = uuid.uuid4().hex[:8]
+        self.reserved[timer_id] = {
+            "id": timer_id,
+            "kind": kind,
+            "user_id": user_id,
+            "amount": amount,
+            "seconds": seconds
+        }
+        return timer_id
+    
+    def release(self, timer_id: str):
+        """Give back a reserved slot whose reply could not be sent"""
+        self.reserved.pop(timer_id, None)
+    
+    def schedule(self, timer_id: str, message):
+        """Start a reserved timer that updates message"""
+        timer = self.reserved.pop(timer_id)
+        seconds = timer.pop("seconds")
+        timer.update(chat_id=message.chat_id, message_id=message.message_id, due=time.time() + seconds)
+        self.timers[timer_id] = timer
+        self._start(timer)
+        self.schedule_save()
+    
+    async def cancel(self, timer_id: str, user_id: int) -> bool:
+        timer = self.timers.get(timer_id)
+        if timer is None or timer["user_id"] != user_id:
+            return False
+        
+        task = self._tasks.pop(timer_id, None)
+        if task is not None:
+            task.cancel()
+        del self.timers[timer_id]
+        self.schedule_save()
+        await self._edit(timer, "❌ Timer cancelled")
+        return True
+    
+    def _start(self, timer: Dict):
+        runner = self._run_countdown if timer["kind"] == "countdown" else self._run_timer
+        self._tasks[timer["id"]] = asyncio.create_task(runner(timer))
+    
+    async def _edit(self, timer: Dict, text: str):
+        try:
+            with count_send_errors():
+                await self.bot.edit_message_text(
+                    text, chat_id=timer["chat_id"], message_id=timer["message_id"],
+                    rate_limit_args=SEND_PRIORITY_BACKGROUND
+                )
+        except Exception as e:
+            logger.warning(f"Could not update timer {timer['id']}: {e}")
+    
+    async def _run_timer(self, timer: Dict):
+        await asyncio.sleep(max(0, timer["due"] - time.time()))
+        await self._edit(timer, f"⏰ Timer for {timer['amount']} minute(s) is up!")
+        self._finish(timer)
+    
+    @staticmethod
+    def countdown_text(timer_id: str, left: int) -> str:
+        return f"⏳ Countdown: {left}\nCancel: /canceltimer {timer_id}"
+    
+    def _next_tick(self, timer: Dict, left: int) -> int:
+        """The next value to show after left, thinned out in group chats"""
+        if not str(timer["chat_id"]).startswith('-') or left - 1 <= self.group_tail:
+            return left - 1
+        return max(self.group_tail, (left - 1) // self.group_interval * self.group_interval)
+    
+    async def _run_countdown(self, timer: Dict):
+        while True:
+            remaining = timer["due"] - time.time()
+            if remaining <= 0:
+                break
+            tick = self._next_tick(timer, math.ceil(remaining))
+            await asyncio.sleep(remaining - tick)
+            left = math.ceil(timer["due"] - time.time())
+            if left > 0:
+                await self._edit(timer, self.countdown_text(timer["id"], left))
+        await self._edit(timer, "🎉 Countdown finished!")
+        self._finish(timer)
+    
+    def _finish(self, timer: Dict):
+        self._tasks.pop(timer["id"], None)
+        self.timers.pop(timer["id"], None)
+        self.schedule_save()
+    
+    def schedule_save(self):
+        """Coalesce bursts of timer changes into one write"""
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._delayed_save())
+    
+    async def _delayed_save(self):
+        await asyncio.sleep(0.5)
+        await self.save()
+    
+    async def save(self):
+        try:
+            await asyncio.to_thread(atomic_write_json, self.path, list(self.timers.values()))
+        except Exception as e:
+            logger.error(f"Error saving timers: {e}")
+    
+    async def start(self, bot):
+        """Resume timers that were pending when the bot last stopped"""
+        self.bot = bot
+        self.timers = self.load()
+        for timer in list(self.timers.values()):
+            self._start(timer)
+        if self.timers:
+            logger.info(f"Resumed {len(self.timers)} pending timers")
+    
+    async def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        if self._save_task is not None:
+            self._save_task.cancel()
+        await self.save()
+
+timer_scheduler = TimerScheduler(shard_path(TIMERS_FILE))
+
 # ======================
 # Message handlers
 # ======================
 
+async def respond(message, bot, user_message: str):
+    """Generate a reply to user_message, record both turns and send it as a reply to message"""
+    chat_id = message.chat_id
+    
+    # Show typing action
+    await bot.send_chat_action(chat_id=chat_id, action="typing")
+    
+    # Page a cold chat in and keep it hot until the reply is recorded
+    async with conversation_store.hold(chat_id):
+        update_conversation_history(chat_id, "user", user_message)
+        
+        if config.stream_replies:
+            response = await stream_reply(message, chat_id, user_message)
+            update_conversation_history(chat_id, "model", response)
+            return
+        
+        # Generate response
+        response = await generate_response(chat_id, user_message)
+        
+        # Update conversation history with bot's response
+        update_conversation_history(chat_id, "model", response)
+    
+    await message.reply_text(response)
+
+class MessageCoalescer:
+    """Answer bursts of group messages with one generation per chat.
+    
+    A message in a quiet chat is answered at once. Messages that arrive while
+    a reply is being generated, or within COALESCE_DEBOUNCE seconds of each
+    other, are merged into the next generation, waiting no longer than
+    COALESCE_MAX_WAIT for the burst to settle.
+    
+    Each chat's drain task generates without holding the chat's update lock,
+    so new messages reach submit() and are buffered in pending while a reply
+    is in flight. The drains run outside the update processor, so at most
+    COALESCE_CONCURRENCY of them (CONCURRENT_UPDATES by default) generate at once.
+    """
+    def __init__(self):
+        self.enabled = config.get_bool('COALESCE_GROUPS', True)
+        self.debounce = float(config.config.get('COALESCE_DEBOUNCE', 1.0))
+        self.max_wait = float(config.config.get('COALESCE_MAX_WAIT', 3.0))
+        self.max_batch = int(config.config.get('COALESCE_MAX_MESSAGES', 10))
+        self.pending: Dict[int, List[tuple]] = {}
+        self.last_arrival = TTLCache(10000, self.max_wait)
+        self.tasks: Dict[int, asyncio.Task] = {}
+        concurrency = config.config.get('COALESCE_CONCURRENCY', config.config.get('CONCURRENT_UPDATES', 1))
+        self.slots = asyncio.Semaphore(max(1, int(concurrency)))
+    
+    def submit(self, message, bot):
+        chat_id = message.chat_id
+        now = time.monotonic()
+        previous = self.last_arrival.get(chat_id)
+        self.last_arrival.set(chat_id, now)
+        self.pending.setdefault(chat_id, []).append((now, message))
+        
+        if chat_id not in self.tasks:
+            bursty = previous is not None and now - previous < self.debounce
+            self.tasks[chat_id] = asyncio.create_task(self._drain(chat_id, bot, bursty))
+    
+    async def _settle(self, chat_id: int):
+        """Wait for the burst to go quiet, bounded by max_wait since its first message"""
+        while True:
+            pending = self.pending[chat_id]
+            now = time.monotonic()
+            quiet_for = now - self.last_arrival.get(chat_id, pending[-1][0])
+            waited = now - pending[0][0]
+            if quiet_for >= self.debounce or waited >= self.max_wait or len(pending) >= self.max_batch:
+                return
+            await asyncio.sleep(min(self.debounce - quiet_for, self.max_wait - waited))
+    
+    async def _drain(self, chat_id: int, bot, bursty: bool):
+        try:
+            while self.pending.get(chat_id):
+                if bursty:
+                    await self._settle(chat_id)
+                bursty = True
+                
+                async with self.slots:
+                    # Messages that came in while waiting for a slot join this batch
+                    batch = [message for _, message in self.pending.pop(chat_id)]
+                    try:
+                        await respond(batch[-1], bot, self.merge(batch))
+                    except Exception as e:
+                        logger.error(f"Error answering coalesced messages in chat {chat_id}: {e}")
+        finally:
+            self.tasks.pop(chat_id, None)
+    
+    @staticmethod
+    def merge(batch: List) -> str:
+        if len(batch) == 1:
+            return batch[0].text
+        lines = [f"{m.from_user.first_name if m.from_user else 'Someone'}: {m.text}" for m in batch]
+        return "\n".join(lines)
+    
+    async def stop(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+        self.tasks.clear()
+
+message_coalescer = MessageCoalescer()
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if config.maintenance_mode and update.effective_user.id != config.owner_id:
         await update.message.reply_text("🛠 Bot is under maintenance. Please try again later.")
         return
     
-    banned_users = load_banned_users()
-    if update.effective_user.id in banned_users:
+    if banned_users.is_banned(update.effective_user.id):
         await update.message.reply_text("🚫 You are banned from using this bot.")
         return
     
     user_message = update.message.text
-    chat_id = update.effective_chat.id
     
     # Check if message starts with any command (skip processing)
     if user_message.startswith('/'):
         return
     
-    # Show typing action
-    await context.bot.send_chat_action(chat_id=chat_id, action="typing")
-    
-    # Update conversation history
-    update_conversation_history(chat_id, "user", user_message)
+    rejected = admission_control.admit(update.effective_user.id, update.effective_chat.id)
+    if rejected is not None:
+        scope, wait = rejected
+        if admission_control.should_notify(update.effective_user.id):
+            if scope == "global":
+                await update.message.reply_text("😵 I'm getting a lot of messages right now. Please try again in a minute.")
+            else:
+                await update.message.reply_text(f"🐢 Slow down a little! Try again in {math.ceil(wait)}s.")
+        return
     
-    # Generate response
-    response = await generate_response(chat_id, user_message)
+    subscribers.record(update.effective_chat.id)
     
-    # Update conversation history with bot's response
-    update_conversation_history(chat_id, "model", response)
+    if message_coalescer.enabled and update.effective_chat.type != "private":
+        message_coalescer.submit(update.message, context.bot)
+        return
     
-    await update.message.reply_text(response)
+    await respond(update.message, context.bot, user_message)
 
 async def clear_memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    history = load_conversation_history()
     
-    if str(chat_id) in history:
-        del history[str(chat_id)]
-        save_conversation_history(history)
+    if await conversation_store.clear(chat_id):
         await update.message.reply_text("🧹 Chat history cleared!")
     else:
         await update.message.reply_text("No chat history to clear.")
 
+async def no_cache(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    
+    if not context.args:
+        state = "off" if chat_id in response_cache.opt_out else "on"
+        await update.message.reply_text(f"Cached replies are {state} for this chat. Usage: /nocache <on/off>")
+        return
+    
+    mode = context.args[0].lower()
+    if mode in ['on', 'true', 'enable']:
+        await response_cache.set_opt_out(chat_id, True)
+        await update.message.reply_text("✅ Cached replies are now disabled for this chat")
+    elif mode in ['off', 'false', 'disable']:
+        await response_cache.set_opt_out(chat_id, False)
+        await update.message.reply_text("✅ Cached replies are now enabled for this chat")
+    else:
+        await update.message.reply_text("Usage: /nocache <on/off>")
+
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     status_msg = (
         f"🤖 **{config.bot_name} Status** 🤖\n\n"
@@ -930,13 +3818,46 @@ async def apistats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     stats_msg = "🔌 **API Statistics** 🔌\n\n"
     stats_msg += f"✦ Current Model: {gemini.get_current_model()}\n"
+    for model in gemini.model_priority:
+        stats_msg += f"  ▸ {model}: {gemini.router.describe(model)}\n"
+    stats_msg += f"✦ Response Cache: {response_cache.describe()}\n"
+    stats_msg += f"✦ Hedging: {gemini.hedger.describe()}\n"
     stats_msg += "🔢 **Key Usage**:\n"
     
     for i, key in enumerate(gemini.api_keys):
-        stats_msg += f"  ▸ Key {i+1}: {gemini.key_usage[key]} requests\n"
+        stats_msg += f"  ▸ Key {i+1}: {gemini.key_usage[key]} requests ({gemini.key_pool.describe(gemini.key_pool.keys[i])})\n"
     
     await update.message.reply_text(stats_msg, parse_mode='Markdown')
 
+async def limits(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != config.owner_id:
+        await update.message.reply_text("❌ This command is only for my owner!")
+        return
+    
+    if not context.args:
+        await update.message.reply_text(
+            "🚦 **Rate Limits** 🚦\n\n" + admission_control.describe()
+            + "\n\n📤 **Telegram sends**\n" + send_pipeline.describe()
+            + "\n\nUsage: /limits <user|chat|global> <per minute> [burst]",
+            parse_mode='Markdown'
+        )
+        return
+    
+    scope = context.args[0].lower()
+    if scope not in AdmissionControl.SCOPES:
+        await update.message.reply_text("Usage: /limits <user|chat|global> <per minute> [burst]")
+        return
+    try:
+        rate = float(context.args[1])
+        burst = float(context.args[2]) if len(context.args) > 2 else admission_control.limits[scope][1]
+    except (IndexError, ValueError):
+        await update.message.reply_text("Usage: /limits <user|chat|global> <per minute> [burst]")
+        return
+    
+    admission_control.set_limit(scope, max(0.0, rate), max(1.0, burst))
+    await shared_state.publish("limits", admission_control.limits)
+    await update.message.reply_text(f"✅ {scope} limit updated\n" + admission_control.describe())
+
 async def eval_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != config.owner_id:
         await update.message.reply_text("❌ This command is only for my owner!")
@@ -999,6 +3920,11 @@ async def server(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Update {update} caused error {context.error}")
+    if isinstance(context.error, TelegramError):
+        TELEGRAM_SEND_ERRORS.inc(type(context.error).__name__)
+    if isinstance(context.error, RetryAfter):
+        # The send pipeline already retried; another reply would hit the same flood limit
+        return
     
     if update.effective_message:
         await update.effective_message.reply_text(
@@ -1006,78 +3932,682 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Error ho gaya. Thodi der baad try karo ya owner ko batado."
         )
 
+# ======================
+# Update processing
+# ======================
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Run updates from different chats in parallel while keeping each chat in order.
+    
+    The first update for an idle chat becomes that chat's drain: it runs its
+    own coroutine and then any that arrived for the chat meanwhile. Those are
+    queued here and return at once, so updates waiting behind a busy chat
+    don't hold one of the max_pending slots of the base semaphore and a
+    single flooding chat can't starve the others.
+    """
+    def __init__(self, max_workers: int, max_pending: int):
+        # The base semaphore bounds draining chats; workers bound the updates actually running
+        super().__init__(max(max_pending, max_workers))
+        self.max_workers = max_workers
+        self._workers = asyncio.BoundedSemaphore(max_workers)
+        self._queues: Dict[int, collections.deque] = {}
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._workers:
+                await coroutine
+            return
+        
+        queue = self._queues.get(chat.id)
+        if queue is not None:
+            queue.append(coroutine)
+            return
+        
+        queue = self._queues[chat.id] = collections.deque([coroutine])
+        try:
+            while queue:
+                coroutine = queue.popleft()
+                async with self._workers:
+                    try:
+                        await coroutine
+                    except Exception as e:
+                        logger.error(f"Update for chat {chat.id} failed: {e}")
+        finally:
+            del self._queues[chat.id]
+            # Only left over if the drain was cancelled during shutdown
+            for coroutine in queue:
+                coroutine.close()
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+# ======================
+# Outbound send pipeline
+# ======================
+
+# Passed to Bot methods as rate_limit_args; calls without it are interactive
+SEND_PRIORITY_INTERACTIVE = 0
+SEND_PRIORITY_BACKGROUND = 1
+SEND_PRIORITY_NAMES = {SEND_PRIORITY_INTERACTIVE: "interactive", SEND_PRIORITY_BACKGROUND: "background"}
+
+class SendPipeline(BaseRateLimiter):
+    """Flood control for every Bot API call, installed as the application's rate limiter.
+    
+    A call to a chat first takes a token from that chat's bucket (per minute,
+    with separate limits for private chats and groups), then queues for the
+    global per-second bucket, which is split across shards. The global queue
+    serves interactive replies before background traffic such as broadcasts
+    and timers. A RetryAfter pauses the bucket and the call is retried, so
+    bursts cost latency instead of failed replies.
+    """
+    def __init__(self):
+        shards = int(SHARD.split('/')[1]) if SHARD else 1
+        rate = float(config.config.get('TELEGRAM_GLOBAL_RATE', 30)) / shards
+        self.global_bucket = TokenBucket(rate, max(1.0, float(config.config.get('TELEGRAM_GLOBAL_BURST', 30)) / shards))
+        self.limits = {
+            "private": (float(config.config.get('TELEGRAM_CHAT_RATE', 60)), float(config.config.get('TELEGRAM_CHAT_BURST', 3))),
+            "group": (float(config.config.get('TELEGRAM_GROUP_RATE', 20)), float(config.config.get('TELEGRAM_GROUP_BURST', 5)))
+        }
+        self.max_retries = int(config.config.get('TELEGRAM_MAX_RETRIES', 3))
+        self.max_retry_after = float(config.config.get('TELEGRAM_MAX_RETRY_AFTER', 30))
+        # An idle bucket refills completely well within the TTL, so evicting it loses nothing
+        self.chat_buckets = TTLCache(20000, 600)
+        # Heap of (priority, arrival, future) for calls waiting on the global bucket
+        self.waiters: List[tuple] = []
+        self.arrivals = 0
+        self._task = None
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for _, _, future in self.waiters:
+            future.cancel()
+        self.waiters.clear()
+    
+    def chat_bucket(self, chat_id) -> Optional[TokenBucket]:
+        key = str(chat_id)
+        # Groups, supergroups and channels have negative IDs or @usernames
+        rate, burst = self.limits["group" if key.startswith(('-', '@')) else "private"]
+        if rate <= 0:
+            return None
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate / 60, max(1.0, burst))
+            self.chat_buckets.set(key, bucket)
+        return bucket
+    
+    async def acquire(self, priority: int):
+        """Wait for a global token; waiting calls are served by priority, then in arrival order"""
+        if not self.waiters and self.global_bucket.try_acquire():
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.arrivals += 1
+        heapq.heappush(self.waiters, (priority, self.arrivals, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch())
+        await future
+    
+    async def _dispatch(self):
+        while self.waiters:
+            wait = self.global_bucket.delay()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self.waiters)
+            # Callers that gave up while queued don't use a token
+            if not future.done():
+                self.global_bucket.tokens -= 1
+                future.set_result(None)
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if rate_limit_args in SEND_PRIORITY_NAMES else SEND_PRIORITY_INTERACTIVE
+        chat_id = data.get("chat_id")
+        # Typing indicators don't count as messages and shouldn't delay the reply they announce
+        throttled = endpoint != "sendChatAction"
+        bucket = self.chat_bucket(chat_id) if throttled and chat_id is not None else None
+        
+        for attempt in range(self.max_retries + 1):
+            queued_at = time.perf_counter()
+            if bucket is not None:
+                await bucket.acquire()
+            if throttled:
+                await self.acquire(priority)
+            TELEGRAM_SEND_WAIT.observe(SEND_PRIORITY_NAMES[priority], value=time.perf_counter() - queued_at)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                wait = retry_after_seconds(e)
+                TELEGRAM_FLOOD_WAITS.inc(endpoint)
+                if attempt == self.max_retries or wait > self.max_retry_after:
+                    raise
+                # The global bucket keeps the bot under its overall limit, so this is most likely the chat's
+                (bucket or self.global_bucket).pause(wait)
+                logger.warning(f"Flood control on {endpoint} to {chat_id}, retrying in {wait:g}s")
+    
+    def describe(self) -> str:
+        lines = [f"global: {self.global_bucket.rate:g}/s, burst {self.global_bucket.capacity:g}"]
+        for kind, (rate, burst) in self.limits.items():
+            lines.append(f"{kind} chat: " + (f"{rate:g}/min, burst {burst:g}" if rate > 0 else "off"))
+        lines.append(f"queued: {len(self.waiters)}")
+        return "\n".join(lines)
+
+send_pipeline = SendPipeline()
+
 # ======================
 # Main function
 # ======================
+startup_profile.mark("subsystems")
 
-def main():
+async def post_init(application: Application):
+    startup_profile.mark("telegram initialize")
+    await conversation_store.start()
+    await subscribers.start()
+    startup_profile.mark("history load")
+    await shared_state.start()
+    await timer_scheduler.start(application.bot)
+    if broadcast_engine.resumable:
+        logger.info("An interrupted broadcast can be resumed with /resumebroadcast")
+    await gemini.warm_up()
+    startup_profile.mark("gemini warm-up")
+    startup_profile.finish()
+
+async def post_shutdown(application: Application):
+    await broadcast_engine.stop()
+    await timer_scheduler.stop()
+    await message_coalescer.stop()
+    await context_builder.stop()
+    await conversation_store.stop()
+    conversation_store.backend.close()
+    await subscribers.stop()
+    await shared_state.stop()
+    image_renderer.close()
+    await backup_manager.stop()
+    await gemini.close()
+
+def instrument(name: str, callback):
+    """Wrap a handler callback to record its latency and the number of updates in flight"""
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        UPDATES_IN_FLIGHT.inc()
+        try:
+            with HANDLER_LATENCY.time(name):
+                return await callback(update, context)
+        finally:
+            UPDATES_IN_FLIGHT.dec()
+    return wrapper
+
+def build_application(webhook: bool = False) -> Application:
     # Create the Application
-    application = Application.builder().token(config.config['TELEGRAM_BOT_TOKEN']).build()
+    builder = (
+        Application.builder()
+        .token(config.config['TELEGRAM_BOT_TOKEN'])
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    # Point at a local Bot API server (or the load-test fake) instead of api.telegram.org
+    if 'TELEGRAM_API_BASE' in config.config:
+        builder.base_url(config.config['TELEGRAM_API_BASE'])
+    # The Bot API clients share one TLS context rather than each loading the CA bundle
+    tls_context = httpx.create_ssl_context()
+    builder.request(HTTPXRequest(connection_pool_size=256, httpx_kwargs={"verify": tls_context}))
+    builder.rate_limiter(send_pipeline)
+    if webhook:
+        builder.updater(None)
+    else:
+        builder.get_updates_request(HTTPXRequest(connection_pool_size=1, httpx_kwargs={"verify": tls_context}))
+    
+    workers = int(config.config.get('CONCURRENT_UPDATES', 1))
+    if workers > 1:
+        builder.concurrent_updates(PerChatUpdateProcessor(
+            workers,
+            int(config.config.get('MAX_PENDING_UPDATES', 256))
+        ))
+    application = builder.build()
     
     # Add command handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", button_handler))
-    application.add_handler(CommandHandler("clearmemory", clear_memory))
-    application.add_handler(CommandHandler("status", status))
+    application.add_handler(CommandHandler("start", instrument("start", start)))
+    application.add_handler(CommandHandler("help", instrument("help", button_handler)))
+    application.add_handler(CommandHandler("clearmemory", instrument("clearmemory", clear_memory)))
+    application.add_handler(CommandHandler("status", instrument("status", status)))
+    application.add_handler(CommandHandler("nocache", instrument("nocache", no_cache)))
     
     # Owner commands
-    application.add_handler(CommandHandler("broadcast", broadcast))
-    application.add_handler(CommandHandler("stats", stats))
-    application.add_handler(CommandHandler("ban", ban_user))
-    application.add_handler(CommandHandler("unban", unban_user))
-    application.add_handler(CommandHandler("maintenance", maintenance))
-    application.add_handler(CommandHandler("getuser", get_user))
-    application.add_handler(CommandHandler("apistats", apistats))
-    application.add_handler(CommandHandler("backup", backup))
-    application.add_handler(CommandHandler("eval", eval_command))
-    application.add_handler(CommandHandler("server", server))
-    application.add_handler(CommandHandler("ping", ping))
+    application.add_handler(CommandHandler("broadcast", instrument("broadcast", broadcast)))
+    application.add_handler(CommandHandler("resumebroadcast", instrument("resumebroadcast", resume_broadcast)))
+    application.add_handler(CommandHandler("cancelbroadcast", instrument("cancelbroadcast", cancel_broadcast)))
+    application.add_handler(CommandHandler("stats", instrument("stats", stats)))
+    application.add_handler(CommandHandler("ban", instrument("ban", ban_user)))
+    application.add_handler(CommandHandler("unban", instrument("unban", unban_user)))
+    application.add_handler(CommandHandler("maintenance", instrument("maintenance", maintenance)))
+    application.add_handler(CommandHandler("stream", instrument("stream", stream_mode)))
+    application.add_handler(CommandHandler("getuser", instrument("getuser", get_user)))
+    application.add_handler(CommandHandler("apistats", instrument("apistats", apistats)))
+    application.add_handler(CommandHandler("limits", instrument("limits", limits)))
+    application.add_handler(CommandHandler("backup", instrument("backup", backup)))
+    application.add_handler(CommandHandler("restore", instrument("restore", restore)))
+    application.add_handler(CommandHandler("eval", instrument("eval", eval_command)))
+    application.add_handler(CommandHandler("server", instrument("server", server)))
+    application.add_handler(CommandHandler("ping", instrument("ping", ping)))
     
     # Utility commands
-    application.add_handler(CommandHandler("dice", dice))
-    application.add_handler(CommandHandler("flip", flip))
-    application.add_handler(CommandHandler("password", password))
-    application.add_handler(CommandHandler("qr", qr_code))
-    application.add_handler(CommandHandler("countdown", countdown))
-    application.add_handler(CommandHandler("timer", timer))
-    application.add_handler(CommandHandler("rate", rate))
-    application.add_handler(CommandHandler("decide", decide))
-    application.add_handler(CommandHandler("color", color_preview))
-    application.add_handler(CommandHandler("font", fancy_font))
-    application.add_handler(CommandHandler("temp", temp_convert))
-    application.add_handler(CommandHandler("currency", currency_convert))
-    application.add_handler(CommandHandler("units", unit_convert))
-    application.add_handler(CommandHandler("emoji", emoji_suggest))
-    application.add_handler(CommandHandler("bmi", bmi_calc))
-    application.add_handler(CommandHandler("id", get_id))
+    application.add_handler(CommandHandler("dice", instrument("dice", dice)))
+    application.add_handler(CommandHandler("flip", instrument("flip", flip)))
+    application.add_handler(CommandHandler("password", instrument("password", password)))
+    application.add_handler(CommandHandler("qr", instrument("qr", qr_code)))
+    application.add_handler(CommandHandler("countdown", instrument("countdown", countdown)))
+    application.add_handler(CommandHandler("timer", instrument("timer", timer)))
+    application.add_handler(CommandHandler("canceltimer", instrument("canceltimer", cancel_timer)))
+    application.add_handler(CommandHandler("rate", instrument("rate", rate)))
+    application.add_handler(CommandHandler("decide", instrument("decide", decide)))
+    application.add_handler(CommandHandler("color", instrument("color", color_preview)))
+    application.add_handler(CommandHandler("font", instrument("font", fancy_font)))
+    application.add_handler(CommandHandler("temp", instrument("temp", temp_convert)))
+    application.add_handler(CommandHandler("currency", instrument("currency", currency_convert)))
+    application.add_handler(CommandHandler("units", instrument("units", unit_convert)))
+    application.add_handler(CommandHandler("emoji", instrument("emoji", emoji_suggest)))
+    application.add_handler(CommandHandler("bmi", instrument("bmi", bmi_calc)))
+    application.add_handler(CommandHandler("id", instrument("id", get_id)))
     
     # Button handler
-    application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(CallbackQueryHandler(copy_id_button))
+    application.add_handler(CallbackQueryHandler(instrument("button", button_handler)))
+    application.add_handler(CallbackQueryHandler(instrument("copy_id", copy_id_button)))
     
      # Message handler
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument("message", handle_message)))
     
     # Error handler
     application.add_error_handler(error_handler)
     
-    # Start the Bot
-    logger.info("Bot is running...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    startup_profile.mark("application")
+    return application
+
+# ======================
+# Webhook server
+# ======================
+
+HEALTH_MESSAGE = "🤖 Bot is running!"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def metrics_authorized(authorization: str) -> bool:
+    """Check an Authorization header against METRICS_TOKEN, or WEBHOOK_SECRET if that is unset.
+    
+    The metrics share a port with the public webhook, so without either
+    token they are not served at all.
+    """
+    token = config.config.get('METRICS_TOKEN') or config.config.get('WEBHOOK_SECRET')
+    if not token:
+        return False
+    return hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+
+async def send_http_response(send, status: int, body: str, content_type: str = "text/plain; charset=utf-8"):
+    payload = body.encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type.encode()),
+            (b"content-length", str(len(payload)).encode())
+        ]
+    })
+    await send({"type": "http.response.body", "body": payload})
+
+class WebhookApp:
+    """ASGI app serving the Telegram webhook, the health check and authenticated metrics on the bot's event loop"""
+    def __init__(self, application: Application, path: str, secret_token: Optional[str]):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token.encode() if secret_token else None
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        
+        path, method = scope["path"], scope["method"]
+        if path == "/" and method in ("GET", "HEAD"):
+            await send_http_response(send, 200, HEALTH_MESSAGE)
+        elif path == "/metrics" and method == "GET":
+            authorization = dict(scope["headers"]).get(b"authorization", b"").decode("latin-1")
+            if metrics_authorized(authorization):
+                await send_http_response(send, 200, metrics.render(), METRICS_CONTENT_TYPE)
+            else:
+                await send_http_response(send, 403, "Forbidden")
+        elif path == self.path and method == "POST":
+            await self.handle_update(scope, receive, send)
+        else:
+            await send_http_response(send, 404, "Not Found")
+    
+    async def handle_update(self, scope, receive, send):
+        if self.secret_token is not None:
+            headers = dict(scope["headers"])
+            token = headers.get(b"x-telegram-bot-api-secret-token", b"")
+            if not hmac.compare_digest(token, self.secret_token):
+                await send_http_response(send, 403, "Forbidden")
+                return
+        
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            await send_http_response(send, 400, "Bad Request")
+            return
+        
+        await self.application.update_queue.put(update)
+        await send_http_response(send, 200, "OK")
+
+def create_webhook_server(application: Application) -> tuple:
+    """Build the uvicorn server for WebhookApp; returns (server, webhook url, secret token)"""
+    import uvicorn
+    
+    path = config.config.get('WEBHOOK_PATH', '/telegram')
+    secret_token = config.config.get('WEBHOOK_SECRET')
+    url = config.config['WEBHOOK_URL'].rstrip('/') + path
+    server = uvicorn.Server(uvicorn.Config(
+        WebhookApp(application, path, secret_token),
+        host=config.config.get('WEBHOOK_LISTEN', '0.0.0.0'),
+        port=int(config.config.get('WEBHOOK_PORT', 8000)),
+        lifespan="off",
+        log_level="warning"
+    ))
+    return server, url, secret_token
+
+async def register_webhook(application: Application, url: str, secret_token: Optional[str]):
+    await application.bot.set_webhook(
+        url,
+        secret_token=secret_token,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=int(config.config.get('WEBHOOK_MAX_CONNECTIONS', 40))
+    )
+
+async def run_webhook(application: Application):
+    """Serve updates via webhook and the health route from one server on this event loop"""
+    server, url, secret_token = create_webhook_server(application)
+    
+    try:
+        async with application:
+            await post_init(application)
+            await register_webhook(application, url, secret_token)
+            await application.start()
+            logger.info(f"Bot is running with webhook at {url}")
+            try:
+                await server.serve()
+            finally:
+                await application.stop()
+    finally:
+        await post_shutdown(application)
+
+# ======================
+# Sharded mode
+# ======================
+
+class ShardDispatcher:
+    """Route updates by chat_id to SHARDS worker processes, so each chat is always handled by one shard.
+    
+    Every shard runs the full bot on its own history files (see shard_path),
+    shares bans, runtime settings and key cooldowns through SharedState and
+    records chats in one SubscriberRegistry table. Updates go over a pipe per worker, with one sender task each so
+    a slow shard only backs up its own queue. Workers that die are restarted.
+    
+    The first sharded start hands over the single-process state: bans go into
+    SharedState, known chats into the shared registry, and the history store is
+    split into the shard files by chat_id % SHARDS.
+    """
+    def __init__(self, count: int):
+        import multiprocessing
+        self.count = count
+        # spawn gives each worker a clean interpreter that builds its own shard-local singletons
+        self.context = multiprocessing.get_context("spawn")
+        self.queue_size = int(config.config.get('SHARD_QUEUE_SIZE', 1000))
+        self.split_batch = int(config.config.get('SHARD_SPLIT_BATCH', 5000))
+        self.processes: List = [None] * count
+        self.connections: List = [None] * count
+        self.queues: List[asyncio.Queue] = []
+    
+    def prepare(self):
+        """Move single-process bans, chats and history into sharded storage; blocking, run before start()"""
+        shared_state.seed_bans(sorted(banned_users.banned))
+        source = conversation_store.backend
+        registry = SubscriberRegistry(SHARED_STATE_FILE)
+        try:
+            if os.path.exists(SUBSCRIBERS_FILE):
+                registry.seed(SUBSCRIBERS_FILE, lambda: SubscriberRegistry.read_file(SUBSCRIBERS_FILE))
+            chat_ids = self.split_history(source)
+            if chat_ids is not None:
+                registry.seed(source.path, lambda: chat_ids)
+        finally:
+            registry.close()
+            source.close()
+    
+    def split_history(self, source: HistoryBackend) -> Optional[List[str]]:
+        """Copy each chat of the single-process store into its shard's file, once; returns the chat IDs.
+        
+        Returns None when the store was already split for this shard count. A
+        chat the shard file already holds is newer there and is kept. The
+        source file is left as it was.
+        """
+        shards = shared_state.meta("history_shards")
+        if shards == self.count:
+            return None
+        if shards is not None:
+            raise RuntimeError(
+                f"History is split across {shards} shards; set SHARDS={shards} "
+                "or merge the shard files back before changing the shard count"
+            )
+        
+        source.open()
+        targets = [type(source)(shard_path(source.path, index)) for index in range(self.count)]
+        chat_ids = []
+        try:
+            for target in targets:
+                target.open()
+            existing = [set(target.chat_ids()) for target in targets]
+            batches: List[Dict[str, ChatHistory]] = [{} for _ in targets]
+            for chat_id, history in source.iter_chats():
+                chat_ids.append(chat_id)
+                # Same rule as route(), so a chat's history lands on the shard that handles it
+                index = int(chat_id) % self.count
+                if chat_id in existing[index]:
+                    continue
+                batches[index][chat_id] = history
+                if len(batches[index]) >= self.split_batch:
+                    targets[index].write_chats(batches[index])
+                    batches[index] = {}
+            for target, batch in zip(targets, batches):
+                if batch:
+                    target.write_chats(batch)
+        finally:
+            for target in targets:
+                target.close()
+        
+        shared_state.set_meta("history_shards", self.count)
+        logger.info(f"Split {len(chat_ids)} chats from {source.path} across {self.count} shards")
+        return chat_ids
+    
+    def spawn(self, index: int):
+        parent, child = self.context.Pipe()
+        os.environ['HINATA_SHARD'] = f"{index}/{self.count}"
+        try:
+            process = self.context.Process(target=run_shard_worker, args=(child,), name=f"shard-{index}")
+            process.start()
+        finally:
+            del os.environ['HINATA_SHARD']
+        child.close()
+        self.processes[index], self.connections[index] = process, parent
+        logger.info(f"Started shard {index} (pid {process.pid})")
+    
+    def start(self):
+        for index in range(self.count):
+            self.spawn(index)
+    
+    def route(self, update: Update) -> int:
+        if update.effective_chat is not None:
+            return update.effective_chat.id % self.count
+        if update.effective_user is not None:
+            return update.effective_user.id % self.count
+        return 0
+    
+    async def _send_loop(self, index: int):
+        queue = self.queues[index]
+        while True:
+            data = await queue.get()
+            for attempt in range(2):
+                if not self.processes[index].is_alive():
+                    logger.warning(f"Shard {index} exited with code {self.processes[index].exitcode}, restarting")
+                    self.connections[index].close()
+                    self.spawn(index)
+                try:
+                    await asyncio.to_thread(self.connections[index].send_bytes, data)
+                    break
+                except OSError as e:
+                    logger.error(f"Could not hand update to shard {index}: {e}")
+    
+    async def forward(self, update_queue: asyncio.Queue):
+        self.queues = [asyncio.Queue(self.queue_size) for _ in range(self.count)]
+        senders = [asyncio.create_task(self._send_loop(index)) for index in range(self.count)]
+        try:
+            while True:
+                update = await update_queue.get()
+                await self.queues[self.route(update)].put(json.dumps(update.to_dict()).encode())
+        finally:
+            for sender in senders:
+                sender.cancel()
+    
+    async def stop(self):
+        # Closing the pipes lets each worker finish its in-flight updates and shut down cleanly
+        for connection in self.connections:
+            if connection is not None:
+                connection.close()
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, 30)
+            if process.is_alive():
+                logger.warning(f"Shard {index} did not stop in time, terminating")
+                process.terminate()
 
-app = Flask(__name__)
+def run_shard_worker(connection):
+    """Entry point of a shard worker process"""
+    import signal
+    # Ctrl-C reaches the whole process group; shards stop when the dispatcher closes their pipe
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_shard(connection))
+
+async def serve_shard(connection):
+    application = build_application(webhook=True)
+    loop = asyncio.get_running_loop()
+    readable = asyncio.Event()
+    
+    try:
+        async with application:
+            await post_init(application)
+            await application.start()
+            loop.add_reader(connection.fileno(), readable.set)
+            logger.info(f"Shard {SHARD} is running")
+            try:
+                while True:
+                    await readable.wait()
+                    readable.clear()
+                    while connection.poll():
+                        data = json.loads(connection.recv_bytes())
+                        await application.update_queue.put(Update.de_json(data, application.bot))
+            except EOFError:
+                logger.info(f"Shard {SHARD} is shutting down")
+            finally:
+                loop.remove_reader(connection.fileno())
+                await application.stop()
+    finally:
+        await post_shutdown(application)
+
+async def run_dispatcher(application: Application, shards: int, webhook: bool):
+    """Receive updates by polling or webhook in this process and fan them out to shard workers"""
+    dispatcher = ShardDispatcher(shards)
+    await asyncio.to_thread(dispatcher.prepare)
+    dispatcher.start()
+    
+    try:
+        async with application:
+            forwarder = asyncio.create_task(dispatcher.forward(application.update_queue))
+            try:
+                if webhook:
+                    server, url, secret_token = create_webhook_server(application)
+                    await register_webhook(application, url, secret_token)
+                    logger.info(f"Dispatching webhook updates from {url} to {shards} shards")
+                    await server.serve()
+                else:
+                    import signal
+                    stop = asyncio.Event()
+                    loop = asyncio.get_running_loop()
+                    for sig in (signal.SIGINT, signal.SIGTERM):
+                        loop.add_signal_handler(sig, stop.set)
+                    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                    logger.info(f"Dispatching polled updates to {shards} shards")
+                    await stop.wait()
+                    await application.updater.stop()
+            finally:
+                forwarder.cancel()
+    finally:
+        await dispatcher.stop()
 
-@app.route("/")
-def home():
-    return "🤖 Bot is running!"
+# Polling fallback: the health check runs on Flask in a separate thread
+def create_flask_app():
+    # Flask is only needed in polling mode and is slow to import, so load it here
+    from flask import Flask, request
+    app = Flask(__name__)
+    
+    @app.route("/")
+    def home():
+        return HEALTH_MESSAGE
+    
+    @app.route("/metrics")
+    def metrics_endpoint():
+        if not metrics_authorized(request.headers.get("Authorization", "")):
+            return "Forbidden", 403
+        return metrics.render(), 200, {"Content-Type": METRICS_CONTENT_TYPE}
+    
+    return app
 
 def run_flask():
-    app.run(host="0.0.0.0", port=8000)
+    create_flask_app().run(host="0.0.0.0", port=8000)
+
+def main():
+    mode = config.config.get('UPDATE_MODE', 'polling').lower()
+    shards = int(config.config.get('SHARDS', 1))
+    
+    if shards > 1:
+        application = build_application(webhook=mode == 'webhook')
+        if mode != 'webhook':
+            threading.Thread(target=run_flask).start()
+        asyncio.run(run_dispatcher(application, shards, mode == 'webhook'))
+        return
+    
+    if mode == 'webhook':
+        application = build_application(webhook=True)
+        asyncio.run(run_webhook(application))
+        return
+    
+    application = build_application()
     
-if __name__ == "__main__":
     # Start Flask server in a separate thread
     threading.Thread(target=run_flask).start()
     
+    # Start the Bot
+    logger.info("Bot is running...")
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    
+if __name__ == "__main__":
     main()
-    # Simple Flask server for health check
 
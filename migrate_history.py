@@ -0,0 +1,36 @@
+"""Import an existing conversation_history.json into the SQLite history backend.
+
+Usage:
+    python migrate_history.py [--source conversation_history.json] [--target conversation_history.db]
+
+The bot does this itself the first time it starts on the SQLite backend (the
+default); run it by hand to import ahead of time or from another file.
+"""
+import argparse
+
+from main import (
+    CONVERSATION_HISTORY_FILE,
+    HISTORY_DB_FILE,
+    SqliteHistoryBackend,
+    logger
+)
+
+def migrate(source: str, target: str, batch_size: int = 500) -> int:
+    backend = SqliteHistoryBackend(target)
+    try:
+        return backend.import_json(source, batch_size)
+    finally:
+        backend.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Import conversation_history.json into SQLite")
+    parser.add_argument('--source', default=CONVERSATION_HISTORY_FILE)
+    parser.add_argument('--target', default=HISTORY_DB_FILE)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    count = migrate(args.source, args.target, args.batch_size)
+    logger.info(f"Imported {count} chats from {args.source} into {args.target}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# main reads config.txt and opens its state files relative to the working
+# directory on import, so run the tests from a scratch directory of their own
+WORKDIR = tempfile.mkdtemp(prefix="hinata-tests-")
+os.chdir(WORKDIR)
+with open("config.txt", "w") as f:
+    f.write("TELEGRAM_BOT_TOKEN=123456:test\n")
+    f.write("GEMINI_API_KEY=test-key\n")
+    f.write("HINGLISH_PROMPT=You are a test bot.\n")
+
+class FakeClock:
+    """Stands in for time.monotonic and time.time so tests can move time forward"""
+    def __init__(self, start: float = 1000.0):
+        self.now = start
+    
+    def __call__(self) -> float:
+        return self.now
+    
+    def advance(self, seconds: float):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    import main
+    fake = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", fake)
+    monkeypatch.setattr(main.time, "time", fake)
+    return fake
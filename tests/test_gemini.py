@@ -0,0 +1,152 @@
+import httpx
+import pytest
+
+import main
+
+def make_router(**overrides):
+    settings = {
+        'GEMINI_MODEL_MIN_SAMPLES': '2',
+        'GEMINI_MODEL_ERROR_THRESHOLD': '0.5',
+        'GEMINI_MODEL_OPEN_SECONDS': '30',
+        'GEMINI_MODEL_MAX_OPEN_SECONDS': '600',
+    }
+    settings.update(overrides)
+    original = dict(main.config.config)
+    main.config.config.update(settings)
+    try:
+        return main.ModelRouter(["pro", "flash"])
+    finally:
+        main.config.config.clear()
+        main.config.config.update(original)
+
+def open_circuit(router, model):
+    for _ in range(router.min_samples):
+        router.record(model, 500, 1.0)
+    assert router.circuits[model].state == "open"
+
+def test_parse_retry_after_prefers_the_header():
+    response = httpx.Response(429, headers={"retry-after": "7"}, json={
+        "error": {"details": [{"retryDelay": "30s"}]}
+    })
+    assert main.parse_retry_after(response) == 7.0
+
+def test_parse_retry_after_reads_the_error_details():
+    response = httpx.Response(429, headers={"retry-after": "soon"}, json={
+        "error": {"details": [{"@type": "QuotaFailure"}, {"retryDelay": "12.5s"}]}
+    })
+    assert main.parse_retry_after(response) == 12.5
+
+def test_parse_retry_after_without_a_hint():
+    assert main.parse_retry_after(httpx.Response(429, text="Too Many Requests")) is None
+    assert main.parse_retry_after(httpx.Response(429, json={"error": {}})) is None
+
+def test_key_pool_picks_the_least_loaded_key(clock):
+    pool = main.KeyPool(["k0", "k1", "k2"], [])
+    first = pool.acquire()
+    second = pool.acquire()
+    third = pool.acquire()
+    assert {first.index, second.index, third.index} == {0, 1, 2}
+    
+    pool.release(second, ok=True)
+    assert pool.acquire() is second
+    assert pool.acquire(exclude={first.index}).index != first.index
+
+def test_key_pool_cools_down_rate_limited_keys(clock):
+    pool = main.KeyPool(["k0", "k1"], [])
+    key = pool.acquire()
+    pool.release(key, ok=False, status=429, retry_after=20)
+    assert pool.cooldown_remaining() == 0
+    
+    other = pool.acquire()
+    assert other is not key
+    pool.release(other, ok=False, status=429)
+    assert pool.cooldown_remaining() == pytest.approx(pool.base_cooldown)
+    
+    # With every key cooling down, the one that recovers first is used
+    assert pool.acquire() is other
+    pool.release(other, ok=False, status=429)
+    # Without a Retry-After the cooldown doubles with each 429 in a row
+    assert other.cooldown_until == pytest.approx(clock.now + pool.base_cooldown * 2)
+    assert pool.cooldown_remaining() == pytest.approx(20)
+    assert pool.acquire() is key
+
+def test_key_pool_success_resets_the_backoff(clock):
+    pool = main.KeyPool(["k0"], [])
+    key = pool.acquire()
+    pool.release(key, ok=False, status=429)
+    clock.advance(pool.base_cooldown)
+    key = pool.acquire()
+    pool.release(key, ok=True, status=200)
+    assert key.rate_limit_streak == 0
+    
+    key = pool.acquire()
+    pool.release(key, ok=False, status=429)
+    assert key.cooldown_until == pytest.approx(clock.now + pool.base_cooldown)
+
+def test_key_pool_cancel_records_no_outcome(clock):
+    pool = main.KeyPool(["k0"], [])
+    key = pool.acquire()
+    pool.cancel(key)
+    assert key.in_flight == 0
+    assert not key.outcomes
+
+def test_router_opens_a_failing_model(clock):
+    router = make_router()
+    assert router.choose() == ("pro", False)
+    open_circuit(router, "pro")
+    assert router.choose() == ("flash", False)
+    assert router.preferred() == "flash"
+
+def test_router_lets_one_probe_through_after_the_cooldown(clock):
+    router = make_router()
+    open_circuit(router, "pro")
+    clock.advance(30)
+    
+    assert router.choose() == ("pro", True)
+    assert router.circuits["pro"].state == "half-open"
+    # Everyone else keeps using the fallback while the probe is out
+    assert router.choose() == ("flash", False)
+    
+    router.record("pro", 200, 1.0, probe=True)
+    assert router.circuits["pro"].state == "closed"
+    assert router.choose() == ("pro", False)
+
+def test_router_reopens_for_longer_after_a_failed_probe(clock):
+    router = make_router()
+    open_circuit(router, "pro")
+    clock.advance(30)
+    assert router.choose() == ("pro", True)
+    
+    router.record("pro", 503, 1.0, probe=True)
+    circuit = router.circuits["pro"]
+    assert circuit.state == "open"
+    assert circuit.reopen_at == pytest.approx(clock.now + 60)
+
+def test_router_ignores_non_probe_results_while_half_open(clock):
+    router = make_router()
+    open_circuit(router, "pro")
+    clock.advance(30)
+    assert router.choose() == ("pro", True)
+    
+    # A request that started before the circuit opened finishes late
+    router.record("pro", 200, 1.0)
+    router.abandon("pro")
+    circuit = router.circuits["pro"]
+    assert circuit.state == "half-open"
+    assert circuit.probing
+    assert router.choose() == ("flash", False)
+
+def test_router_abandoned_probe_lets_the_next_request_probe(clock):
+    router = make_router()
+    open_circuit(router, "pro")
+    clock.advance(30)
+    assert router.choose() == ("pro", True)
+    
+    router.abandon("pro", probe=True)
+    assert router.choose() == ("pro", True)
+
+def test_router_counts_slow_replies_as_failures(clock):
+    router = make_router(GEMINI_MODEL_SLOW_SECONDS='5')
+    for _ in range(router.min_samples):
+        router.record("pro", 200, 6.0)
+    assert router.circuits["pro"].state == "open"
@@ -0,0 +1,62 @@
+import pytest
+
+import main
+
+def test_token_bucket_allows_a_burst_then_refills(clock):
+    bucket = main.TokenBucket(rate=2.0, capacity=3)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.delay() == pytest.approx(0.5)
+    
+    clock.advance(0.5)
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+def test_token_bucket_never_exceeds_capacity(clock):
+    bucket = main.TokenBucket(rate=10.0, capacity=2)
+    clock.advance(60)
+    assert bucket.try_acquire(2)
+    assert not bucket.try_acquire()
+
+def test_token_bucket_pause_blocks_until_it_ends(clock):
+    bucket = main.TokenBucket(rate=1.0, capacity=5)
+    bucket.pause(4)
+    assert bucket.delay() == pytest.approx(4)
+    assert not bucket.try_acquire()
+    
+    # A shorter pause never cuts a longer one short
+    bucket.pause(1)
+    clock.advance(3)
+    assert not bucket.try_acquire()
+    clock.advance(1)
+    assert bucket.try_acquire()
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = main.TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+def test_ttl_cache_expires_entries(clock):
+    cache = main.TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    clock.advance(4)
+    assert cache.get("a") == 1
+    clock.advance(2)
+    assert cache.get("a", "gone") == "gone"
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_ttl_cache_pop_and_clear():
+    cache = main.TTLCache(maxsize=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.pop("a") == 1
+    assert cache.pop("a", "missing") == "missing"
+    cache.clear()
+    assert len(cache) == 0
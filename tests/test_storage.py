@@ -0,0 +1,41 @@
+import main
+
+def test_chat_history_blob_round_trip():
+    history = main.ChatHistory()
+    history.append("user", "namaste 🙏", 100.5)
+    history.append("model", "", 101.25)
+    history.append("user", "kya haal hai?\nsab badhiya", 102.0)
+    
+    restored = main.ChatHistory.from_bytes(history.to_bytes())
+    assert restored.entries() == history.entries()
+    assert restored.last_active() == 102.0
+
+def test_chat_history_blob_keeps_ring_order():
+    history = main.ChatHistory()
+    for i in range(main.HISTORY_LIMIT + 3):
+        history.append("user" if i % 2 else "model", f"message {i}", float(i))
+    
+    restored = main.ChatHistory.from_bytes(history.to_bytes())
+    assert len(restored) == main.HISTORY_LIMIT
+    assert restored.entries() == history.entries()
+    assert restored.entries()[0].message == "message 3"
+    assert main.ChatHistory.from_bytes(b"").entries() == []
+
+def bans(state):
+    return {row[0] for row in state.execute("SELECT user_id FROM bans")}
+
+def test_seed_bans_imports_once(tmp_path):
+    path = str(tmp_path / "shared_state.db")
+    state = main.SharedState(path)
+    state.seed_bans([1, 2])
+    assert bans(state) == {1, 2}
+    
+    # Everyone is unbanned while sharded; the stale file must not bring them back
+    state.execute("DELETE FROM bans")
+    state.conn.close()
+    
+    restarted = main.SharedState(path)
+    restarted.seed_bans([1, 2])
+    assert bans(restarted) == set()
+    assert restarted.meta("bans_seeded") == 1
+    restarted.conn.close()